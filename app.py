@@ -1,19 +1,148 @@
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.responses import JSONResponse, FileResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import yt_dlp
+from yt_dlp.postprocessor import FFmpegPostProcessor
 import os
 import json
 import uuid
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode, quote
 import threading
 import time
 import platform
+import shutil
 import re
+import copy
+import functools
+import sqlite3
+import hashlib
+import hmac
+import struct
+import heapq
+import bisect
+import itertools
+import random
+import asyncio
+import sys
+import socket
+import http.server
+import logging
+import logging.handlers
+import queue
+import contextvars
+import atexit
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+# Hot-path messages (per-chunk progress and the like) only keep one record in LOG_SAMPLE_EVERY
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", 100))
+# Records waiting for the writer thread; beyond this they are dropped rather than blocking
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Download id (in download threads) or request id (in request handlers) stamped on every record
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+class CorrelationFilter(logging.Filter):
+    """Stamps records with the current correlation id and thins out sampled hot-path records
+
+    Runs in the thread that logs, so it only does a contextvar read and, for
+    records logged with extra={'sample': key}, a counter bump.
+    """
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self.counters = {}  # sample key -> itertools.count
+
+    def filter(self, record):
+        sample = getattr(record, 'sample', None)
+        if sample is not None:
+            counter = self.counters.get(sample) or self.counters.setdefault(sample, itertools.count())
+            if next(counter) % self.sample_every:
+                return False
+        record.correlation_id = correlation_id.get()
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that hands the raw record to the writer thread and drops it when the queue is full
+
+    The stock prepare() formats the message in the calling thread; records never
+    leave the process here, so formatting is left to the listener.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line for log shippers"""
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage(),
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def configure_logging():
+    """Route the app logger through a bounded queue to a single writer thread"""
+    logger = logging.getLogger('fbdl')
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JSONLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s [%(correlation_id)s] %(message)s'))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(CorrelationFilter(LOG_SAMPLE_EVERY))
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)  # flush what is still queued
+    return logger, queue_handler
+
+logger, log_queue_handler = configure_logging()
+
+class YtDlpLogger:
+    """yt-dlp logger that feeds its output into ours instead of writing to stdout itself"""
+    def debug(self, msg):
+        # yt-dlp routes its regular screen output here too
+        logger.debug(msg)
+
+    def info(self, msg):
+        logger.debug(msg)
+
+    def warning(self, msg):
+        logger.warning(msg)
+
+    def error(self, msg):
+        logger.error(msg)
+
+ytdlp_logger = YtDlpLogger()
 
 def is_facebook_url_valid(url):
     """Enhanced Facebook URL validation"""
@@ -32,8 +161,42 @@ def is_facebook_url_valid(url):
         
     return any(pattern in url_lower for pattern in valid_patterns) or 'facebook.com' in url_lower
 
+@asynccontextmanager
+async def lifespan(app):
+    """Startup work that needs the whole module loaded and must only run in the serving process"""
+    if download_journal is not None:
+        download_journal.start(DOWNLOAD_HEARTBEAT_INTERVAL, DOWNLOAD_ORPHAN_TIMEOUT)
+    yield
+
+class CorrelationMiddleware:
+    """Gives every request a correlation id (the client's X-Request-ID if sent) for its log records
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed and pathsend
+    responses pass through untouched.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex[:12]
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', request_id.encode('latin-1'))]
+            await send(message)
+
+        token = correlation_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            correlation_id.reset(token)
+
 # Initialize FastAPI app
-app = FastAPI(title="Facebook Video Downloader")
+app = FastAPI(title="Facebook Video Downloader", lifespan=lifespan)
+app.add_middleware(CorrelationMiddleware)
 
 # Get the current directory and create absolute paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -54,38 +217,1177 @@ def create_directories():
             os.makedirs(directory, exist_ok=True)
             if platform.system() != 'Windows':
                 os.chmod(directory, 0o755)
-            print(f"✅ Created/verified directory: {directory}")
+            logger.info("✅ Created/verified directory: %s", directory)
         except Exception as e:
-            print(f"❌ Error creating directory {directory}: {e}")
+            logger.error("❌ Error creating directory %s: %s", directory, e)
 
 # Initialize directories
 create_directories()
 
-# Store download progress and completed files - OPTIMIZED
-download_progress = {}
-completed_downloads = {}
-filename_cache = {}
+MEDIA_EXTENSIONS = ('.mp4', '.webm', '.mkv')
+
+# Seconds between background reconciles of the output index against the directory
+OUTPUT_INDEX_RECONCILE_INTERVAL = float(os.environ.get("OUTPUT_INDEX_RECONCILE_INTERVAL", 300))
+# Tracked-but-never-created intermediate names are forgotten after this long
+OUTPUT_INDEX_CANDIDATE_TTL = 6 * 3600
+
+class OutputIndex:
+    """In-process index of outputs/ artifacts, maintained by the download pipeline
+
+    Lookups by download ID or base name are dict hits instead of os.listdir
+    scans with a stat per file. A periodic reconcile picks up files that were
+    created or removed behind the pipeline's back.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.files = {}  # filename -> {'size', 'mtime', 'download_id'}
+        self.bases = {}  # base name -> set of indexed filenames
+        self.candidates = {}  # base name -> (tracked_at, set of filenames that may appear)
+        self.finals = {}  # download_id -> final filename
+        self.reconciler = None
+        self.last_reconcile = 0.0
+        self.max_age = None  # set in shared-state mode, where other workers write outputs/ too
+
+    @staticmethod
+    def base_name(filename):
+        # Safe filenames never contain dots, so everything after the first one is
+        # a yt-dlp suffix (.f123v.mp4, .mp4.part, .temp.mp4, ...)
+        return filename.split('.', 1)[0]
+
+    def _stat(self, filename):
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _index(self, filename, size, mtime, download_id=None):
+        entry = self.files.get(filename)
+        if download_id is None and entry:
+            download_id = entry['download_id']
+        self.files[filename] = {'size': size, 'mtime': mtime, 'download_id': download_id}
+        self.bases.setdefault(self.base_name(filename), set()).add(filename)
+        if download_id:
+            self.finals[download_id] = filename
+
+    def _unindex(self, filename):
+        entry = self.files.pop(filename, None)
+        if entry is None:
+            return
+        base = self.base_name(filename)
+        names = self.bases.get(base)
+        if names:
+            names.discard(filename)
+            if not names:
+                del self.bases[base]
+        if entry['download_id'] and self.finals.get(entry['download_id']) == filename:
+            del self.finals[entry['download_id']]
+
+    def track(self, filename):
+        """Remember a file the pipeline may create (e.g. a .part) so cleanup can find it"""
+        base = self.base_name(filename)
+        with self.lock:
+            _, names = self.candidates.get(base, (None, set()))
+            names.add(filename)
+            self.candidates[base] = (time.time(), names)
+
+    def add(self, filename, download_id=None):
+        """Index a file that now exists on disk, optionally as a download's final output"""
+        stat = self._stat(filename)
+        if stat is None:
+            return
+        with self.lock:
+            self._index(filename, stat[0], stat[1], download_id)
+
+    def remove(self, filename):
+        with self.lock:
+            self._unindex(filename)
+
+    def get(self, filename):
+        with self.lock:
+            entry = self.files.get(filename)
+            return dict(entry) if entry else None
+
+    def final_file(self, download_id):
+        with self.lock:
+            return self.finals.get(download_id)
+
+    def entries(self):
+        """(filename, entry) pairs for every indexed file"""
+        with self.lock:
+            return [(filename, dict(entry)) for filename, entry in self.files.items()]
+
+    def files_for_base(self, base_name):
+        """Indexed and tracked filenames sharing a base name"""
+        with self.lock:
+            names = set(self.bases.get(base_name, ()))
+            names.update(self.candidates.get(base_name, (None, ()))[1])
+        return names
+
+    def forget_base(self, base_name):
+        with self.lock:
+            self.candidates.pop(base_name, None)
+
+    def media_files(self):
+        """(filename, entry) pairs for non-empty video files"""
+        with self.lock:
+            return [
+                (filename, dict(entry)) for filename, entry in self.files.items()
+                if filename.endswith(MEDIA_EXTENSIONS) and entry['size'] > 0
+            ]
+
+    def recent_media(self, limit):
+        return heapq.nlargest(limit, self.media_files(), key=lambda item: item[1]['mtime'])
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': sum(entry['size'] for entry in self.files.values()),
+                'tracked_candidates': sum(len(names) for _, names in self.candidates.values()),
+            }
+
+    def ensure_fresh(self):
+        """Reconcile first if other processes may have changed outputs/ since the last sync"""
+        if self.max_age is not None and time.time() - self.last_reconcile > self.max_age:
+            self.reconcile()
+
+    def reconcile(self):
+        """Resync the index with the directory (one scandir, no per-file stat calls)"""
+        self.last_reconcile = time.time()
+        try:
+            found = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        found[entry.name] = (stat.st_size, stat.st_mtime)
+        except OSError as e:
+            logger.warning("⚠️ Could not reconcile output index: %s", e)
+            return
+
+        expired = time.time() - OUTPUT_INDEX_CANDIDATE_TTL
+        with self.lock:
+            for filename in [name for name in self.files if name not in found]:
+                self._unindex(filename)
+            for filename, (size, mtime) in found.items():
+                self._index(filename, size, mtime)
+            for base in [base for base, (tracked_at, _) in self.candidates.items() if tracked_at < expired]:
+                del self.candidates[base]
+
+    def start_reconciler(self, interval):
+        """Reconcile periodically in a daemon thread"""
+        if self.reconciler or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reconcile()
+
+        self.reconciler = threading.Thread(target=loop, name='output-index', daemon=True)
+        self.reconciler.start()
+
+output_index = OutputIndex(OUTPUTS_DIR)
+output_index.reconcile()
+output_index.start_reconciler(OUTPUT_INDEX_RECONCILE_INTERVAL)
+
+# Job state store settings - records expire after JOB_STATE_TTL seconds without updates
+JOB_STATE_TTL = float(os.environ.get("JOB_STATE_TTL", 6 * 3600))
+JOB_STATE_MAX_ENTRIES = int(os.environ.get("JOB_STATE_MAX_ENTRIES", 10000))
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE_BACKEND", "memory")  # memory | sqlite | shared
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(BASE_DIR, 'jobs.db'))
+
+# 'shared' lets several worker processes use one SQLite WAL file as the source of truth
+SHARED_STATE = JOB_STORE_BACKEND == 'shared'
+# How stale the output index and SSE streams may get when other workers do the writing
+SHARED_STATE_POLL_INTERVAL = float(os.environ.get("SHARED_STATE_POLL_INTERVAL", 1))
+OUTPUT_INDEX_SHARED_MAX_AGE = float(os.environ.get("OUTPUT_INDEX_SHARED_MAX_AGE", 5))
+
+class JobRecord:
+    """Compact per-download state, updated in place on every progress tick"""
+    __slots__ = ('status', 'percent', 'message', 'speed', 'eta', 'downloaded', 'total',
+                 'error', 'filename', 'filepath', 'last_update', 'completed_at')
+
+    # Fields exposed through /progress (completed_at is internal bookkeeping)
+    PROGRESS_FIELDS = ('status', 'percent', 'message', 'speed', 'eta', 'downloaded', 'total',
+                       'error', 'filename', 'filepath', 'last_update')
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, None)
+
+    def assign(self, progress):
+        """Replace the progress fields with those in a progress dict"""
+        for field in self.PROGRESS_FIELDS:
+            setattr(self, field, progress.get(field))
+
+    def to_dict(self):
+        """Progress dict in the shape /progress has always returned"""
+        progress = {}
+        for field in self.PROGRESS_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                progress[field] = value
+        return progress
+
+    def to_row(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls()
+        for field in cls.__slots__:
+            setattr(record, field, row.get(field))
+        return record
+
+class SQLiteJobBackend:
+    """Persists job records to a SQLite file so state survives a restart"""
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        if shared:
+            # WAL lets every worker read while one writes; wait instead of failing on contention
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA busy_timeout=10000')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'download_id TEXT PRIMARY KEY, data TEXT NOT NULL, last_update REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_last_update ON jobs (last_update)')
+
+    def load(self, download_id):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM jobs WHERE download_id = ?', (download_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, download_id, row):
+        # Never replace a newer row - another worker may have written this job since
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO jobs (download_id, data, last_update) VALUES (?, ?, ?) '
+                'ON CONFLICT (download_id) DO UPDATE SET data = excluded.data, last_update = excluded.last_update '
+                'WHERE excluded.last_update >= jobs.last_update',
+                (download_id, json.dumps(row), row.get('last_update') or time.time())
+            )
+
+    def delete(self, download_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE download_id = ?', (download_id,))
+
+    def expire(self, before):
+        with self.lock:
+            return self.conn.execute('DELETE FROM jobs WHERE last_update < ?', (before,)).rowcount
+
+class JobStore:
+    """Bounded, expiring store of per-download state with an optional persistent backend
+
+    Records live in an OrderedDict ordered by last write, so both TTL expiry and
+    size-cap eviction pop from the front. With a backend every write is also
+    persisted and misses fall back to it, e.g. after a restart. In shared mode
+    the backend is the only source of truth: nothing is cached locally, so any
+    worker process sees updates made by the others.
+    """
+    def __init__(self, ttl, max_entries, backend=None, shared=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.shared = shared
+        self.records = OrderedDict()  # download_id -> JobRecord, least recently written first
+        self.lock = threading.Lock()
+        self.last_sweep = 0.0
+        self.stats = {'expired': 0, 'evicted': 0, 'backend_loads': 0}
+
+    def _lookup(self, download_id):
+        record = self.records.get(download_id)
+        if record is not None or self.backend is None:
+            return record
+        row = self.backend.load(download_id)
+        if row is None:
+            return None
+        record = JobRecord.from_row(row)
+        if self.shared:
+            return record
+        self.records[download_id] = record
+        self.records.move_to_end(download_id, last=False)  # loaded, not written
+        self.stats['backend_loads'] += 1
+        return record
+
+    def _written(self, download_id, record, now):
+        if record.last_update is None:
+            record.last_update = now
+        if self.shared:
+            if now - self.last_sweep > 60:
+                self._sweep(now)
+            return
+        self.records[download_id] = record
+        self.records.move_to_end(download_id)
+        while len(self.records) > self.max_entries:
+            self.records.popitem(last=False)
+            self.stats['evicted'] += 1
+        if now - self.last_sweep > 60:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        self.last_sweep = now
+        cutoff = now - self.ttl
+        while self.records:
+            download_id, record = next(iter(self.records.items()))
+            if (record.last_update or 0) >= cutoff:
+                break
+            del self.records[download_id]
+            self.stats['expired'] += 1
+        if self.backend:
+            self.backend.expire(cutoff)
+
+    def _persist(self, download_id, record):
+        # Called under self.lock so the backend sees writes in the same order as memory
+        if self.backend:
+            self.backend.save(download_id, record.to_row())
+
+    def get(self, download_id):
+        """Progress dict for download_id, or None"""
+        with self.lock:
+            record = self._lookup(download_id)
+            return record.to_dict() if record else None
+
+    def set(self, download_id, progress):
+        """Replace a job's progress fields; returns the record"""
+        now = time.time()
+        with self.lock:
+            record = self._lookup(download_id) or JobRecord()
+            record.assign(progress)
+            self._written(download_id, record, now)
+            self._persist(download_id, record)
+        return record
+
+    def set_unless_completed(self, download_id, progress):
+        """Like set, but leaves finished jobs alone; returns None when skipped"""
+        now = time.time()
+        with self.lock:
+            record = self._lookup(download_id) or JobRecord()
+            if record.completed_at is not None:
+                return None
+            record.assign(progress)
+            self._written(download_id, record, now)
+            self._persist(download_id, record)
+        return record
+
+    def update_download(self, download_id, percent, speed, eta, downloaded, total, now):
+        """Hot-path progress tick: assigns slots in place, no per-tick dict"""
+        with self.lock:
+            record = self._lookup(download_id) or JobRecord()
+            if record.completed_at is not None:
+                return record  # a late tick never reopens a finished job
+            record.status = 'downloading'
+            record.percent = percent
+            record.speed = speed
+            record.eta = eta
+            record.downloaded = downloaded
+            record.total = total
+            record.error = None
+            record.last_update = now
+            record.message = 'Downloading...'
+            self._written(download_id, record, now)
+            self._persist(download_id, record)
+        return record
+
+    def mark_finished(self, download_id, filename, filepath):
+        now = time.time()
+        with self.lock:
+            record = self._lookup(download_id) or JobRecord()
+            record.assign({
+                'status': 'finished',
+                'percent': 100,
+                'filename': filename,
+                'filepath': filepath,
+                'last_update': now,
+                'message': 'Download completed!'
+            })
+            record.completed_at = now
+            self._written(download_id, record, now)
+            self._persist(download_id, record)
+        return record
+
+    def delete(self, download_id):
+        with self.lock:
+            self.records.pop(download_id, None)
+        if self.backend:
+            self.backend.delete(download_id)
+
+    def get_completed(self, download_id):
+        """{'filename', 'filepath', 'completed_at'} for a finished job, or None"""
+        with self.lock:
+            record = self._lookup(download_id)
+            if record is None or record.completed_at is None:
+                return None
+            return {'filename': record.filename, 'filepath': record.filepath, 'completed_at': record.completed_at}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                **self.stats,
+                'entries': len(self.records),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'backend': type(self.backend).__name__ if self.backend else 'memory',
+                'shared': self.shared,
+            }
+
+def create_job_store():
+    backend = None
+    if JOB_STORE_BACKEND in ('sqlite', 'shared'):
+        backend = SQLiteJobBackend(JOB_STORE_PATH, shared=SHARED_STATE)
+        logger.info("✅ Job state %s: %s", 'shared via' if SHARED_STATE else 'persisted to', JOB_STORE_PATH)
+    return JobStore(JOB_STATE_TTL, JOB_STATE_MAX_ENTRIES, backend, shared=SHARED_STATE)
+
+job_store = create_job_store()
+
+if SHARED_STATE:
+    # Other workers write to outputs/ too - resync the index before answering from it
+    output_index.max_age = OUTPUT_INDEX_SHARED_MAX_AGE
+
+# Progress states after which no further updates arrive
+TERMINAL_PROGRESS_STATES = ('finished', 'error', 'cancelled', 'not_found')
+
+class ProgressChannel:
+    """Fan-out of progress updates from download threads to asyncio subscribers"""
+    def __init__(self, queue_size=16):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscribers = {}  # download_id -> set of (loop, queue)
+
+    def subscribe(self, download_id):
+        """Register the calling coroutine's loop; returns an asyncio.Queue of updates"""
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self.queue_size))
+        with self.lock:
+            self.subscribers.setdefault(download_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, download_id, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(download_id)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[download_id]
+
+    def publish(self, download_id, progress):
+        """Thread-safe push of a progress dict or JobRecord to every subscriber of download_id"""
+        with self.lock:
+            subscribers = tuple(self.subscribers.get(download_id, ()))
+        if not subscribers:
+            return
+        if isinstance(progress, JobRecord):
+            progress = progress.to_dict()  # snapshot now, the record keeps changing
+        for loop, subscriber_queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, subscriber_queue, progress)
+            except RuntimeError:
+                pass  # subscriber's loop already closed
+
+    @staticmethod
+    def _offer(subscriber_queue, progress):
+        # Slow consumers only need the latest state - drop the oldest update
+        if subscriber_queue.full():
+            subscriber_queue.get_nowait()
+        subscriber_queue.put_nowait(progress)
+
+    def subscriber_count(self):
+        with self.lock:
+            return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+progress_channel = ProgressChannel()
+
+def set_progress(download_id, progress):
+    """Store a progress record and push it to stream subscribers"""
+    progress_channel.publish(download_id, job_store.set(download_id, progress))
+
+def mark_download_finished(download_id, filename, filepath):
+    """Record a completed download and publish its final progress"""
+    progress = job_store.mark_finished(download_id, filename, filepath).to_dict()
+    progress_channel.publish(download_id, progress)
+    output_index.add(filename, download_id)
+    return progress
+
+# Latency buckets in seconds, from a cache hit to a long merge
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(2 ** power * 1024 for power in range(6, 18, 1))  # 64 KB/s .. 128 MB/s
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def format_metric_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in the Prometheus text format
+
+    Either incremented by hooks, or read at scrape time from a callback that
+    returns {label values tuple: value} - handy for totals a /stats snapshot
+    already keeps.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.callback is not None:
+            values = self.callback().items()
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.labels, key), value
+
+class Gauge(Counter):
+    """Point-in-time value, set by hooks or read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions under a lock"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(self.labels, key, (('le', format_metric_value(bound)),)), cumulative
+            yield self.name + '_sum' + format_labels(self.labels, key), counts[-1]
+            yield self.name + '_count' + format_labels(self.labels, key), cumulative
+
+class MetricsRegistry:
+    """Named metrics exposed by /metrics"""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {format_metric_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+# Pipeline stage hooks - everything else is read from the /stats snapshots at scrape time
+EXTRACT_QUEUE_WAIT = metrics.register(Histogram(
+    'fbdl_extraction_queue_wait_seconds', 'Time extraction jobs waited for a pool worker'))
+EXTRACT_RUN_TIME = metrics.register(Histogram(
+    'fbdl_extraction_run_seconds', 'Time a pool worker spent in yt-dlp extraction'))
+STRATEGY_LATENCY = metrics.register(Histogram(
+    'fbdl_extraction_strategy_seconds', 'Extraction latency per strategy and outcome',
+    labels=('pattern', 'strategy', 'outcome')))
+DOWNLOAD_QUEUE_WAIT = metrics.register(Histogram(
+    'fbdl_download_queue_wait_seconds', 'Time downloads waited for a free download slot'))
+DOWNLOAD_STAGE_TIME = metrics.register(Histogram(
+    'fbdl_download_stage_seconds', 'Wall time per download stage (download, merger, mediafinalizer, ...)',
+    labels=('stage',)))
+DOWNLOAD_THROUGHPUT = metrics.register(Histogram(
+    'fbdl_download_throughput_bytes_per_second', 'Average transfer rate of finished downloads',
+    buckets=THROUGHPUT_BUCKETS))
+DOWNLOAD_BYTES = metrics.register(Counter(
+    'fbdl_download_bytes_total', 'Bytes of finished downloads'))
+DOWNLOAD_OUTCOMES = metrics.register(Counter(
+    'fbdl_downloads_total', 'Download attempts by outcome', labels=('outcome',)))
+FILE_SERVE_BYTES = metrics.register(Counter(
+    'fbdl_file_serve_bytes_total', 'Bytes sent by /download_file', labels=('status',)))
+
+# Opt-in profiling of single runs: off unless PROFILE_TOKEN is set, then an
+# /extract_info or /download request sending it in X-Profile has its run
+# sampled and written to PROFILES_DIR as collapsed stacks
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN") or None
+PROFILES_DIR = os.environ.get("PROFILES_DIR", os.path.join(BASE_DIR, 'profiles'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 50))
+PROFILE_ID_PATTERN = re.compile(r'^(extract|download)-[0-9a-f-]{32,36}$')
+THREAD_NUMBER_PATTERN = re.compile(r'[-_]\d+')
+
+# The profiler of the run in progress, if any; copied into extraction pool threads with the context
+active_profile = contextvars.ContextVar('active_profile', default=None)
+
+class SamplingProfiler:
+    """Samples the stacks of the threads working on one run
+
+    Threads opt in with add_thread(): the run's own thread, the extraction pool
+    threads running its strategies and, through progress_hook, yt-dlp's
+    fragment threads. A background thread reads their frames with
+    sys._current_frames(), so the profiled code itself is not instrumented.
+    The result is written in the collapsed-stack format that flamegraph.pl,
+    speedscope and inferno read, one root per thread kind.
+    """
+    def __init__(self, profile_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.profile_id = profile_id
+        self.interval = interval
+        self.threads = {}  # thread ident -> root frame name
+        self.stacks = {}  # collapsed stack -> samples
+        self.frame_names = {}  # code object -> frame name
+        self.samples = 0
+        self.started_at = None
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.run, name=f'profiler-{profile_id}', daemon=True)
+
+    def add_thread(self):
+        """Sample the calling thread from now on"""
+        ident = threading.get_ident()
+        if ident not in self.threads:
+            self.threads[ident] = THREAD_NUMBER_PATTERN.sub('', threading.current_thread().name)
+
+    def remove_thread(self):
+        self.threads.pop(threading.get_ident(), None)
+
+    def progress_hook(self, _status):
+        """yt-dlp progress hook; fragment threads report progress, which enrolls them"""
+        self.add_thread()
+
+    def frame_name(self, code):
+        name = self.frame_names.get(code)
+        if name is None:
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.frame_names[code] = name
+        return name
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, root in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(root)
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            del frames
+
+    def start(self):
+        self.started_at = time.time()
+        self.sampler.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and write the profile; returns its path, or None if writing failed"""
+        self.stop_event.set()
+        self.sampler.join()
+        path = os.path.join(PROFILES_DIR, f'{self.profile_id}.folded')
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.error("❌ Could not write profile %s: %s", self.profile_id, e)
+            return None
+        logger.info("🔬 Profile %s: %d samples over %.1fs", self.profile_id, self.samples, time.time() - self.started_at)
+        prune_profiles()
+        return path
+
+def profile_requested(header_value):
+    """True if a request's X-Profile header asks for (and is allowed) a profile"""
+    if PROFILE_TOKEN is None or header_value is None:
+        return False
+    # Constant-time comparison so response timing does not leak the token
+    return hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+def list_profiles():
+    """Written profiles, newest first"""
+    try:
+        entries = [entry for entry in os.scandir(PROFILES_DIR) if entry.name.endswith('.folded')]
+    except OSError:
+        return []
+    profiles = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        profiles.append({'profile_id': entry.name[:-len('.folded')], 'size': stat.st_size, 'created': stat.st_mtime})
+    profiles.sort(key=lambda profile: profile['created'], reverse=True)
+    return profiles
+
+def prune_profiles():
+    """Keep only the newest PROFILE_MAX_FILES profiles"""
+    for profile in list_profiles()[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(PROFILES_DIR, f"{profile['profile_id']}.folded"))
+        except OSError:
+            pass
+
+# Extraction worker pool settings (yt-dlp extraction is blocking network I/O)
+EXTRACT_MAX_WORKERS = int(os.environ.get("EXTRACT_MAX_WORKERS", 16))
+EXTRACT_MAX_QUEUE = int(os.environ.get("EXTRACT_MAX_QUEUE", 64))
+EXTRACT_DEADLINE = float(os.environ.get("EXTRACT_DEADLINE", 90))
+
+class ExtractionPoolSaturated(Exception):
+    """Raised when every extraction worker is busy and the queue is full"""
+
+class ExtractionPool:
+    """Bounded thread pool that keeps blocking yt-dlp calls off the event loop"""
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='extract')
+        self.lock = threading.Lock()
+        self.pending = 0  # queued + running jobs
+        self.running = 0
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'queue_wait_total': 0.0,
+            'queue_wait_max': 0.0,
+            'extract_time_total': 0.0,
+            'extract_time_max': 0.0,
+        }
+
+    def _run_timed(self, func, args, submitted_at):
+        """Run func in a worker thread, recording queue wait and run time"""
+        started_at = time.perf_counter()
+        queue_wait = started_at - submitted_at
+        EXTRACT_QUEUE_WAIT.observe(queue_wait)
+        with self.lock:
+            self.running += 1
+            self.stats['queue_wait_total'] += queue_wait
+            self.stats['queue_wait_max'] = max(self.stats['queue_wait_max'], queue_wait)
+        profiler = active_profile.get()
+        if profiler is not None:
+            profiler.add_thread()
+        ok = False
+        try:
+            result = func(*args)
+            ok = True
+            return result
+        finally:
+            if profiler is not None:
+                profiler.remove_thread()
+            elapsed = time.perf_counter() - started_at
+            EXTRACT_RUN_TIME.observe(elapsed)
+            with self.lock:
+                self.running -= 1
+                self.stats['completed' if ok else 'failed'] += 1
+                self.stats['extract_time_total'] += elapsed
+                self.stats['extract_time_max'] = max(self.stats['extract_time_max'], elapsed)
+
+    def _release(self, _future):
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, func, *args, timeout=None):
+        """Run a blocking callable in the pool; raises ExtractionPoolSaturated when full"""
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.stats['rejected'] += 1
+                raise ExtractionPoolSaturated()
+            self.pending += 1
+            self.stats['submitted'] += 1
+
+        # Released on completion *or* cancellation, so a timed-out job that never
+        # started does not leak a slot. A job that already started keeps its slot
+        # until yt-dlp returns (bounded by socket_timeout).
+        # Executor threads do not inherit the caller's context; carry the request id over
+        future = self.executor.submit(contextvars.copy_context().run, self._run_timed, func, args, time.perf_counter())
+        future.add_done_callback(self._release)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.stats['timed_out'] += 1
+            raise
+
+    def snapshot(self):
+        """Return pool metrics for the /stats endpoint"""
+        with self.lock:
+            stats = dict(self.stats)
+            finished = stats['completed'] + stats['failed']
+            started = finished + self.running
+            stats.update({
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'running': self.running,
+                'queued': self.pending - self.running,
+                'queue_wait_avg': stats['queue_wait_total'] / started if started else 0.0,
+                'extract_time_avg': stats['extract_time_total'] / finished if finished else 0.0,
+            })
+        return stats
+
+extraction_pool = ExtractionPool(EXTRACT_MAX_WORKERS, EXTRACT_MAX_QUEUE)
+
+# Video info cache settings - keyed by canonical Facebook video ID
+VIDEO_CACHE_TTL = float(os.environ.get("VIDEO_CACHE_TTL", 1800))
+VIDEO_CACHE_MAX_ENTRIES = int(os.environ.get("VIDEO_CACHE_MAX_ENTRIES", 2048))
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get("VIDEO_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+VIDEO_CACHE_DIR = os.environ.get("VIDEO_CACHE_DIR") or None
+
+class VideoInfoCache:
+    """TTL + LRU cache of processed video data and the raw yt-dlp info dict"""
+    def __init__(self, ttl, max_entries, max_bytes, cache_dir=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()  # key -> (expires_at, size, entry)
+        self.tokens = OrderedDict()  # info token -> (expires_at, key)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+                      'disk_files_removed': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, re.sub(r'[^\w\-]', '_', key) + '.json')
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def _store(self, key, expires_at, size, entry):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (expires_at, size, entry)
+        self.total_bytes += size
+        # Evict least recently used entries until we fit both bounds
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
+
+    def get(self, key):
+        """Return the cached entry for key, or None on miss/expiry"""
+        if not key:
+            return None
+        now = time.time()
+        expired = False
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached:
+                expires_at, _, entry = cached
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry
+                self._remove(key)
+                self.stats['expirations'] += 1
+                expired = True
+
+        if expired:
+            # The disk copy was written with the same expiry
+            self._remove_from_disk(key)
+            return None
+        entry = self._load_from_disk(key, now)
+        with self.lock:
+            self.stats['disk_hits' if entry else 'misses'] += 1
+        return entry
+
+    def put(self, key, video_data, info):
+        """Cache processed video data together with the sanitized raw info dict"""
+        if not key or not video_data:
+            return
+        entry = {'video_data': video_data, 'info': info}
+        try:
+            payload = json.dumps(entry)
+        except (TypeError, ValueError) as e:
+            logger.warning("⚠️ Video info for %s is not cacheable: %s", key, e)
+            return
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._store(key, expires_at, len(payload), entry)
+        self._save_to_disk(key, expires_at, payload)
+
+    def issue_token(self, key):
+        """Hand out an opaque token that /download can use to reuse cached info"""
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = (time.time() + self.ttl, key)
+            while len(self.tokens) > self.max_entries * 4:
+                self.tokens.popitem(last=False)
+        return token
+
+    def resolve_token(self, token):
+        """Return the cache key an info token was issued for, or None"""
+        if not token:
+            return None
+        with self.lock:
+            issued = self.tokens.get(token)
+            if not issued:
+                return None
+            expires_at, key = issued
+            if expires_at <= time.time():
+                del self.tokens[token]
+                return None
+        return key
+
+    def _load_from_disk(self, key, now):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("⚠️ Could not read cache file %s: %s", path, e)
+            return None
 
-# Thread locks for thread safety
-progress_lock = threading.Lock()
+        if record.get('expires_at', 0) <= now:
+            self._remove_from_disk(key)
+            return None
+
+        entry = record['entry']
+        with self.lock:
+            self._store(key, record['expires_at'], len(json.dumps(entry)), entry)
+        return entry
+
+    def _remove_from_disk(self, key):
+        if not self.cache_dir:
+            return
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            return
+        with self.lock:
+            self.stats['disk_files_removed'] += 1
+
+    def sweep_disk(self):
+        """Delete cache files past their TTL (and stale temp files) that no lookup touched again"""
+        if not self.cache_dir:
+            return 0
+        cutoff = time.time() - self.ttl
+        removed = 0
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return 0
+        for entry in entries:
+            # Files are written once per put, so their mtime + TTL is their expiry
+            try:
+                if entry.name.endswith(('.json', '.tmp')) and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            with self.lock:
+                self.stats['disk_files_removed'] += removed
+        return removed
+
+    def _save_to_disk(self, key, expires_at, payload):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('{"expires_at": %r, "entry": %s}' % (expires_at, payload))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning("⚠️ Could not persist cache entry %s: %s", key, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def snapshot(self):
+        """Return cache metrics for the /stats endpoint"""
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+            stats.update({
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hit_rate': (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0,
+                'persistent': bool(self.cache_dir),
+            })
+        return stats
+
+video_info_cache = VideoInfoCache(VIDEO_CACHE_TTL, VIDEO_CACHE_MAX_ENTRIES, VIDEO_CACHE_MAX_BYTES, VIDEO_CACHE_DIR)
+
+# Hedged extraction - seconds to wait before racing the next strategy (0 = sequential).
+# Healthy extractions take 1-5s, so the default sits above that; once a URL pattern
+# has EXTRACT_HEDGE_MIN_SAMPLES wins, the p95 of its recent win latencies is used instead
+EXTRACT_HEDGE_DELAY = float(os.environ.get("EXTRACT_HEDGE_DELAY", 10))
+EXTRACT_HEDGE_MIN_SAMPLES = int(os.environ.get("EXTRACT_HEDGE_MIN_SAMPLES", 20))
+EXTRACT_HEDGE_WINDOW = 200  # recent win latencies kept per URL pattern
+
+class StrategyStats:
+    """Per URL pattern win rates and latencies for the extraction strategies"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}  # pattern -> strategy name -> counters
+        self.win_latencies = {}  # pattern -> recent win latencies, any strategy
+
+    def _counters(self, pattern, name):
+        return self.data.setdefault(pattern, {}).setdefault(name, {
+            'attempts': 0,
+            'wins': 0,
+            'failures': 0,
+            'cancelled': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        })
+
+    def record(self, pattern, name, outcome, latency=None):
+        """Record a 'win', 'failure' or 'cancelled' outcome for a strategy"""
+        with self.lock:
+            counters = self._counters(pattern, name)
+            counters['attempts'] += 1
+            if outcome == 'win':
+                counters['wins'] += 1
+                if latency is not None:
+                    self.win_latencies.setdefault(pattern, deque(maxlen=EXTRACT_HEDGE_WINDOW)).append(latency)
+            elif outcome == 'failure':
+                counters['failures'] += 1
+            else:
+                counters['cancelled'] += 1
+            if latency is not None:
+                counters['latency_total'] += latency
+                counters['latency_max'] = max(counters['latency_max'], latency)
+        if latency is not None:
+            STRATEGY_LATENCY.observe(latency, pattern=pattern, strategy=name, outcome=outcome)
+
+    def _score(self, pattern, name):
+        # Laplace-smoothed success rate; cancelled attempts carry no signal
+        counters = self.data.get(pattern, {}).get(name)
+        if not counters:
+            return 0.5
+        return (counters['wins'] + 1) / (counters['wins'] + counters['failures'] + 2)
+
+    def hedge_delay(self, pattern):
+        """Seconds to wait before hedging: p95 win latency for the pattern, EXTRACT_HEDGE_DELAY until known"""
+        if EXTRACT_HEDGE_DELAY <= 0:
+            return None
+        with self.lock:
+            latencies = sorted(self.win_latencies.get(pattern, ()))
+        if len(latencies) < EXTRACT_HEDGE_MIN_SAMPLES:
+            return EXTRACT_HEDGE_DELAY
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def order(self, pattern, strategies):
+        """Return strategies sorted by success rate for this pattern, stable on ties"""
+        with self.lock:
+            return sorted(strategies, key=lambda strategy: -self._score(pattern, strategy[0]))
+
+    def snapshot(self):
+        """Return per-pattern strategy stats for the /stats endpoint"""
+        with self.lock:
+            result = {}
+            for pattern, strategies in self.data.items():
+                result[pattern] = {}
+                for name, counters in strategies.items():
+                    decided = counters['wins'] + counters['failures']
+                    result[pattern][name] = {
+                        **counters,
+                        'win_rate': counters['wins'] / decided if decided else 0.0,
+                        'latency_avg': counters['latency_total'] / decided if decided else 0.0,
+                    }
+        return result
+
+strategy_stats = StrategyStats()
 
 # Pydantic models for request/response
 class ExtractInfoRequest(BaseModel):
     url: str
+    max_height: Optional[int] = None
+    preferred_codec: Optional[str] = None
+    max_filesize: Optional[int] = None
+    prefer_combined: bool = True
 
 class DownloadRequest(BaseModel):
     url: str
     format_id: str
+    info_token: Optional[str] = None
+    priority: int = 0
+
+class BatchExtractRequest(BaseModel):
+    urls: List[str]
+    concurrency: Optional[int] = None
+
+class BatchDownloadRequest(BaseModel):
+    urls: List[str]
+    format_id: str = 'bestvideo+bestaudio/best'
+    priority: int = -1  # behind interactive downloads by default
+    concurrency: Optional[int] = None
+    wait: bool = False  # report each item once its download finishes, not when queued
+    zip: bool = False  # stream the finished files back as one zip instead of NDJSON
+
+class CrawlRequest(BaseModel):
+    url: str
+    format_id: str = 'bestvideo+bestaudio/best'
+    priority: int = -1
+    limit: Optional[int] = None  # stop after this many entries
 
 def generate_safe_filename(title, max_length=40):
     """Generate a safe, predictable filename that matches yt-dlp output"""
     if not title or title.strip() == '':
         return f"facebook_video_{int(time.time())}"
-        
-    # Create cache key
-    if title in filename_cache:
-        return filename_cache[title]
-        
+    return _clean_title(title, max_length)
+
+@functools.lru_cache(maxsize=4096)
+def _clean_title(title, max_length):
+    """Bounded cache of title -> safe filename"""
     # Clean the title
     safe_name = title.strip()
         
@@ -106,8 +1408,6 @@ def generate_safe_filename(title, max_length=40):
     if len(safe_name) < 3:
         safe_name = f"facebook_video_{int(time.time())}"
         
-    # Cache the result
-    filename_cache[title] = safe_name
     return safe_name
 
 def find_completed_file(expected_filename, base_name):
@@ -118,217 +1418,1386 @@ def find_completed_file(expected_filename, base_name):
     if os.path.exists(expected_path) and os.path.getsize(expected_path) > 0:
         return expected_filename
         
-    # Search for variations
+    # Search the output index for variations of this base name
     try:
-        search_patterns = [
-            f"{base_name}.mp4",
-            f"{base_name}.webm",
-            f"{base_name}.mkv",
-        ]
-                
-        for filename in os.listdir(OUTPUTS_DIR):
-            file_path = os.path.join(OUTPUTS_DIR, filename)
-                        
-            # Skip if not a file or empty
-            if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+        output_index.ensure_fresh()
+        search_patterns = [f"{base_name}{ext}" for ext in MEDIA_EXTENSIONS]
+        candidates = []
+        for filename in output_index.files_for_base(base_name):
+            entry = output_index.get(filename)
+            if not entry or entry['size'] == 0 or time.time() - entry['mtime'] >= 600:  # Within last 10 minutes
                 continue
-                        
-            # Check if it matches our patterns and is recent
-            for pattern in search_patterns:
-                if filename == pattern:
-                    file_age = time.time() - os.path.getmtime(file_path)
-                    if file_age < 600:  # Within last 10 minutes
-                        return filename
-                                        
-            # Also check if base_name is in filename (for yt-dlp variations)
-            if base_name in filename and filename.endswith('.mp4'):
-                file_age = time.time() - os.path.getmtime(file_path)
-                if file_age < 600:
-                    return filename
+            if filename in search_patterns:
+                return filename
+            if filename.endswith('.mp4'):
+                candidates.append(filename)
+        return candidates[0] if candidates else None
                     
     except Exception as e:
-        print(f"⚠️ Error searching for completed file: {e}")
+        logger.warning("⚠️ Error searching for completed file: %s", e)
         return None
 
 def cleanup_intermediate_files(base_name):
     """Clean up intermediate files created during download/merge"""
     try:
-        for filename in os.listdir(OUTPUTS_DIR):
-            file_path = os.path.join(OUTPUTS_DIR, filename)
-                        
-            if os.path.isfile(file_path):
-                # Remove intermediate files (contain format IDs)
-                if (base_name in filename and 
-                     ('f' in filename and any(ext in filename for ext in ['.f', '.part', '.ytdl', '.tmp']))):
-                    try:
-
-                        os.remove(file_path)
-                        print(f"🗑️ Cleaned up intermediate file: {filename}")
-                    except Exception as e:
-                        print(f"⚠️ Could not remove {filename}: {e}")
+        for filename in output_index.files_for_base(base_name):
+            # Remove intermediate files (contain format IDs)
+            if ('f' in filename and any(ext in filename for ext in ['.f', '.part', '.ytdl', '.tmp'])):
+                try:
+                    os.remove(os.path.join(OUTPUTS_DIR, filename))
+                    logger.debug("🗑️ Cleaned up intermediate file: %s", filename)
+                except FileNotFoundError:
+                    pass  # yt-dlp already removed it after merging
+                except Exception as e:
+                    logger.warning("⚠️ Could not remove %s: %s", filename, e)
+                    continue
+                output_index.remove(filename)
+        output_index.forget_base(base_name)
                         
     except Exception as e:
-        print(f"⚠️ Error during cleanup: {e}")
+        logger.warning("⚠️ Error during cleanup: %s", e)
+
+# Progress is published at most this often per download; the EWMA speed forgets
+# half of its history every PROGRESS_SPEED_HALF_LIFE seconds
+PROGRESS_PUBLISH_INTERVAL = float(os.environ.get("PROGRESS_PUBLISH_INTERVAL", 0.5))
+PROGRESS_SPEED_HALF_LIFE = 3.0
+
+def format_speed(bytes_per_second):
+    return f"{yt_dlp.utils.format_bytes(bytes_per_second)}/s" if bytes_per_second else 'N/A'
+
+def format_eta(seconds):
+    if seconds is None:
+        return 'N/A'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+class DownloadProgress:
+    """Byte counts of one download across all of its streams, published to the job store
+
+    yt-dlp reports every chunk, from up to concurrent_fragment_downloads
+    threads at once, so the per-chunk path only stores the reporting stream's
+    byte counts in its own slot (plain item writes, atomic under the GIL).
+    Publishing is due every PROGRESS_PUBLISH_INTERVAL; the caller that wins a
+    non-blocking per-download lock sums the streams, updates the EWMA speed
+    and writes the job record while the others return at once. Streams of a
+    video+audio merge that have not started yet count with their expected
+    size, so the bar keeps going when the audio starts instead of resetting.
+    """
+    __slots__ = ('download_id', 'interval', 'streams', 'expected', 'lock', 'publish_lock',
+                 'next_publish', 'last_bytes', 'last_time', 'speed')
+
+    def __init__(self, download_id, interval=PROGRESS_PUBLISH_INTERVAL):
+        self.download_id = download_id
+        self.interval = interval
+        self.streams = {}  # format_id -> [downloaded, total]
+        self.expected = {}  # format_id -> size estimate from the extracted formats
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.next_publish = 0.0
+        self.last_bytes = 0
+        self.last_time = None
+        self.speed = None  # bytes/s
+
+    def _stream(self, d):
+        """The [downloaded, total] slot of the stream d reports on, registered on first sight"""
+        info = d.get('info_dict') or {}
+        key = info.get('format_id') or d.get('filename')
+        slot = self.streams.get(key)
+        if slot is None:
+            with self.lock:
+                if not self.expected:
+                    for fmt in info.get('requested_formats') or (info,):
+                        self.expected[fmt.get('format_id')] = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+                slot = self.streams.setdefault(key, [0, 0])
+        return slot
+
+    def update(self, d, now):
+        """Record a progress report (now is time.monotonic()); True when a publish is due"""
+        slot = self._stream(d)
+        downloaded = d.get('downloaded_bytes') or 0
+        # Fragment threads can report out of order; never move backwards
+        if downloaded > slot[0]:
+            slot[0] = downloaded
+        slot[1] = d.get('total_bytes') or d.get('total_bytes_estimate') or slot[1]
+        return now >= self.next_publish
+
+    def totals(self):
+        """(downloaded, total) bytes over every stream, expected ones included"""
+        downloaded = total = 0
+        for key, (stream_downloaded, stream_total) in list(self.streams.items()):
+            downloaded += stream_downloaded
+            total += stream_total or self.expected.get(key, 0)
+        for key, size in list(self.expected.items()):
+            if key not in self.streams:
+                total += size
+        return downloaded, total
+
+    def publish(self, now):
+        """Write the aggregate to the job store unless another thread is doing so"""
+        if not self.publish_lock.acquire(blocking=False):
+            return
+        try:
+            if now < self.next_publish:
+                return
+            self.next_publish = now + self.interval
+            downloaded, total = self.totals()
+            # The first publish only sets the baseline, so resumed bytes don't count as speed
+            if self.last_time is not None and now > self.last_time and downloaded >= self.last_bytes:
+                rate = (downloaded - self.last_bytes) / (now - self.last_time)
+                weight = 1 - 0.5 ** ((now - self.last_time) / PROGRESS_SPEED_HALF_LIFE)
+                self.speed = rate if self.speed is None else self.speed + weight * (rate - self.speed)
+            self.last_bytes = downloaded
+            self.last_time = now
+            percent = min(downloaded * 100 / total, 99) if total else 0
+            eta = (total - downloaded) / self.speed if self.speed and total > downloaded else None
+            record = job_store.update_download(
+                self.download_id, percent, format_speed(self.speed), format_eta(eta), downloaded, total, time.time()
+            )
+            progress_channel.publish(self.download_id, record)
+            logger.debug("📶 %.1f%% of %s bytes", percent, total, extra={'sample': 'progress'})
+        finally:
+            self.publish_lock.release()
 
 class OptimizedProgressHook:
-    def __init__(self, download_id, expected_filename, base_name):
+    def __init__(self, download_id, expected_filename, base_name, cancel_event=None):
         self.download_id = download_id
+        self.cancel_event = cancel_event
         self.expected_filename = expected_filename
         self.base_name = base_name
-        self.last_update = time.time()
-        self.last_percent = 0
-        self.update_threshold = 1.0  # Only update if progress changes by 1% or more
-        self.time_threshold = 2.0    # Or if 2 seconds have passed
+        self.progress = DownloadProgress(download_id)
+        self.tracked_files = set()
         
     def __call__(self, d):
+        # Raised outside the try block so yt-dlp aborts the download
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled('Download cancelled by user')
+
         try:
-            current_time = time.time()
-                        
-            if d['status'] == 'downloading':
-                # Extract progress information
-                downloaded = d.get('downloaded_bytes', 0) or 0
-                total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0) or 0
-                                
-                # Calculate percentage
-                if total > 0:
-                    percent = (downloaded / total) * 100
-                else:
-                    percent_str = d.get('_percent_str', '0%')
-                    try:
-                        percent = float(percent_str.replace('%', '').strip()) if percent_str != 'N/A' else 0
-                    except:
-                        percent = 0
-                                
-                # Only update if significant change or time threshold passed
-                percent_change = abs(percent - self.last_percent)
-                time_since_update = current_time - self.last_update
-                                
-                if percent_change >= self.update_threshold or time_since_update >= self.time_threshold:
-                    with progress_lock:
-                        download_progress[self.download_id] = {
-                            'status': 'downloading',
-                            'percent': min(percent, 99),
-                            'speed': d.get('_speed_str', 'N/A') or 'N/A',
-                            'eta': d.get('_eta_str', 'N/A') or 'N/A',
-                            'downloaded': downloaded,
-                            'total': total,
-                            'last_update': current_time,
-                            'message': 'Downloading...'
-                        }
-                                        
-                    self.last_percent = percent
-                    self.last_update = current_time
+            status = d['status']
+            if status == 'downloading':
+                # Register partial files once so cleanup never has to scan outputs/
+                tmpfilename = d.get('tmpfilename')
+                if tmpfilename and tmpfilename not in self.tracked_files:
+                    self.tracked_files.add(tmpfilename)
+                    output_index.track(os.path.basename(tmpfilename))
+                    if d.get('filename'):
+                        # Fragment downloads keep their resume state next to the target file
+                        output_index.track(os.path.basename(d['filename']) + '.ytdl')
+
+                now = time.monotonic()
+                if self.progress.update(d, now):
+                    self.progress.publish(now)
                         
-            elif d['status'] == 'finished':
+            elif status == 'finished':
+                # Count the whole stream, so the next one of a merge starts where this one ended
+                self.progress.update(d, time.monotonic())
                 filename = os.path.basename(d['filename'])
-                print(f"✅ File finished: {filename}")
+                logger.debug("✅ File finished: %s", filename)
+                output_index.add(filename)
                                 
                 # Check if this is the final file (not intermediate)
                 if not ('f' in filename and any(ext in filename for ext in ['v.', 'a.'])):
-                    self._mark_completed(filename, d['filename'], current_time)
+                    self._mark_completed(filename, d['filename'], time.time())
                         
-            elif d['status'] == 'error':
-                with progress_lock:
-                    download_progress[self.download_id] = {
-                        'status': 'error',
-                        'error': d.get('error', 'Unknown download error'),
-                        'percent': 0,
-                        'last_update': current_time,
-                        'message': 'Download failed'
-                    }
-                print(f"❌ Download error: {d.get('error', 'Unknown error')}")
+            elif status == 'error':
+                set_progress(self.download_id, {
+                    'status': 'error',
+                    'error': d.get('error', 'Unknown download error'),
+                    'percent': 0,
+                    'last_update': time.time(),
+                    'message': 'Download failed'
+                })
+                logger.error("❌ Download error: %s", d.get('error', 'Unknown error'))
                         
         except Exception as e:
-            print(f"❌ Progress hook error: {e}")
+            logger.error("❌ Progress hook error: %s", e, extra={'sample': 'progress-error'})
     
     def _mark_completed(self, filename, filepath, current_time):
         """Mark download as completed"""
-        with progress_lock:
-            completed_downloads[self.download_id] = {
-                'filename': filename,
-                'filepath': filepath,
-                'completed_at': current_time
-            }
-                        
-            download_progress[self.download_id] = {
-                'status': 'finished',
-                'percent': 100,
-                'filename': filename,
-                'filepath': filepath,
-                'last_update': current_time,
-                'message': 'Download completed!'
-            }
+        mark_download_finished(self.download_id, filename, filepath)
                 
-        print(f"🎉 DOWNLOAD COMPLETED: {filename}")
+        logger.info("🎉 DOWNLOAD COMPLETED: %s", filename)
                 
         # Clean up intermediate files
         cleanup_intermediate_files(self.base_name)
 
+# Download scheduler settings
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 4))
+MAX_CONCURRENT_MERGES = int(os.environ.get("MAX_CONCURRENT_MERGES", 2))
+
+# yt-dlp postprocessors (by pp_key) that spawn ffmpeg and count against the merge limit
+FFMPEG_POSTPROCESSORS = ('Merger', 'VideoConvertor', 'VideoRemuxer')
+
+class MergeGate:
+    """yt-dlp postprocessor hook that bounds concurrent ffmpeg runs across jobs"""
+    def __init__(self, semaphore, download_id):
+        self.semaphore = semaphore
+        self.download_id = download_id
+        self.held = 0
+
+    def __call__(self, d):
+        name = d.get('postprocessor') or ''
+        if name not in FFMPEG_POSTPROCESSORS and not name.startswith('Fixup'):
+            return
+
+        if d['status'] == 'started':
+            if not self.semaphore.acquire(blocking=False):
+                self._set_status('queued', 'Waiting for a free merge slot...')
+                self.semaphore.acquire()
+            self.held += 1
+            self._set_status('merging', 'Merging video and audio...')
+        elif d['status'] == 'finished' and self.held:
+            self.held -= 1
+            self.semaphore.release()
+
+    def _set_status(self, status, message):
+        progress = {
+            'status': status,
+            'percent': 99,
+            'message': message,
+            'last_update': time.time()
+        }
+        # Don't clobber a finished status when a convertor runs after completion
+        if job_store.set_unless_completed(self.download_id, progress):
+            progress_channel.publish(self.download_id, progress)
+
+    def release_all(self):
+        """Release slots still held when a postprocessor raised before finishing"""
+        while self.held:
+            self.held -= 1
+            self.semaphore.release()
+
+# Process-wide transfer budget shared by all running downloads (0 bandwidth = unlimited)
+DOWNLOAD_BANDWIDTH_LIMIT = int(os.environ.get("DOWNLOAD_BANDWIDTH_LIMIT", 0))  # bytes/sec
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", 32))
+DOWNLOAD_BUFFER_BUDGET = int(os.environ.get("DOWNLOAD_BUFFER_BUDGET", 128 * 1024 * 1024))
+JOB_MAX_CONNECTIONS = 8
+JOB_MAX_BUFFER = 4 * 1024 * 1024
+JOB_MIN_BUFFER = 64 * 1024
+
+class TransferBudget:
+    """Splits bandwidth, connections and buffer memory fairly across active downloads
+
+    Jobs register their live yt-dlp params dict; yt-dlp re-reads ratelimit on
+    every block and the other settings per request/format, so rebalancing on
+    each start and finish adapts running jobs without restarting them.
+    """
+    def __init__(self, bandwidth, connections, buffer_bytes):
+        self.bandwidth = bandwidth
+        self.connections = connections
+        self.buffer_bytes = buffer_bytes
+        self.lock = threading.Lock()
+        self.jobs = {}  # download_id -> yt-dlp params dict
+        self.stats = {'rebalances': 0, 'peak_jobs': 0}
+
+    def share(self, active):
+        """Per-job yt-dlp settings when `active` jobs split the budget"""
+        active = max(active, 1)
+        connections = max(1, min(JOB_MAX_CONNECTIONS, self.connections // active))
+        buffer_size = max(JOB_MIN_BUFFER, min(JOB_MAX_BUFFER, self.buffer_bytes // (active * connections)))
+        return {
+            'concurrent_fragment_downloads': connections,
+            'buffersize': buffer_size,
+            'ratelimit': self.bandwidth // active if self.bandwidth else None,
+            # yt-dlp grows read buffers up to JOB_MAX_BUFFER; pin them only when the budget is tighter
+            'noresizebuffer': buffer_size < JOB_MAX_BUFFER,
+        }
+
+    def acquire(self, download_id, params):
+        """Register a job's params and rebalance every active job"""
+        with self.lock:
+            self.jobs[download_id] = params
+            self.stats['peak_jobs'] = max(self.stats['peak_jobs'], len(self.jobs))
+            self._rebalance()
+
+    def release(self, download_id):
+        with self.lock:
+            if self.jobs.pop(download_id, None) is not None:
+                self._rebalance()
+
+    def _rebalance(self):
+        share = self.share(len(self.jobs))
+        for params in self.jobs.values():
+            params.update(share)
+        self.stats['rebalances'] += 1
+
+    def snapshot(self):
+        """Return budget usage for the /stats endpoint"""
+        with self.lock:
+            active = len(self.jobs)
+            share = self.share(active)
+            return {
+                **self.stats,
+                'active_jobs': active,
+                'bandwidth_limit': self.bandwidth,
+                'max_connections': self.connections,
+                'buffer_budget': self.buffer_bytes,
+                'per_job': {key: share[key] for key in ('concurrent_fragment_downloads', 'buffersize', 'ratelimit')},
+            }
+
+transfer_budget = TransferBudget(DOWNLOAD_BANDWIDTH_LIMIT, DOWNLOAD_MAX_CONNECTIONS, DOWNLOAD_BUFFER_BUDGET)
+
+class StageTimings:
+    """Cumulative wall time per download stage (download, merge, finalize, ...)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> [count, total seconds, max seconds]
+
+    def record(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        DOWNLOAD_STAGE_TIME.observe(seconds, stage=stage)
+
+    def snapshot(self):
+        """Return per-stage timings for the /stats endpoint"""
+        with self.lock:
+            return {
+                stage: {'count': count, 'total': total, 'avg': total / count, 'max': longest}
+                for stage, (count, total, longest) in self.stages.items()
+            }
+
+stage_timings = StageTimings()
+
+class PostprocessTimer:
+    """yt-dlp postprocessor hook that times each postprocessor run for one job"""
+    def __init__(self):
+        self.started = {}
+        self.durations = {}  # stage -> seconds
+
+    def __call__(self, d):
+        name = (d.get('postprocessor') or '').lower()
+        if d['status'] == 'started':
+            self.started[name] = time.time()
+        elif d['status'] == 'finished' and name in self.started:
+            elapsed = time.time() - self.started.pop(name)
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            stage_timings.record(name, elapsed)
+
+# Codecs that stream-copy into mp4 with any ffmpeg we ship. VP9, Opus and FLAC in
+# mp4 need a recent ffmpeg (or -strict) and play back unevenly, so files using
+# them are served in the container they came in.
+MP4_VIDEO_CODECS = ('h264', 'hevc', 'av1', 'mpeg4')
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'alac', 'ac3', 'eac3')
+# yt-dlp codec string prefixes -> ffprobe codec names, for when ffprobe is missing
+YTDLP_CODEC_NAMES = (
+    ('avc', 'h264'), ('h264', 'h264'), ('hvc', 'hevc'), ('hev', 'hevc'), ('h265', 'hevc'),
+    ('av01', 'av1'), ('mp4v', 'mpeg4'), ('mp4a', 'aac'), ('aac', 'aac'), ('mp3', 'mp3'),
+    ('ac-3', 'ac3'), ('ec-3', 'eac3'), ('alac', 'alac'),
+)
+
+def ffprobe_codec_name(codec):
+    """ffprobe-style name of a yt-dlp codec string (e.g. avc1.64001F -> h264)"""
+    codec = codec.lower()
+    for prefix, name in YTDLP_CODEC_NAMES:
+        if codec.startswith(prefix):
+            return name
+    return codec
+
+def mp4_is_faststart(path):
+    """True if the moov atom precedes mdat, None if the file is not a readable mp4"""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                size, kind = struct.unpack('>I4s', header)
+                header_size = 8
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0]
+                    header_size = 16
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size < header_size:
+                    return None
+                f.seek(size - header_size, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+class MediaFinalizerPP(FFmpegPostProcessor):
+    """Makes the final file a streamable mp4, touching it only when needed
+
+    Merges already write mp4 with +faststart in the same ffmpeg pass, so most
+    files are left alone. Other files are probed and remuxed (stream copy)
+    once, holding a merge slot only while ffmpeg actually runs.
+    """
+    def __init__(self, downloader=None, merge_semaphore=None):
+        super().__init__(downloader)
+        self.merge_semaphore = merge_semaphore
+
+    def stream_codecs(self, path, info):
+        """(codec_type, codec_name) of the file's streams - probed, else as yt-dlp reported them"""
+        if self.probe_available:
+            try:
+                streams = self.get_metadata_object(path).get('streams', [])
+                return [(stream.get('codec_type'), stream.get('codec_name')) for stream in streams]
+            except Exception as e:
+                logger.warning("⚠️ ffprobe failed for %s: %s", os.path.basename(path), e)
+        return [
+            (kind, ffprobe_codec_name(info[field]))
+            for kind, field in (('video', 'vcodec'), ('audio', 'acodec'))
+            if info.get(field) and info[field] not in MISSING_CODECS
+        ]
+
+    def remux_reason(self, path, info):
+        """Why the file needs a remux, or None if it can be served as-is"""
+        for kind, codec in self.stream_codecs(path, info):
+            codecs = MP4_VIDEO_CODECS if kind == 'video' else MP4_AUDIO_CODECS
+            if kind in ('video', 'audio') and codec not in codecs:
+                # Stream copy can't fix this and re-encoding is not worth it here
+                return None
+        if not path.endswith('.mp4'):
+            return 'container'
+        if mp4_is_faststart(path) is False:
+            return 'faststart'
+        return None
+
+    def run(self, info):
+        path = info['filepath']
+        reason = self.remux_reason(path, info)
+        if not reason:
+            self.to_screen(f'Serving "{path}" as is')
+            return [], info
+        if not self.available:
+            self.report_warning(f'ffmpeg not found, leaving "{path}" as is ({reason})')
+            return [], info
+
+        out_path = os.path.splitext(path)[0] + '.mp4'
+        temp_path = out_path + '.temp.mp4'
+        self.to_screen(f'Remuxing "{path}" ({reason})')
+        if self.merge_semaphore is not None:
+            self.merge_semaphore.acquire()
+        try:
+            self.run_ffmpeg(path, temp_path, ['-map', '0', '-dn', '-ignore_unknown', '-c', 'copy', '-movflags', '+faststart'])
+        except yt_dlp.utils.PostProcessingError as e:
+            # The download itself is fine; serve it unremuxed rather than failing the job
+            self.report_warning(f'Remux of "{path}" failed, leaving it as is: {e}')
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return [], info
+        finally:
+            if self.merge_semaphore is not None:
+                self.merge_semaphore.release()
+        os.replace(temp_path, out_path)
+        if out_path == path:
+            return [], info
+        info['filepath'] = out_path
+        info['ext'] = 'mp4'
+        output_index.remove(os.path.basename(path))
+        return [path], info
+
+class DownloadJob:
+    """A queued or running download"""
+    def __init__(self, download_id, url, format_id, info_token=None, priority=0, attempts=0, profile=False):
+        self.download_id = download_id
+        self.url = url
+        self.format_id = format_id
+        self.info_token = info_token
+        self.priority = priority
+        self.attempts = attempts  # retries and restarts so far
+        self.profile = profile  # sample the run with a SamplingProfiler
+        self.cancel_event = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+
+# Transient failures are retried with exponential backoff; each attempt resumes
+# from the .part/.ytdl files the previous one left behind. Restarts that
+# interrupt a job count against the same budget.
+DOWNLOAD_MAX_RETRIES = int(os.environ.get("DOWNLOAD_MAX_RETRIES", 3))
+DOWNLOAD_RETRY_BACKOFF = float(os.environ.get("DOWNLOAD_RETRY_BACKOFF", 2))
+DOWNLOAD_RETRY_MAX_DELAY = 60
+TRANSIENT_HTTP_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+TRANSIENT_ERROR_PATTERN = re.compile(
+    r'timed? ?out|connection (reset|refused|aborted)|temporar(y|ily)|incomplete ?read|'
+    r'HTTP Error (408|429|5\d\d)|network is unreachable|remote end closed|did not get any data blocks',
+    re.IGNORECASE
+)
+
+def is_transient_download_error(error):
+    """True for failures worth retrying - network trouble rather than a bad URL or format"""
+    cause = error.exc_info[1] if getattr(error, 'exc_info', None) else None
+    if isinstance(cause, yt_dlp.networking.exceptions.HTTPError):
+        return cause.status in TRANSIENT_HTTP_STATUSES
+    if isinstance(cause, (yt_dlp.networking.exceptions.TransportError, yt_dlp.utils.ContentTooShortError,
+                          TimeoutError, ConnectionError)):
+        return True
+    return bool(TRANSIENT_ERROR_PATTERN.search(str(error)))
+
+# Signed format URLs in cached info stop working once they expire
+EXPIRED_URL_HTTP_STATUSES = (403, 410)
+EXPIRED_URL_PATTERN = re.compile(r'HTTP Error (403|410)|expired', re.IGNORECASE)
+
+def is_expired_url_error(error):
+    """True when a format URL from cached info was refused, so a fresh extraction may help"""
+    cause = error.exc_info[1] if getattr(error, 'exc_info', None) else None
+    if isinstance(cause, yt_dlp.networking.exceptions.HTTPError):
+        return cause.status in EXPIRED_URL_HTTP_STATUSES
+    return bool(EXPIRED_URL_PATTERN.search(str(error)))
+
+def download_retry_delay(attempt):
+    """Backoff before retry number attempt (0-based), with jitter so retries do not stampede"""
+    return min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def run_download_job(job):
+    """Default scheduler runner - performs the actual yt-dlp download, retrying transient failures"""
+    filename = None
+    # Worker threads are reused, so the id is reset once this job is done
+    correlation = correlation_id.set(job.download_id)
+    profiler = None
+    if job.profile:
+        profiler = SamplingProfiler(f'download-{job.download_id}').start()
+        profiler.add_thread()
+        profiling = active_profile.set(profiler)
+    try:
+        while download_video_background(job.url, job.format_id, job.download_id, job.info_token, job.cancel_event, job.attempts):
+            delay = download_retry_delay(job.attempts)
+            job.attempts += 1
+            DOWNLOAD_OUTCOMES.inc(outcome='retried')
+            journal = download_queue or download_journal
+            if journal is not None:
+                journal.record_attempt(job.download_id, job.attempts)
+            logger.info("⏳ Retrying download %s in %.1fs", job.download_id, delay)
+            if job.cancel_event.wait(delay):
+                logger.info("🛑 Download cancelled for ID: %s", job.download_id)
+                set_progress(job.download_id, {
+                    'status': 'cancelled',
+                    'percent': 0,
+                    'last_update': time.time(),
+                    'message': 'Download cancelled'
+                })
+                break
+        progress = job_store.get(job.download_id) or {}
+        DOWNLOAD_OUTCOMES.inc(outcome=progress.get('status') or 'unknown')
+        if progress.get('status') == 'finished':
+            filename = progress.get('filename')
+    finally:
+        download_registry.finish(job.download_id, filename)
+        if download_journal is not None:
+            download_journal.remove(job.download_id)
+        if profiler is not None:
+            active_profile.reset(profiling)
+            profiler.stop()
+        correlation_id.reset(correlation)
+
+# Completed-file store size (entries are dropped early once their file is gone)
+COMPLETED_STORE_MAX_ENTRIES = int(os.environ.get("COMPLETED_STORE_MAX_ENTRIES", 512))
+
+def get_download_key(video_id, format_id):
+    """Content address of a download: identical video + format share one key"""
+    return hashlib.sha1(f"{video_id}|{format_id}".encode('utf-8')).hexdigest()[:12]
+
+class DownloadRegistry:
+    """Single-flight coalescing of identical downloads plus a completed-file store"""
+    def __init__(self, max_completed):
+        self.max_completed = max_completed
+        self.lock = threading.Lock()
+        self.in_flight = {}  # download key -> {'download_id', 'subscribers'}
+        self.keys = {}  # download_id -> download key
+        self.completed = OrderedDict()  # download key -> filename
+        self.stats = {'started': 0, 'coalesced': 0, 'completed_hits': 0, 'evictions': 0}
+
+    def lookup_completed(self, key):
+        """Return the filename of a finished download for key if it is still on disk"""
+        with self.lock:
+            filename = self.completed.get(key)
+            if not filename:
+                return None
+            if not os.path.isfile(os.path.join(OUTPUTS_DIR, filename)):
+                del self.completed[key]
+                self.stats['evictions'] += 1
+                return None
+            self.completed.move_to_end(key)
+            self.stats['completed_hits'] += 1
+            return filename
+
+    def attach(self, key, download_id):
+        """Register download_id for key, or return the in-flight download_id to share"""
+        with self.lock:
+            flight = self.in_flight.get(key)
+            if flight:
+                flight['subscribers'] += 1
+                self.stats['coalesced'] += 1
+                return flight['download_id']
+            self.in_flight[key] = {'download_id': download_id, 'subscribers': 1}
+            self.keys[download_id] = key
+            self.stats['started'] += 1
+            return None
+
+    def detach(self, download_id):
+        """Drop one subscriber; returns True when nobody else is waiting on the job"""
+        with self.lock:
+            key = self.keys.get(download_id)
+            flight = self.in_flight.get(key)
+            if not flight:
+                return True
+            flight['subscribers'] -= 1
+            return flight['subscribers'] <= 0
+
+    def finish(self, download_id, filename=None):
+        """Mark a job done, remembering its output file for later identical requests"""
+        with self.lock:
+            key = self.keys.pop(download_id, None)
+            if key is None:
+                return
+            self.in_flight.pop(key, None)
+            if filename:
+                self.completed[key] = filename
+                self.completed.move_to_end(key)
+                while len(self.completed) > self.max_completed:
+                    self.completed.popitem(last=False)
+                    self.stats['evictions'] += 1
+
+    def snapshot(self):
+        """Return dedup metrics for the /stats endpoint"""
+        with self.lock:
+            return {
+                **self.stats,
+                'in_flight': len(self.in_flight),
+                'completed': len(self.completed),
+            }
+
+download_registry = DownloadRegistry(COMPLETED_STORE_MAX_ENTRIES)
+
+class DownloadScheduler:
+    """Bounded worker pool running download jobs in priority, then FIFO, order
+
+    The runner is injectable so the scheduler can be exercised with a fake
+    extractor instead of yt-dlp.
+    """
+    def __init__(self, max_workers, max_merges, runner=run_download_job):
+        self.max_workers = max_workers
+        self.runner = runner
+        self.merge_semaphore = threading.BoundedSemaphore(max_merges)
+        self.max_merges = max_merges
+        self.queue = []  # heap of (-priority, sequence, job)
+        self.sequence = itertools.count()
+        self.queued = {}  # download_id -> job
+        self.running = {}  # download_id -> job
+        self.condition = threading.Condition()
+        self.workers = []
+        self.stats = {'submitted': 0, 'completed': 0, 'cancelled': 0, 'queue_wait_total': 0.0}
+
+    def _ensure_workers(self):
+        # Started lazily so importing the app does not spawn threads
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, name=f'download-{len(self.workers)}', daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def submit(self, job):
+        """Queue a job; it starts as soon as a worker slot is free"""
+        with self.condition:
+            heapq.heappush(self.queue, (-job.priority, next(self.sequence), job))
+            self.queued[job.download_id] = job
+            self.stats['submitted'] += 1
+            self._ensure_workers()
+            self.condition.notify()
+
+    def cancel(self, download_id):
+        """Cancel a job; returns 'queued' or 'running', or None if the job is unknown"""
+        with self.condition:
+            job = self.queued.pop(download_id, None) or self.running.get(download_id)
+            if not job:
+                return None
+            job.cancel_event.set()
+            was_queued = download_id not in self.running
+            if was_queued:
+                self.stats['cancelled'] += 1
+
+        if was_queued:
+            # Queued jobs are skipped when popped; running jobs stop at the next progress tick
+            set_progress(download_id, {
+                'status': 'cancelled',
+                'percent': 0,
+                'last_update': time.time(),
+                'message': 'Download cancelled'
+            })
+        return 'queued' if was_queued else 'running'
+
+    def queue_position(self, download_id):
+        """1-based position of a queued job, or None if it is not queued"""
+        with self.condition:
+            if download_id not in self.queued:
+                return None
+            ordered = sorted(entry for entry in self.queue if entry[2].download_id in self.queued)
+            for position, entry in enumerate(ordered, start=1):
+                if entry[2].download_id == download_id:
+                    return position
+        return None
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                while self.queue:
+                    _, _, job = heapq.heappop(self.queue)
+                    # Cancelled jobs were already removed from self.queued
+                    if self.queued.pop(job.download_id, None) is job:
+                        job.started_at = time.time()
+                        self.running[job.download_id] = job
+                        self.stats['queue_wait_total'] += job.started_at - job.submitted_at
+                        DOWNLOAD_QUEUE_WAIT.observe(job.started_at - job.submitted_at)
+                        return job
+                self.condition.wait()
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            try:
+                self.runner(job)
+            except Exception as e:
+                logger.error("❌ Download worker error for ID %s: %s", job.download_id, e)
+            finally:
+                with self.condition:
+                    self.running.pop(job.download_id, None)
+                    self.stats['cancelled' if job.cancel_event.is_set() else 'completed'] += 1
+
+    def snapshot(self):
+        """Return scheduler metrics for the /stats endpoint"""
+        with self.condition:
+            started = self.stats['completed'] + self.stats['cancelled'] + len(self.running)
+            return {
+                **self.stats,
+                'max_workers': self.max_workers,
+                'max_merges': self.max_merges,
+                'queued': len(self.queued),
+                'running': len(self.running),
+                'queue_wait_avg': self.stats['queue_wait_total'] / started if started else 0.0,
+            }
+
+download_scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_MERGES)
+
+# inline: downloads run in the web process | queue: web enqueues, `python -m app worker` runs them.
+# Queue mode needs JOB_STORE_BACKEND=shared for web and worker alike and the same volume for
+# both - they share jobs.db and outputs/ through it. Only queue mode supports several web
+# workers: inline dedupe, cancel and file leases are per process. The Docker image defaults
+# to queue mode; the Procfile stays inline because its dynos do not share a filesystem.
+DOWNLOAD_EXECUTION = os.environ.get("DOWNLOAD_EXECUTION", "inline")
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 0.5))
+# Processes owning downloads refresh a heartbeat; jobs whose owner went quiet are re-queued
+DOWNLOAD_HEARTBEAT_INTERVAL = float(os.environ.get("DOWNLOAD_HEARTBEAT_INTERVAL", 10))
+DOWNLOAD_ORPHAN_TIMEOUT = float(os.environ.get("DOWNLOAD_ORPHAN_TIMEOUT", 60))
+
+# Unique per process start: a restarted container often gets the same hostname and pid
+PROCESS_NAME = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+def resumed_progress(attempts):
+    return {
+        'status': 'queued',
+        'percent': 0,
+        'message': f'Resuming interrupted download (attempt {attempts + 1})...',
+        'last_update': time.time()
+    }
+
+def abandoned_progress():
+    return {
+        'status': 'error',
+        'error': 'Download was interrupted too many times - please try again',
+        'percent': 0,
+        'last_update': time.time(),
+        'message': 'Download failed'
+    }
+
+class SQLiteJobQueue:
+    """Download queue shared between web and worker processes through the job store file
+
+    Mirrors the DownloadScheduler interface (submit/cancel/queue_position/snapshot)
+    so the web tier does not care where downloads run. Workers claim rows in
+    priority, then FIFO, order; cancelling a claimed row only flags it and the
+    owning worker stops the download on its next poll. Rows stay until their
+    worker is done, so a claimed row whose worker stopped heartbeating is an
+    interrupted download and goes back to the queue.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA busy_timeout=10000')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS download_queue ('
+            'download_id TEXT PRIMARY KEY, download_key TEXT, url TEXT, format_id TEXT, '
+            'info_token TEXT, priority INTEGER, enqueued_at REAL, worker TEXT, '
+            'claimed_at REAL, cancel_requested INTEGER DEFAULT 0, attempts INTEGER DEFAULT 0, heartbeat REAL, '
+            'profile INTEGER DEFAULT 0)'
+        )
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(download_queue)')}
+        for column, definition in (('attempts', 'INTEGER DEFAULT 0'), ('heartbeat', 'REAL'), ('profile', 'INTEGER DEFAULT 0')):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE download_queue ADD COLUMN {column} {definition}')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS download_queue_order ON download_queue (worker, priority, enqueued_at)')
+        self.stats = {'submitted': 0, 'coalesced': 0, 'claimed': 0, 'completed': 0, 'cancelled': 0,
+                      'requeued': 0, 'abandoned': 0}
+
+    def submit(self, job, download_key=None):
+        """Enqueue a job; returns the download_id of an identical queued/running job instead if there is one"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if download_key:
+                    row = self.conn.execute(
+                        'SELECT download_id FROM download_queue WHERE download_key = ? AND cancel_requested = 0',
+                        (download_key,)
+                    ).fetchone()
+                    if row:
+                        self.conn.execute('COMMIT')
+                        self.stats['coalesced'] += 1
+                        return row[0]
+                self.conn.execute(
+                    'INSERT INTO download_queue (download_id, download_key, url, format_id, info_token, priority, enqueued_at, profile) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job.download_id, download_key, job.url, job.format_id, job.info_token, job.priority, job.submitted_at,
+                     int(job.profile))
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.stats['submitted'] += 1
+            return None
+
+    def claim(self, worker):
+        """Atomically take the next unclaimed job for worker, or None if the queue is empty"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(
+                    'SELECT download_id, url, format_id, info_token, priority, enqueued_at, attempts, profile FROM download_queue '
+                    'WHERE worker IS NULL ORDER BY priority DESC, enqueued_at LIMIT 1'
+                ).fetchone()
+                if row:
+                    now = time.time()
+                    self.conn.execute(
+                        'UPDATE download_queue SET worker = ?, claimed_at = ?, heartbeat = ? WHERE download_id = ?',
+                        (worker, now, now, row[0])
+                    )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        self.stats['claimed'] += 1
+        job = DownloadJob(row[0], row[1], row[2], row[3], row[4], row[6] or 0, bool(row[7]))
+        job.submitted_at = row[5]
+        return job
+
+    def record_attempt(self, download_id, attempts):
+        with self.lock:
+            self.conn.execute('UPDATE download_queue SET attempts = ? WHERE download_id = ?', (attempts, download_id))
+
+    def heartbeat(self, worker):
+        """Mark worker's claimed jobs as still running"""
+        with self.lock:
+            self.conn.execute('UPDATE download_queue SET heartbeat = ? WHERE worker = ?', (time.time(), worker))
+
+    def requeue_orphans(self, stale_before):
+        """Put jobs claimed by workers that stopped heartbeating back in the queue"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT download_id, cancel_requested, attempts FROM download_queue '
+                    'WHERE worker IS NOT NULL AND COALESCE(heartbeat, claimed_at) < ?',
+                    (stale_before,)
+                ).fetchall()
+                for download_id, cancel_requested, attempts in rows:
+                    if cancel_requested or (attempts or 0) >= DOWNLOAD_MAX_RETRIES:
+                        self.conn.execute('DELETE FROM download_queue WHERE download_id = ?', (download_id,))
+                    else:
+                        self.conn.execute(
+                            'UPDATE download_queue SET worker = NULL, claimed_at = NULL, heartbeat = NULL, '
+                            'attempts = ? WHERE download_id = ?',
+                            ((attempts or 0) + 1, download_id)
+                        )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        for download_id, cancel_requested, attempts in rows:
+            if cancel_requested:
+                set_progress(download_id, {
+                    'status': 'cancelled',
+                    'percent': 0,
+                    'last_update': time.time(),
+                    'message': 'Download cancelled'
+                })
+            elif (attempts or 0) >= DOWNLOAD_MAX_RETRIES:
+                self.stats['abandoned'] += 1
+                logger.error("❌ Giving up on interrupted download %s", download_id)
+                set_progress(download_id, abandoned_progress())
+            else:
+                self.stats['requeued'] += 1
+                logger.info("♻️ Re-queued interrupted download %s", download_id)
+                set_progress(download_id, resumed_progress((attempts or 0) + 1))
+        return len(rows)
+
+    def pending_keys(self):
+        """Download keys of every queued or running job"""
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT download_key FROM download_queue') if row[0]}
+
+    def complete(self, download_id):
+        """Remove a job once its worker is done with it"""
+        with self.lock:
+            self.conn.execute('DELETE FROM download_queue WHERE download_id = ?', (download_id,))
+        self.stats['completed'] += 1
+
+    def cancel(self, download_id):
+        """Cancel a job; returns 'queued' or 'running', or None if the job is unknown"""
+        with self.lock:
+            if self.conn.execute(
+                'DELETE FROM download_queue WHERE download_id = ? AND worker IS NULL', (download_id,)
+            ).rowcount:
+                state = 'queued'
+            elif self.conn.execute(
+                'UPDATE download_queue SET cancel_requested = 1 WHERE download_id = ?', (download_id,)
+            ).rowcount:
+                state = 'running'
+            else:
+                return None
+        self.stats['cancelled'] += 1
+        if state == 'queued':
+            set_progress(download_id, {
+                'status': 'cancelled',
+                'percent': 0,
+                'last_update': time.time(),
+                'message': 'Download cancelled'
+            })
+        return state
+
+    def cancel_requests(self, worker):
+        """download_ids claimed by worker that have since been cancelled"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT download_id FROM download_queue WHERE worker = ? AND cancel_requested = 1', (worker,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def queue_position(self, download_id):
+        """1-based position of a queued job, or None if it is not queued"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT COUNT(*) + 1 FROM download_queue AS other, download_queue AS job '
+                'WHERE job.download_id = ? AND job.worker IS NULL AND other.worker IS NULL '
+                'AND (other.priority > job.priority OR (other.priority = job.priority AND other.enqueued_at < job.enqueued_at))',
+                (download_id,)
+            ).fetchone()
+            if row is None or not self.conn.execute(
+                'SELECT 1 FROM download_queue WHERE download_id = ? AND worker IS NULL', (download_id,)
+            ).fetchone():
+                return None
+        return row[0]
+
+    def snapshot(self):
+        """Return queue metrics for the /stats endpoint"""
+        with self.lock:
+            queued, running, workers = self.conn.execute(
+                'SELECT COUNT(*) - COUNT(worker), COUNT(worker), COUNT(DISTINCT worker) FROM download_queue'
+            ).fetchone()
+        return {
+            **self.stats,
+            'execution': 'queue',
+            'queued': queued,
+            'running': running,
+            'active_workers': workers,
+        }
+
+def create_download_queue():
+    if DOWNLOAD_EXECUTION != 'queue':
+        return None
+    if not SHARED_STATE:
+        # Workers report progress through the job store, so it has to be shared
+        logger.warning("⚠️ DOWNLOAD_EXECUTION=queue needs JOB_STORE_BACKEND=shared - running downloads inline")
+        return None
+    logger.info("✅ Download jobs queued for worker processes in: %s", JOB_STORE_PATH)
+    return SQLiteJobQueue(JOB_STORE_PATH)
+
+download_queue = create_download_queue()
+
+def run_queued_job(job):
+    """Worker-side runner: perform the download, then drop the job from the shared queue"""
+    try:
+        run_download_job(job)
+    finally:
+        download_queue.complete(job.download_id)
+
+# Worker processes serve no HTTP; set a port to expose their /metrics
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 0))
+
+def start_worker_metrics_server(port):
+    """Serve /metrics from a worker process on a plain http.server thread"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='worker-metrics', daemon=True).start()
+    logger.info("📈 Worker metrics on port %s", port)
+
+def run_worker():
+    """Worker tier entry point - claims queued downloads and runs them on the local scheduler"""
+    if download_queue is None:
+        logger.error("❌ The worker needs DOWNLOAD_EXECUTION=queue and JOB_STORE_BACKEND=shared")
+        sys.exit(1)
+
+    worker_name = PROCESS_NAME
+    download_scheduler.runner = run_queued_job
+    if WORKER_METRICS_PORT:
+        start_worker_metrics_server(WORKER_METRICS_PORT)
+    logger.info("🛠️ Download worker %s started (%s slots, %s merges)", worker_name, download_scheduler.max_workers, download_scheduler.max_merges)
+
+    cancelling = set()
+    last_heartbeat = 0
+    while True:
+        if time.time() - last_heartbeat >= DOWNLOAD_HEARTBEAT_INTERVAL:
+            last_heartbeat = time.time()
+            download_queue.heartbeat(worker_name)
+            # Jobs of workers that died mid-download go back to the queue and resume from their .part files
+            download_queue.requeue_orphans(last_heartbeat - DOWNLOAD_ORPHAN_TIMEOUT)
+
+        requested = set(download_queue.cancel_requests(worker_name))
+        for download_id in requested - cancelling:
+            if download_scheduler.cancel(download_id):
+                logger.info("🛑 Cancel requested for ID: %s", download_id)
+        cancelling = requested
+
+        # Only claim what can start right away so other workers can pick up the rest
+        snapshot = download_scheduler.snapshot()
+        claimed = False
+        if snapshot['queued'] + snapshot['running'] < download_scheduler.max_workers:
+            job = download_queue.claim(worker_name)
+            if job:
+                logger.info("📦 Claimed download %s", job.download_id)
+                download_scheduler.submit(job)
+                claimed = True
+        if not claimed:
+            time.sleep(WORKER_POLL_INTERVAL)
+
+class DownloadJournal:
+    """Write-ahead record of inline downloads, so jobs interrupted by a restart are picked up again
+
+    A row is written before a job is handed to the scheduler and deleted once
+    its runner returns (or it is cancelled while queued), so any row whose owner
+    stopped heartbeating belongs to an interrupted download. Those are adopted
+    by whichever process notices first and re-queued; yt-dlp then continues
+    from the .part/.ytdl files the interrupted attempt left in outputs/.
+    """
+    def __init__(self, path, owner, shared=False):
+        self.path = path
+        self.owner = owner
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        if shared:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA busy_timeout=10000')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS download_journal ('
+            'download_id TEXT PRIMARY KEY, download_key TEXT, url TEXT, format_id TEXT, info_token TEXT, '
+            'priority INTEGER, submitted_at REAL, attempts INTEGER DEFAULT 0, owner TEXT, heartbeat REAL)'
+        )
+        self.thread = None
+        self.stats = {'recorded': 0, 'resumed': 0, 'abandoned': 0}
+
+    def record(self, job, download_key):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO download_journal (download_id, download_key, url, format_id, info_token, '
+                'priority, submitted_at, attempts, owner, heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.download_id, download_key, job.url, job.format_id, job.info_token, job.priority,
+                 job.submitted_at, job.attempts, self.owner, time.time())
+            )
+        self.stats['recorded'] += 1
+
+    def record_attempt(self, download_id, attempts):
+        with self.lock:
+            self.conn.execute('UPDATE download_journal SET attempts = ? WHERE download_id = ?', (attempts, download_id))
+
+    def remove(self, download_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM download_journal WHERE download_id = ?', (download_id,))
+
+    def heartbeat(self):
+        with self.lock:
+            self.conn.execute('UPDATE download_journal SET heartbeat = ? WHERE owner = ?', (time.time(), self.owner))
+
+    def adopt(self, stale_before):
+        """Take over the rows of owners that stopped heartbeating; returns them"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT download_id, download_key, url, format_id, info_token, priority, submitted_at, attempts '
+                    'FROM download_journal WHERE owner != ? AND heartbeat < ?',
+                    (self.owner, stale_before)
+                ).fetchall()
+                self.conn.execute(
+                    'UPDATE download_journal SET owner = ?, heartbeat = ?, attempts = attempts + 1 '
+                    'WHERE owner != ? AND heartbeat < ?',
+                    (self.owner, time.time(), self.owner, stale_before)
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return rows
+
+    def resume_orphans(self, stale_before):
+        """Re-queue interrupted downloads on this process's scheduler"""
+        for download_id, download_key, url, format_id, info_token, priority, submitted_at, attempts in self.adopt(stale_before):
+            if attempts >= DOWNLOAD_MAX_RETRIES:
+                logger.error("❌ Giving up on interrupted download %s", download_id)
+                self.remove(download_id)
+                set_progress(download_id, abandoned_progress())
+                self.stats['abandoned'] += 1
+                continue
+            existing_id = download_registry.attach(download_key, download_id)
+            if existing_id:
+                # An identical download was started here meanwhile; running both would race on one file
+                download_registry.detach(existing_id)
+                self.remove(download_id)
+                set_progress(download_id, {
+                    'status': 'error',
+                    'error': 'Download was interrupted and has been restarted - please request it again',
+                    'percent': 0,
+                    'last_update': time.time(),
+                    'message': 'Download failed'
+                })
+                continue
+            job = DownloadJob(download_id, url, format_id, info_token, priority, attempts + 1)
+            job.submitted_at = submitted_at
+            set_progress(download_id, resumed_progress(attempts + 1))
+            logger.info("♻️ Resuming interrupted download %s", download_id)
+            download_scheduler.submit(job)
+            self.stats['resumed'] += 1
+
+    def pending_keys(self):
+        """Download keys of every journaled job"""
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT download_key FROM download_journal') if row[0]}
+
+    def start(self, interval, orphan_timeout):
+        if self.thread or interval <= 0:
+            return
+
+        def loop():
+            # Only this process uses an unshared store, so whatever is left over was interrupted
+            stale_before = time.time() if not self.shared else time.time() - orphan_timeout
+            while True:
+                try:
+                    self.heartbeat()
+                    self.resume_orphans(stale_before)
+                except Exception as e:
+                    logger.warning("⚠️ Download journal pass failed: %s", e)
+                time.sleep(interval)
+                stale_before = time.time() - orphan_timeout
+
+        self.thread = threading.Thread(target=loop, name='download-journal', daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        """Return journal metrics for the /stats endpoint"""
+        with self.lock:
+            pending, owners = self.conn.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT owner) FROM download_journal'
+            ).fetchone()
+        return {**self.stats, 'pending': pending, 'owners': owners}
+
+def create_download_journal():
+    # Journaling only makes sense when job state itself outlives the process
+    if download_queue is not None or JOB_STORE_BACKEND not in ('sqlite', 'shared'):
+        return None
+    return DownloadJournal(JOB_STORE_PATH, PROCESS_NAME, shared=SHARED_STATE)
+
+download_journal = create_download_journal()  # started by lifespan()
+
+def pending_download_keys():
+    """Download keys of jobs that may still resume - their intermediate files must be kept"""
+    journal = download_queue or download_journal
+    return journal.pending_keys() if journal is not None else set()
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/extract_info")
-async def extract_info(request_data: ExtractInfoRequest):
+async def extract_info(request_data: ExtractInfoRequest, x_profile: Optional[str] = Header(None)):
+    profiler = None
+    if profile_requested(x_profile):
+        profiler = SamplingProfiler(f'extract-{uuid.uuid4()}').start()
+        active_profile.set(profiler)
     try:
-        url = request_data.url.strip()
-        
-        if not url:
-            raise HTTPException(status_code=400, detail='Please provide a valid URL')
-        
-        # FIXED: Enhanced URL validation and normalization
-        normalized_url = normalize_facebook_url(url)
-        if not normalized_url:
-            raise HTTPException(status_code=400, detail='Please provide a valid Facebook video URL. Supported formats: facebook.com/watch, facebook.com/reel, fb.watch, or direct video links')
-        
-        print(f"🔍 Original URL: {url}")
-        print(f"🔗 Normalized URL: {normalized_url}")
-        
-        # Try multiple extraction strategies
-        video_data = None
-        last_error = None
-        
-        # Strategy 1: Standard extraction with updated options
-        try:
-            video_data = await extract_with_strategy_1(normalized_url)
-            if video_data:
-                print("✅ Strategy 1 (Standard) succeeded")
-                return video_data
-        except Exception as e:
-            last_error = str(e)
-            print(f"⚠️ Strategy 1 failed: {e}")
-        
-        # Strategy 2: Alternative extraction method
-        try:
-            video_data = await extract_with_strategy_2(normalized_url)
-            if video_data:
-                print("✅ Strategy 2 (Alternative) succeeded")
-                return video_data
-        except Exception as e:
-            last_error = str(e)
-            print(f"⚠️ Strategy 2 failed: {e}")
-        
-        # Strategy 3: Generic extractor fallback
-        try:
-            video_data = await extract_with_strategy_3(normalized_url)
-            if video_data:
-                print("✅ Strategy 3 (Generic) succeeded")
-                return video_data
-        except Exception as e:
-            last_error = str(e)
-            print(f"⚠️ Strategy 3 failed: {e}")
-        
-        # If all strategies fail, provide helpful error message
-        error_message = get_helpful_error_message(last_error, url)
-        raise HTTPException(status_code=400, detail=error_message)
-        
+        policy = FormatPolicy(
+            max_height=request_data.max_height,
+            preferred_codec=request_data.preferred_codec,
+            max_filesize=request_data.max_filesize,
+            prefer_combined=request_data.prefer_combined
+        )
+        video_data = await extract_video_data(request_data.url, policy)
+        if profiler is not None:
+            video_data = {**video_data, 'profile_id': profiler.profile_id}
+        return video_data
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Unexpected error in extract_info: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Unexpected error in extract_info: %s", e)
         raise HTTPException(status_code=500, detail=f'An unexpected error occurred: {str(e)}')
+    finally:
+        if profiler is not None:
+            # Joins the sampler thread and writes the profile - keep it off the event loop
+            await asyncio.to_thread(profiler.stop)
+
+async def extract_video_data(url, policy=None):
+    """Extract (or fetch from cache) one video's formats; raises HTTPException on failure"""
+    url = url.strip()
+    
+    if not url:
+        raise HTTPException(status_code=400, detail='Please provide a valid URL')
+    
+    # FIXED: Enhanced URL validation and normalization
+    normalized_url = normalize_facebook_url(url)
+    if not normalized_url:
+        raise HTTPException(status_code=400, detail='Please provide a valid Facebook video URL. Supported formats: facebook.com/watch, facebook.com/reel, fb.watch, or direct video links')
+    
+    logger.debug("🔍 Original URL: %s", url)
+    logger.debug("🔗 Normalized URL: %s", normalized_url)
+
+    video_id = get_facebook_video_id(normalized_url)
+    cached = video_info_cache.get(video_id)
+    if cached:
+        logger.info("⚡ Cache hit for: %s", cached['video_data']['title'])
+        video_data = apply_format_policy(cached, policy)
+        return {**video_data, 'info_token': video_info_cache.issue_token(video_id)}
+    
+    # Try multiple extraction strategies within a single per-request deadline
+    try:
+        extracted, last_error = await asyncio.wait_for(
+            run_extraction_strategies(normalized_url), timeout=EXTRACT_DEADLINE
+        )
+    except ExtractionPoolSaturated:
+        logger.warning("⚠️ Extraction pool saturated, rejecting request")
+        raise HTTPException(
+            status_code=503,
+            detail='Server is busy extracting other videos. Please try again in a few seconds.',
+            headers={'Retry-After': '5'}
+        )
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Extraction deadline of %ss exceeded", EXTRACT_DEADLINE)
+        raise HTTPException(status_code=504, detail='Timed out while extracting video information. Please try again.')
+
+    if extracted:
+        video_data = apply_format_policy(extracted, policy)
+        return {**video_data, 'info_token': video_info_cache.issue_token(video_id)}
+
+    # If all strategies fail, provide helpful error message
+    error_message = get_helpful_error_message(last_error, url)
+    raise HTTPException(status_code=400, detail=error_message)
+
+def apply_format_policy(cached, policy):
+    """Video data of a cache entry (or fresh extraction), with formats re-selected from the raw info for a policy"""
+    video_data = cached['video_data']
+    if policy is None or policy.is_default():
+        return video_data
+    formats = process_formats_enhanced(cached['info'].get('formats') or [], policy)
+    if not formats:
+        raise HTTPException(status_code=400, detail='No formats match the requested quality, codec or size limits')
+    return {**video_data, 'formats': formats}
+
+def get_url_pattern(url):
+    """Classify a Facebook URL so strategy statistics can be kept per pattern"""
+    url_lower = url.lower()
+    if 'fb.watch' in url_lower:
+        return 'fb.watch'
+    for pattern in ('reel', 'watch', 'videos', 'posts'):
+        if f'/{pattern}' in url_lower:
+            return pattern
+    return 'other'
+
+async def run_extraction_strategies(url):
+    """Run extraction strategies hedged, best first, returning (extracted, last_error)
+
+    extracted is {'video_data', 'info'} like a video_info_cache entry, or None.
+
+    The most successful strategy for this URL pattern starts first; if it has
+    not finished after strategy_stats.hedge_delay() seconds (or it fails) the next one is
+    launched alongside it. The first success wins and the rest are cancelled.
+    """
+    pattern = get_url_pattern(url)
+    remaining = strategy_stats.order(pattern, EXTRACTION_STRATEGIES)
+    pending = {}
+    last_error = None
+    saturated = False
+    delay = strategy_stats.hedge_delay(pattern)
+
+    def launch_next():
+        name, strategy = remaining.pop(0)
+        task = asyncio.ensure_future(strategy(url))
+        pending[task] = (name, time.perf_counter())
+
+    launch_next()
+    try:
+        while pending:
+            hedge_delay = delay if remaining else None
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info("⏱️ Strategy still running after %.1fs, hedging with %s", delay, remaining[0][0])
+                launch_next()
+                continue
+
+            failed = False
+            for task in done:
+                name, started = pending.pop(task)
+                latency = time.perf_counter() - started
+                try:
+                    extracted = task.result()
+                except ExtractionPoolSaturated:
+                    saturated = True
+                    failed = True
+                    continue
+                except Exception as e:
+                    last_error = str(e)
+                    logger.warning("⚠️ Strategy %s failed: %s", name, e)
+                    strategy_stats.record(pattern, name, 'failure', latency)
+                    failed = True
+                    continue
+
+                if extracted:
+                    logger.info("✅ Strategy %s succeeded in %.2fs", name, latency)
+                    strategy_stats.record(pattern, name, 'win', latency)
+                    return extracted, None
+                strategy_stats.record(pattern, name, 'failure', latency)
+                failed = True
+
+            if remaining and (failed or not pending):
+                launch_next()
+    finally:
+        for task, (name, _) in pending.items():
+            task.cancel()
+            strategy_stats.record(pattern, name, 'cancelled')
+
+    if saturated and last_error is None:
+        raise ExtractionPoolSaturated()
+    return None, last_error
 
 def normalize_facebook_url(url):
     """FIXED: Normalize Facebook URLs to improve extraction success"""
@@ -359,14 +2828,51 @@ def normalize_facebook_url(url):
         
         return None
     except Exception as e:
-        print(f"⚠️ URL normalization error: {e}")
+        logger.warning("⚠️ URL normalization error: %s", e)
         return url if 'facebook.com' in url or 'fb.watch' in url else None
 
+FB_WATCH_ID_PATTERN = re.compile(r'fb\.watch/([\w\-]+)')
+VIDEO_ID_PATTERNS = [
+    re.compile(r'[?&](?:v|video_id)=(\d+)'),
+    re.compile(r'/(?:reel|reels|videos)/(?:[^/?#]+/)?(\d+)'),
+    re.compile(r'[?&]story_fbid=(\d+)'),
+    re.compile(r'(\d{15,})'),
+]
+
+# Share-link query params that do not change which video a URL points to
+FB_TRACKING_PARAMS = frozenset(('mibextid', 'rdid', 'share_url', 'sfnsn', 'fbclid', 'ref', 'refsrc', '_rdr', 'extid', 'paipv', 'eav'))
+FB_TRACKING_PARAM_PREFIXES = ('__cft__', '__tn__', 'utm_')
+
+def strip_tracking_params(url):
+    """URL without fragment, trailing slash and share-link tracking params"""
+    parsed = urlparse(url.split('#')[0])
+    query = [
+        (name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if name not in FB_TRACKING_PARAMS and not name.startswith(FB_TRACKING_PARAM_PREFIXES)
+    ]
+    stripped = parsed._replace(path=parsed.path.rstrip('/'), query=urlencode(query))
+    return stripped.geturl()
+
+def get_facebook_video_id(normalized_url):
+    """Derive a canonical cache key (video ID) from a normalized Facebook URL"""
+    if not normalized_url:
+        return None
+    match = FB_WATCH_ID_PATTERN.search(normalized_url)
+    if match:
+        return f"fbwatch:{match.group(1)}"
+    for pattern in VIDEO_ID_PATTERNS:
+        match = pattern.search(normalized_url)
+        if match:
+            return match.group(1)
+    # No numeric ID (e.g. pfbid post links) - fall back to the URL without tracking params
+    return 'url:' + strip_tracking_params(normalized_url)
+
 async def extract_with_strategy_1(url):
     """Standard extraction with updated yt-dlp options"""
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
+        'logger': ytdlp_logger,
         'extract_flat': False,
         'skip_download': True,
         'no_check_certificate': True,
@@ -384,17 +2890,14 @@ async def extract_with_strategy_1(url):
         }
     }
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        if info and info.get('formats'):
-            return process_video_info(info)
-    return None
+    return await extraction_pool.run(extract_blocking, ydl_opts, url)
 
 async def extract_with_strategy_2(url):
     """Alternative extraction with different options"""
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
+        'logger': ytdlp_logger,
         'extract_flat': False,
         'skip_download': True,
         'no_check_certificate': True,
@@ -409,17 +2912,14 @@ async def extract_with_strategy_2(url):
         'age_limit': None,
     }
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        if info and info.get('formats'):
-            return process_video_info(info)
-    return None
+    return await extraction_pool.run(extract_blocking, ydl_opts, url)
 
 async def extract_with_strategy_3(url):
     """Generic extractor fallback"""
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
+        'logger': ytdlp_logger,
         'extract_flat': False,
         'skip_download': True,
         'no_check_certificate': True,
@@ -432,10 +2932,25 @@ async def extract_with_strategy_3(url):
         }
     }
     
+    return await extraction_pool.run(extract_blocking, ydl_opts, url)
+
+EXTRACTION_STRATEGIES = [
+    ('Standard', extract_with_strategy_1),
+    ('Alternative', extract_with_strategy_2),
+    ('Generic', extract_with_strategy_3),
+]
+
+def extract_blocking(ydl_opts, url):
+    """Blocking yt-dlp extraction; runs inside the extraction pool"""
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         info = ydl.extract_info(url, download=False)
         if info and info.get('formats'):
-            return process_video_info(info)
+            video_data = process_video_info(info)
+            if video_data:
+                # Same shape as a cache entry, so callers never have to read it back
+                extracted = {'video_data': video_data, 'info': ydl.sanitize_info(info, remove_private_keys=True)}
+                video_info_cache.put(get_facebook_video_id(url), extracted['video_data'], extracted['info'])
+                return extracted
     return None
 
 def process_video_info(info):
@@ -459,177 +2974,226 @@ def process_video_info(info):
     if not formats:
         return None
         
-    print(f"📊 Found {len(formats)} total formats")
+    logger.debug("📊 Found %s total formats", len(formats))
     
     # Enhanced format processing
     processed_formats = process_formats_enhanced(formats)
     
     if not processed_formats:
         return None
+    logger.debug("📊 Selected %s formats", len(processed_formats))
         
     video_data['formats'] = processed_formats
-    print(f"✅ Successfully processed {len(video_data['formats'])} formats for: {video_data['title']}")
+    logger.info("✅ Successfully processed %s formats for: %s", len(video_data['formats']), video_data['title'])
     return video_data
 
-def process_formats_enhanced(formats):
-    """Enhanced format processing with better fallbacks"""
-    combined_formats = []
-    video_only_formats = []
-    audio_only_formats = []
-    
-    for fmt in formats:
+# Height hints in format_note when yt-dlp has no height ("720p", "HD 1080", ...)
+FORMAT_NOTE_HEIGHT_PATTERN = re.compile(r'1080|720|480|360|240')
+IMAGE_EXTENSIONS = frozenset(('jpg', 'png', 'gif', 'webp'))
+MISSING_CODECS = frozenset(('', 'none', 'null'))
+MAX_LISTED_FORMATS = 8
+
+# Codec names users pass mapped to the vcodec prefixes yt-dlp reports
+CODEC_ALIASES = {
+    'h264': ('avc1', 'h264'),
+    'avc1': ('avc1', 'h264'),
+    'h265': ('hvc1', 'hev1', 'hevc', 'h265'),
+    'hevc': ('hvc1', 'hev1', 'hevc', 'h265'),
+    'vp9': ('vp09', 'vp9'),
+    'av1': ('av01', 'av1'),
+}
+
+# Candidate kinds: (listing priority, position group in the legacy listing)
+FORMAT_KINDS = {
+    'combined': (1, 0),
+    'untyped': (2, 0),  # no codec info but has dimensions
+    'best_combined': (1, 0),
+    'video_only': (3, 1),
+    'audio_only': (2, 2),
+}
+
+class FormatPolicy:
+    """User preferences applied while selecting formats"""
+    __slots__ = ('max_height', 'preferred_codec', 'max_filesize', 'prefer_combined')
+
+    def __init__(self, max_height=None, preferred_codec=None, max_filesize=None, prefer_combined=True):
+        self.max_height = max_height
+        self.preferred_codec = CODEC_ALIASES.get((preferred_codec or '').lower(), (preferred_codec,) if preferred_codec else None)
+        self.max_filesize = max_filesize
+        self.prefer_combined = prefer_combined
+
+    def is_default(self):
+        return not (self.max_height or self.preferred_codec or self.max_filesize) and self.prefer_combined
+
+    def allows(self, height, filesize):
+        if self.max_height and height > self.max_height:
+            return False
+        return not (self.max_filesize and filesize > self.max_filesize)
+
+    def codec_rank(self, vcodec):
+        """0 for the preferred codec (or when there is no preference), 1 otherwise"""
+        if not self.preferred_codec:
+            return 0
+        return 0 if isinstance(vcodec, str) and vcodec.lower().startswith(self.preferred_codec) else 1
+
+DEFAULT_FORMAT_POLICY = FormatPolicy()
+
+def format_listing_entry(kind, fmt, height, abr):
+    """Response dict for one selected format (only built for the formats that are listed)"""
+    get = fmt.get
+    filesize = get('filesize') or get('filesize_approx') or 0
+    if kind == 'audio_only':
+        ext = get('ext', 'mp4')
+        return {
+            'format_id': get('format_id', 'unknown'),
+            'quality': 'Audio Only',
+            'ext': 'mp3' if ext in ['m4a', 'mp3'] else ext,
+            'filesize': filesize,
+            'type': 'audio_only',
+            'acodec': get('acodec', 'unknown'),
+            'abr': abr,
+            'priority': 2
+        }
+    untyped = kind == 'untyped'
+    if kind == 'combined':
+        quality = f"{height}p (Video + Audio)"
+    elif kind == 'video_only':
+        quality = f"{height}p (Video Only)"
+    else:
+        quality = f"{height}p" if height else 'Video'
+    entry = {
+        'format_id': get('format_id', 'unknown'),
+        'quality': quality,
+        'ext': get('ext', 'mp4'),
+        'filesize': filesize,
+        'type': 'video_only' if kind == 'video_only' else 'combined',
+        'height': height,
+        'width': get('width') or 0,
+        'fps': get('fps') or 0,
+        'vcodec': 'unknown' if untyped else get('vcodec', 'unknown'),
+    }
+    if kind == 'video_only':
+        entry['priority'] = 3
+        return entry
+    entry['acodec'] = 'unknown' if untyped else get('acodec', 'unknown')
+    entry['abr'] = abr
+    entry['priority'] = FORMAT_KINDS[kind][0]
+    return entry
+
+def best_combined_format(video, video_height, audio, audio_abr):
+    """Synthetic video+audio entry for sites that only serve DASH streams"""
+    video_size = video.get('filesize') or video.get('filesize_approx') or 0
+    audio_size = audio.get('filesize') or audio.get('filesize_approx') or 0
+    return {
+        'format_id': f"{video.get('format_id', 'unknown')}+{audio.get('format_id', 'unknown')}",
+        'quality': f"{video_height}p (Best Quality + Audio)" if video_height > 0 else "Best Quality + Audio",
+        'ext': 'mp4',
+        'filesize': video_size + audio_size if video_size > 0 and audio_size > 0 else 0,
+        'type': 'best_combined',
+        'height': video_height,
+        'width': video.get('width') or 0,
+        'fps': video.get('fps') or 0,
+        'vcodec': video.get('vcodec', 'unknown'),
+        'acodec': audio.get('acodec', 'unknown'),
+        'abr': audio_abr,
+        'priority': 1
+    }
+
+def format_sort_key(kind, height, abr, order, prefer_combined):
+    """Listing order: priority, then resolution and bitrate, then position in yt-dlp's list"""
+    priority, group = FORMAT_KINDS[kind]
+    key = (priority, -height, -abr, group, order)
+    if not prefer_combined:
+        # Rank every video format by resolution, audio after
+        return (kind == 'audio_only', -height) + key
+    return key
+
+def process_formats_enhanced(formats, policy=DEFAULT_FORMAT_POLICY):
+    """Pick the formats to offer: the best candidate per quality label, top MAX_LISTED_FORMATS overall
+
+    One pass over the yt-dlp formats keeps a compact (codec rank, abr, order,
+    format) tuple for the current best candidate of each quality label, plus the
+    best video-only/audio-only streams for the synthetic combined entry. Response
+    dicts are only built for the handful of formats that end up listed.
+    """
+    # (kind, height) quality label -> (codec rank, abr, order, fmt); audio is keyed by height 0
+    best = {}
+    has_combined = False
+    best_video = best_audio = None
+    best_video_height = best_audio_abr = -1
+    allows = policy.allows
+    codec_rank = policy.codec_rank
+
+    for order, fmt in enumerate(formats):
         try:
-            format_id = fmt.get('format_id', 'unknown')
-            ext = fmt.get('ext', 'mp4')
-            
-            # Skip formats that are clearly not video/audio
-            if ext in ['jpg', 'png', 'gif', 'webp']:
+            get = fmt.get
+            if get('ext', 'mp4') in IMAGE_EXTENSIONS:
                 continue
-                
-            has_video = fmt.get('vcodec') and fmt.get('vcodec') not in ['none', 'null']
-            has_audio = fmt.get('acodec') and fmt.get('acodec') not in ['none', 'null']
-            
-            # Get dimensions with fallbacks
-            height = fmt.get('height') or 0
-            width = fmt.get('width') or 0
-            
-            # If no height/width, try to infer from format_note or quality
+
+            vcodec = get('vcodec')
+            acodec = get('acodec')
+            has_video = vcodec is not None and vcodec not in MISSING_CODECS
+            has_audio = acodec is not None and acodec not in MISSING_CODECS
+            height = get('height') or 0
             if height == 0:
-                format_note = fmt.get('format_note', '').lower()
-                if '1080' in format_note:
-                    height = 1080
-                elif '720' in format_note:
-                    height = 720
-                elif '480' in format_note:
-                    height = 480
-                elif '360' in format_note:
-                    height = 360
-                elif '240' in format_note:
-                    height = 240
-            
-            filesize = fmt.get('filesize') or fmt.get('filesize_approx') or 0
-            
-            if has_video and has_audio and height >= 144:
-                # Combined format (video + audio) - PREFERRED
-                combined_formats.append({
-                    'format_id': format_id,
-                    'quality': f"{height}p (Video + Audio)" if height > 0 else "Video + Audio",
-                    'ext': ext,
-                    'filesize': filesize,
-                    'type': 'combined',
-                    'height': height,
-                    'width': width,
-                    'fps': fmt.get('fps') or 0,
-                    'vcodec': fmt.get('vcodec', 'unknown'),
-                    'acodec': fmt.get('acodec', 'unknown'),
-                    'abr': fmt.get('abr') or 0,
-                    'priority': 1
-                })
-            elif has_video and not has_audio and height >= 144:
-                # Video only format
-                video_only_formats.append({
-                    'format_id': format_id,
-                    'quality': f"{height}p (Video Only)" if height > 0 else "Video Only",
-                    'ext': ext,
-                    'filesize': filesize,
-                    'type': 'video_only',
-                    'height': height,
-                    'width': width,
-                    'fps': fmt.get('fps') or 0,
-                    'vcodec': fmt.get('vcodec', 'unknown'),
-                    'priority': 3
-                })
+                heights = FORMAT_NOTE_HEIGHT_PATTERN.findall(get('format_note') or '')
+                if heights:
+                    height = max(map(int, heights))
+
+            if has_video and height >= 144:
+                kind = 'combined' if has_audio else 'video_only'
             elif has_audio and not has_video:
-                # Audio only format
-                audio_only_formats.append({
-                    'format_id': format_id,
-                    'quality': 'Audio Only',
-                    'ext': 'mp3' if ext in ['m4a', 'mp3'] else ext,
-                    'filesize': filesize,
-                    'type': 'audio_only',
-                    'acodec': fmt.get('acodec', 'unknown'),
-                    'abr': fmt.get('abr') or 0,
-                    'priority': 2
-                })
-            elif not has_video and not has_audio:
-                # Sometimes formats don't have codec info but are still valid
-                # Try to determine based on other properties
-                if height > 0 or width > 0:
-                    # Likely video
-                    combined_formats.append({
-                        'format_id': format_id,
-                        'quality': f"{height}p" if height > 0 else "Video",
-                        'ext': ext,
-                        'filesize': filesize,
-                        'type': 'combined',
-                        'height': height,
-                        'width': width,
-                        'fps': fmt.get('fps') or 0,
-                        'vcodec': 'unknown',
-                        'acodec': 'unknown',
-                        'abr': fmt.get('abr') or 0,
-                        'priority': 2
-                    })
+                kind = 'audio_only'
+                height = 0  # listed and ranked without a resolution
+            elif not has_video and not has_audio and (height > 0 or get('width')):
+                kind = 'untyped'
+            else:
+                continue
+
+            if not allows(height, get('filesize') or get('filesize_approx') or 0):
+                continue
+
+            abr = (get('abr') or 0) if kind != 'video_only' else 0
+            rank = codec_rank(vcodec) if kind != 'audio_only' else 0
+
+            if kind == 'video_only':
+                if height > best_video_height:
+                    best_video, best_video_height = fmt, height
+            elif kind == 'audio_only':
+                if abr > best_audio_abr:
+                    best_audio, best_audio_abr = fmt, abr
+            else:
+                has_combined = True
+
+            # Keep the first of the best candidates per quality label
+            label = (kind, height)
+            current = best.get(label)
+            if current is None or rank < current[0] or (rank == current[0] and abr > current[1]):
+                best[label] = (rank, abr, order, fmt)
         except Exception as fmt_error:
-            print(f"⚠️ Error processing format {fmt.get('format_id', 'unknown')}: {fmt_error}")
+            logger.warning("⚠️ Error processing format %s: %s", fmt.get('format_id', 'unknown'), fmt_error)
             continue
-    
-    print(f"📊 Processed formats - Combined: {len(combined_formats)}, Video-only: {len(video_only_formats)}, Audio-only: {len(audio_only_formats)}")
-    
+
+    prefer_combined = policy.prefer_combined
+    ranked = []
+    for (kind, height), (_, abr, order, fmt) in best.items():
+        key = format_sort_key(kind, height, abr, order, prefer_combined)
+        ranked.append((key, kind, fmt, height, abr))
+
     # Create best combination if no combined formats exist
-    if not combined_formats and video_only_formats and audio_only_formats:
-        try:
-            best_video = max(video_only_formats, key=lambda x: x.get('height', 0))
-            best_audio = max(audio_only_formats, key=lambda x: x.get('abr', 0))
-            
-            video_size = best_video.get('filesize') or 0
-            audio_size = best_audio.get('filesize') or 0
-            combined_size = video_size + audio_size if video_size > 0 and audio_size > 0 else 0
-            
-            combined_formats.append({
-                'format_id': f"{best_video['format_id']}+{best_audio['format_id']}",
-                'quality': f"{best_video['height']}p (Best Quality + Audio)" if best_video['height'] > 0 else "Best Quality + Audio",
-                'ext': 'mp4',
-                'filesize': combined_size,
-                'type': 'best_combined',
-                'height': best_video.get('height', 0),
-                'width': best_video.get('width', 0),
-                'fps': best_video.get('fps', 0),
-                'vcodec': best_video.get('vcodec', 'unknown'),
-                'acodec': best_audio.get('acodec', 'unknown'),
-                'abr': best_audio.get('abr', 0),
-                'priority': 1
-            })
-            print("✅ Created best combined format")
-        except Exception as combine_error:
-            print(f"⚠️ Error creating combined format: {combine_error}")
-    
-    # Combine all formats and sort
-    all_formats = combined_formats + video_only_formats + audio_only_formats
-    
-    if not all_formats:
-        return None
-    
-    # Remove duplicates and sort
-    seen_qualities = set()
-    unique_formats = []
-    
-    # Sort by priority first, then by height/quality
-    all_formats.sort(key=lambda x: (
-        x.get('priority', 999), 
-        -x.get('height', 0), 
-        -x.get('abr', 0)
-    ))
-    
-    for fmt in all_formats:
-        quality_key = fmt['quality']
-        if quality_key not in seen_qualities:
-            unique_formats.append(fmt)
-            seen_qualities.add(quality_key)
-            if len(unique_formats) >= 8:  # Increased limit
-                break
-    
-    return unique_formats
+    if not has_combined and best_video and best_audio:
+        combined = best_combined_format(best_video, best_video_height, best_audio, best_audio_abr)
+        if policy.allows(0, combined['filesize']):
+            key = format_sort_key('best_combined', best_video_height, best_audio_abr, len(formats), prefer_combined)
+            ranked.append((key, 'best_combined', combined, best_video_height, best_audio_abr))
+
+    # Sort keys end with the unique list position, so tuples never compare past them
+    ranked.sort()
+    results = [
+        fmt if kind == 'best_combined' else format_listing_entry(kind, fmt, height, abr)
+        for _, kind, fmt, height, abr in ranked[:MAX_LISTED_FORMATS]
+    ]
+    return results or None
 
 def get_helpful_error_message(error_msg, url):
     """Generate helpful error messages based on the error type"""
@@ -673,62 +3237,140 @@ Please try:
 3. Refreshing the page and trying again"""
 
 @app.post("/download")
-async def download_video(request_data: DownloadRequest, background_tasks: BackgroundTasks):
+async def download_video(request_data: DownloadRequest, x_profile: Optional[str] = Header(None)):
     try:
-        url = request_data.url.strip()
-        format_id = request_data.format_id
-                
-        if not url or not format_id:
-            raise HTTPException(status_code=400, detail='URL and format are required')
-                
-        # Generate unique download ID
-        download_id = str(uuid.uuid4())
-                
-        # Initialize progress
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'starting',
-                'percent': 0,
-                'message': 'Initializing...'
-            }
-                
-        print(f"🚀 Starting download with ID: {download_id}")
-                
-        # Start download in background
-        background_tasks.add_task(download_video_background, url, format_id, download_id)
-                
-        return {'download_id': download_id}
-                
+        return await start_download(request_data, profile=profile_requested(x_profile))
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Error in download_video: {e}")
+        logger.error("❌ Error in download_video: %s", e)
         raise HTTPException(status_code=500, detail=f'Download failed: {str(e)}')
 
-def download_video_background(url, format_id, download_id):
+async def start_download(request_data, profile=False):
+    """Start (or join) the download described by a DownloadRequest; raises HTTPException on failure
+
+    With profile, a newly started job is sampled by a SamplingProfiler and the
+    response names its profile; joined and already finished downloads are not.
+    """
+    url = request_data.url.strip()
+    format_id = request_data.format_id
+            
+    if not url or not format_id:
+        raise HTTPException(status_code=400, detail='URL and format are required')
+            
+    # Generate unique download ID
+    download_id = str(uuid.uuid4())
+
+    # Identical video + format requests share one job and one output file
+    video_id = video_info_cache.resolve_token(request_data.info_token) or get_facebook_video_id(normalize_facebook_url(url))
+    download_key = get_download_key(video_id, format_id)
+
+    if download_queue is not None:
+        await ensure_disk_space()
+        return enqueue_download(request_data, url, format_id, download_id, download_key, profile)
+
+    completed_filename = download_registry.lookup_completed(download_key)
+    if completed_filename:
+        mark_download_finished(download_id, completed_filename, os.path.join(OUTPUTS_DIR, completed_filename))
+        logger.info("⚡ Serving already downloaded file: %s", completed_filename)
+        return {'download_id': download_id}
+
+    await ensure_disk_space()
+    existing_id = download_registry.attach(download_key, download_id)
+    if existing_id:
+        logger.info("🔗 Joining in-flight download: %s", existing_id)
+        return {'download_id': existing_id}
+            
+    # Initialize progress
+    set_progress(download_id, {
+        'status': 'queued',
+        'percent': 0,
+        'message': 'Waiting for a free download slot...',
+        'last_update': time.time()
+    })
+            
+    logger.info("🚀 Queueing download with ID: %s", download_id)
+            
+    # Hand the job to the bounded download worker pool, journaling it first so a restart can resume it
+    job = DownloadJob(download_id, url, format_id, request_data.info_token, request_data.priority, profile=profile)
+    if download_journal is not None:
+        download_journal.record(job, download_key)
+    download_scheduler.submit(job)
+            
+    return download_response(job)
+
+def download_response(job):
+    """/download response for a job that was just queued"""
+    if job.profile:
+        return {'download_id': job.download_id, 'profile_id': f'download-{job.download_id}'}
+    return {'download_id': job.download_id}
+
+def enqueue_download(request_data, url, format_id, download_id, download_key, profile=False):
+    """Queue-mode /download: hand the job to the worker tier through the shared queue"""
+    # Written before the submit: a worker may claim the job and report progress right away
+    set_progress(download_id, {
+        'status': 'queued',
+        'percent': 0,
+        'message': 'Waiting for a free download slot...',
+        'last_update': time.time()
+    })
+
+    job = DownloadJob(download_id, url, format_id, request_data.info_token, request_data.priority, profile=profile)
+    existing_id = download_queue.submit(job, download_key)
+    if existing_id:
+        # The client follows the existing job; nothing will ever update this id
+        job_store.delete(download_id)
+        logger.info("🔗 Joining queued download: %s", existing_id)
+        return {'download_id': existing_id}
+
+    logger.info("🚀 Queued download for the worker tier with ID: %s", download_id)
+    return download_response(job)
+
+def download_video_background(url, format_id, download_id, info_token=None, cancel_event=None, attempt=0):
+    """Run one download attempt; returns True if it failed transiently and should be retried"""
+    merge_gate = None
+    safe_filename = None
     try:
-        print(f"📥 Background download started for ID: {download_id}")
-        print(f"🔗 URL: {url}")
-        print(f"🎬 Format ID: {format_id}")
+        logger.info("📥 Background download started for ID: %s", download_id)
+        logger.debug("🔗 URL: %s", url)
+        logger.debug("🎬 Format ID: %s", format_id)
                 
         # Set initial status
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'starting',
-                'percent': 0,
-                'message': 'Getting video information...',
-                'last_update': time.time()
-            }
+        set_progress(download_id, {
+            'status': 'starting',
+            'percent': 0,
+            'message': 'Getting video information...',
+            'last_update': time.time()
+        })
                 
-        # Get video info for filename
+        # Get video info for filename - reuse the /extract_info result when cached
+        video_id = video_info_cache.resolve_token(info_token) or get_facebook_video_id(normalize_facebook_url(url))
+        download_key = get_download_key(video_id, format_id)
+        cached = video_info_cache.get(video_id)
+        # Sanitized info handed to process_ie_result, so the page is only fetched once
+        reuse_info = None
         try:
-            with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'socket_timeout': 10}) as ydl_info:
-                info = ydl_info.extract_info(url, download=False)
-                original_title = info.get('title', 'facebook_video')
-                safe_filename = generate_safe_filename(original_title)
+            if cached:
+                reuse_info = copy.deepcopy(cached['info'])
+                original_title = reuse_info.get('title', 'facebook_video')
+                logger.info("⚡ Reusing extracted info for: %s", original_title)
+            else:
+                with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'socket_timeout': 10}) as ydl_info:
+                    info = ydl_info.extract_info(url, download=False)
+                    original_title = info.get('title', 'facebook_video')
+                    if info.get('formats'):
+                        video_data = process_video_info(info)
+                        reuse_info = ydl_info.sanitize_info(info, remove_private_keys=True)
+                        video_info_cache.put(video_id, video_data, copy.deepcopy(reuse_info))
+            safe_filename = generate_safe_filename(original_title)
         except Exception as info_error:
-            print(f"⚠️ Error getting video info for filename: {info_error}")
-            safe_filename = f"facebook_video_{int(time.time())}"
+            logger.warning("⚠️ Error getting video info for filename: %s", info_error)
+            safe_filename = "facebook_video"
+
+        # Suffix with the download key so different videos/formats never share a path
+        safe_filename = f"{safe_filename}_{download_key}"
                 
-        print(f"📁 Generated safe filename: {safe_filename}")
+        logger.debug("📁 Generated safe filename: %s", safe_filename)
                 
         # Expected final filename
         expected_final_filename = f"{safe_filename}.mp4"
@@ -741,35 +3383,42 @@ def download_video_background(url, format_id, download_id):
             # This is our custom best_combined format
             video_format, audio_format = format_id.split('+')
             final_format = f"{video_format}+{audio_format}"
-            print(f"🎬 Using combined format: {final_format}")
+            logger.debug("🎬 Using combined format: %s", final_format)
         elif 'Video Only' in format_id or 'video_only' in str(format_id):
             # For video-only formats, merge with best audio
             actual_format_id = format_id.split()[0] if ' ' in format_id else format_id
             final_format = f"{actual_format_id}+bestaudio"
-            print(f"🎬 Merging video with audio: {final_format}")
+            logger.debug("🎬 Merging video with audio: %s", final_format)
         else:
             # Use the format as-is
-            print(f"🎬 Using direct format: {final_format}")
+            logger.debug("🎬 Using direct format: %s", final_format)
                 
         # Update progress
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'preparing',
-                'percent': 5,
-                'message': 'Preparing download...',
-                'last_update': time.time()
-            }
+        set_progress(download_id, {
+            'status': 'preparing',
+            'percent': 5,
+            'message': 'Preparing download...',
+            'last_update': time.time()
+        })
                 
         # Create progress hook
-        progress_hook = OptimizedProgressHook(download_id, expected_final_filename, safe_filename)
+        progress_hook = OptimizedProgressHook(download_id, expected_final_filename, safe_filename, cancel_event)
+        merge_gate = MergeGate(download_scheduler.merge_semaphore, download_id)
+        postprocess_timer = PostprocessTimer()
                 
         # Configure yt-dlp options for download with MAXIMUM OPTIMIZATIONS
         ydl_opts = {
             'format': final_format,
             'outtmpl': os.path.join(OUTPUTS_DIR, f'{safe_filename}.%(ext)s'),
             'progress_hooks': [progress_hook],
+            # Called with the final path after all postprocessors (merge/remux) ran;
+            # the remux may have renamed the file the progress hook reported
+            'post_hooks': [lambda filepath: mark_download_finished(download_id, os.path.basename(filepath), filepath)],
+            'postprocessor_hooks': [merge_gate, postprocess_timer],
             'quiet': False,
             'no_warnings': False,
+            'logger': ytdlp_logger,  # yt-dlp's screen output goes through the log queue
+            'noprogress': True,  # OptimizedProgressHook reports progress
             'no_check_certificate': True,
             'writeinfojson': False,
             'writesubtitles': False,
@@ -778,27 +3427,23 @@ def download_video_background(url, format_id, download_id):
             'windowsfilenames': True,
                         
             # MAXIMUM SPEED OPTIMIZATIONS
-            'concurrent_fragment_downloads': 8,  # Increased for maximum speed
+            # Fragment concurrency, buffer size and rate limit come from transfer_budget
             'fragment_retries': 2,  # Reduced retries for speed
             'retries': 3,  # Reduced retries
+            # Fail the attempt instead of stitching a file with holes; the retry resumes it
+            'skip_unavailable_fragments': False,
+            'continuedl': True,
             'file_access_retries': 2,
-            'http_chunk_size': 4194304,  # 4MB chunks for maximum speed
+            'http_chunk_size': 4194304,  # 4MB range requests (not held in memory)
             'socket_timeout': 20,  # Reduced timeout
-            'buffersize': 4194304,  # 4MB buffer
                         
             # FASTEST MERGE OPTIONS - NO RE-ENCODING
+            # The merge stream-copies into mp4 and applies faststart in the same pass;
+            # MediaFinalizerPP below only rewrites files that still need it
             'merge_output_format': 'mp4',
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }],
             'postprocessor_args': {
-                'ffmpeg': [
-                    '-c:v', 'copy',  # COPY VIDEO - NO RE-ENCODING (FASTEST)
-                    '-c:a', 'copy',  # COPY AUDIO - NO RE-ENCODING (FASTEST)
+                'merger+ffmpeg_o': [
                     '-movflags', '+faststart',  # Optimize for streaming
-                    '-threads', str(min(os.cpu_count() or 4, 8)),  # Use optimal CPU cores
-                    '-preset', 'ultrafast',  # Fastest preset
                     '-avoid_negative_ts', 'make_zero'  # Fix timestamp issues
                 ]
             },
@@ -806,109 +3451,145 @@ def download_video_background(url, format_id, download_id):
             'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
                 
-        print(f"📁 Downloading: {safe_filename}")
-        print(f"🎵 Format: {final_format}")
-        print(f"📂 Output directory: {OUTPUTS_DIR}")
-        print(f"🎯 Expected final file: {expected_final_filename}")
+        logger.debug("📁 Downloading: %s", safe_filename)
+        logger.debug("🎵 Format: %s", final_format)
+        logger.debug("📂 Output directory: %s", OUTPUTS_DIR)
+        logger.debug("🎯 Expected final file: %s", expected_final_filename)
                 
         # Update progress to downloading
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'downloading',
-                'percent': 10,
-                'message': 'Starting download...',
-                'last_update': time.time()
-            }
+        set_progress(download_id, {
+            'status': 'downloading',
+            'percent': 10,
+            'message': 'Starting download...',
+            'last_update': time.time()
+        })
+        profiler = active_profile.get()
+        if profiler is not None:
+            ydl_opts['progress_hooks'].append(profiler.progress_hook)
                 
+        # YoutubeDL keeps this dict as its live params, so rebalancing reaches running jobs
+        transfer_budget.acquire(download_id, ydl_opts)
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            print(f"🚀 Starting yt-dlp download...")
-            ydl.download([url])
-            print(f"✅ yt-dlp download completed")
+            finalizer = MediaFinalizerPP(ydl, download_scheduler.merge_semaphore)
+            finalizer.add_progress_hook(postprocess_timer)
+            ydl.add_post_processor(finalizer, when='post_process')
+            logger.debug("🚀 Starting yt-dlp download...")
+            download_started = time.time()
+            if reuse_info is not None:
+                # Same path as --load-info-json: no page fetch, straight to format selection
+                try:
+                    ydl.process_ie_result(reuse_info, download=True)
+                except yt_dlp.DownloadError as reuse_error:
+                    # Only expired format URLs warrant a fresh extraction; anything else
+                    # goes to the retry path like an uncached download would
+                    if not is_expired_url_error(reuse_error):
+                        raise
+                    logger.warning("⚠️ Download from extracted info failed, re-extracting: %s", reuse_error)
+                    ydl.download([url])
+            else:
+                ydl.download([url])
+            # Everything that was not a postprocessor counts as download time
+            download_time = time.time() - download_started - sum(postprocess_timer.durations.values())
+            stage_timings.record('download', download_time)
+            completed = job_store.get_completed(download_id)
+            if completed and os.path.isfile(completed['filepath']):
+                size = os.path.getsize(completed['filepath'])
+                DOWNLOAD_BYTES.inc(size)
+                if download_time > 0:
+                    DOWNLOAD_THROUGHPUT.observe(size / download_time)
+            logger.debug("✅ yt-dlp download completed")
+            logger.info("⏱️ Stage timings: download=%.2fs %s", download_time, ' '.join(
+                f"{stage}={seconds:.2f}s" for stage, seconds in postprocess_timer.durations.items()))
                 
         # Final verification if hooks didn't catch completion
-        if download_id not in completed_downloads:
-            print(f"🔍 Verifying completion for: {expected_final_filename}")
+        if job_store.get_completed(download_id) is None:
+            logger.debug("🔍 Verifying completion for: %s", expected_final_filename)
                         
             # Look for the completed file
             final_filename = find_completed_file(expected_final_filename, safe_filename)
                         
             if final_filename:
-                final_path = os.path.join(OUTPUTS_DIR, final_filename)
-                with progress_lock:
-                    completed_downloads[download_id] = {
-                        'filename': final_filename,
-                        'filepath': final_path,
-                        'completed_at': time.time()
-                    }
-                    download_progress[download_id] = {
-                        'status': 'finished',
-                        'percent': 100,
-                        'filename': final_filename,
-                        'filepath': final_path,
-                        'last_update': time.time(),
-                        'message': 'Download completed!'
-                    }
-                print(f"✅ Verification found completed file: {final_filename}")
+                mark_download_finished(download_id, final_filename, os.path.join(OUTPUTS_DIR, final_filename))
+                logger.info("✅ Verification found completed file: %s", final_filename)
                                 
                 # Clean up intermediate files
                 cleanup_intermediate_files(safe_filename)
             else:
-                print(f"⚠️ Could not find completed file")
-                # List available files for debugging
-                try:
-                    available_files = [f for f in os.listdir(OUTPUTS_DIR) if f.endswith('.mp4')]
-                    print(f"📂 Available MP4 files: {available_files}")
-                except Exception as list_error:
-                    print(f"⚠️ Error listing files: {list_error}")
+                logger.warning("⚠️ Could not find completed file")
+                # List this download's files for debugging
+                logger.debug("📂 Known files for %s: %s", safe_filename, sorted(output_index.files_for_base(safe_filename)))
                 
-        print(f"✅ Download process completed for ID: {download_id}")
+        logger.info("✅ Download process completed for ID: %s", download_id)
                 
         # Final status check
-        with progress_lock:
-            final_status = download_progress.get(download_id, {})
+        final_status = job_store.get(download_id) or {}
         if final_status.get('status') == 'finished':
-            print(f"🎉 DOWNLOAD SUCCESS: {final_status.get('filename')}")
+            logger.info("🎉 DOWNLOAD SUCCESS: %s", final_status.get('filename'))
         else:
-            print(f"⚠️ Download status: {final_status.get('status')} - {final_status.get('message', 'Unknown')}")
+            logger.warning("⚠️ Download status: %s - %s", final_status.get('status'), final_status.get('message', 'Unknown'))
             
+    except yt_dlp.utils.DownloadCancelled:
+        logger.info("🛑 Download cancelled for ID: %s", download_id)
+        set_progress(download_id, {
+            'status': 'cancelled',
+            'percent': 0,
+            'last_update': time.time(),
+            'message': 'Download cancelled'
+        })
+        if safe_filename:
+            cleanup_intermediate_files(safe_filename)
     except yt_dlp.DownloadError as e:
         error_msg = str(e)
-        print(f"❌ yt-dlp error for ID {download_id}: {error_msg}")
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'error',
-                'error': f'Download failed: {error_msg}',
-                'percent': 0,
-                'last_update': time.time(),
-                'message': 'Download failed'
-            }
+        if attempt < DOWNLOAD_MAX_RETRIES and is_transient_download_error(e):
+            # Partial files stay in place so the next attempt picks up where this one stopped
+            logger.info("🔁 Transient error for ID %s (attempt %s of %s): %s", download_id, attempt + 1, DOWNLOAD_MAX_RETRIES + 1, error_msg)
+            set_progress(download_id, {
+                'status': 'retrying',
+                'percent': (job_store.get(download_id) or {}).get('percent') or 0,
+                'message': f'Connection problem - retrying (attempt {attempt + 2} of {DOWNLOAD_MAX_RETRIES + 1})...',
+                'last_update': time.time()
+            })
+            return True
+        logger.error("❌ yt-dlp error for ID %s: %s", download_id, error_msg)
+        set_progress(download_id, {
+            'status': 'error',
+            'error': f'Download failed: {error_msg}',
+            'percent': 0,
+            'last_update': time.time(),
+            'message': 'Download failed'
+        })
     except Exception as e:
-        print(f"❌ Unexpected error for ID {download_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        with progress_lock:
-            download_progress[download_id] = {
-                'status': 'error',
-                'error': f'Unexpected error: {str(e)}',
-                'percent': 0,
-                'last_update': time.time(),
-                'message': 'Download failed'
-            }
+        logger.exception("❌ Unexpected error for ID %s: %s", download_id, e)
+        set_progress(download_id, {
+            'status': 'error',
+            'error': f'Unexpected error: {str(e)}',
+            'percent': 0,
+            'last_update': time.time(),
+            'message': 'Download failed'
+        })
+    finally:
+        transfer_budget.release(download_id)
+        if merge_gate is not None:
+            merge_gate.release_all()
 
 @app.get("/progress/{download_id}")
 async def get_progress(download_id: str):
-    with progress_lock:
-        progress = download_progress.get(download_id, {'status': 'not_found'}).copy()
+    progress = job_store.get(download_id) or {'status': 'not_found'}
+
+    if progress.get('status') == 'queued':
+        position = (download_queue or download_scheduler).queue_position(download_id)
+        if position is not None:
+            progress['queue_position'] = position
         
     # Check if download is stale (no updates for 2 minutes while downloading) - REDUCED TIMEOUT
     if progress.get('status') in ['downloading', 'merging', 'processing']:
         last_update = progress.get('last_update', 0)
         if time.time() - last_update > 120:  # 2 minutes timeout (reduced from 3)
-            print(f"⚠️ Download {download_id} appears stale, checking for completed files...")
+            logger.warning("⚠️ Download %s appears stale, checking for completed files...", download_id)
                         
             # Check if download actually completed
-            if download_id in completed_downloads:
-                completed = completed_downloads[download_id]
+            completed = job_store.get_completed(download_id)
+            if completed:
                 progress = {
                     'status': 'finished',
                     'percent': 100,
@@ -917,36 +3598,24 @@ async def get_progress(download_id: str):
                     'last_update': time.time(),
                     'message': 'Download completed!'
                 }
-                with progress_lock:
-                    download_progress[download_id] = progress
-                print(f"✅ Found completed download after stale detection")
+                set_progress(download_id, progress)
+                logger.info("✅ Found completed download after stale detection")
             else:
-                # Look for recent MP4 files
+                # Look for this download's final file, then recent MP4 files
                 try:
-                    files = [f for f in os.listdir(OUTPUTS_DIR) if f.endswith('.mp4')]
+                    output_index.ensure_fresh()
+                    final_file = output_index.final_file(download_id)
+                    files = [(final_file, output_index.get(final_file))] if final_file else output_index.recent_media(1)
+                    files = [(name, entry) for name, entry in files if entry and name.endswith('.mp4')]
                     if files:
                         # Get the most recent file
-                        latest_file = max(files, key=lambda f: os.path.getmtime(os.path.join(OUTPUTS_DIR, f)))
-                        file_time = os.path.getmtime(os.path.join(OUTPUTS_DIR, latest_file))
+                        latest_file, latest_entry = files[0]
+                        file_time = latest_entry['mtime']
                                                 
                         # If the file was created recently, assume it's our download
                         if time.time() - file_time < 180:  # Within last 3 minutes
-                            progress = {
-                                'status': 'finished',
-                                'percent': 100,
-                                'filename': latest_file,
-                                'filepath': os.path.join(OUTPUTS_DIR, latest_file),
-                                'last_update': time.time(),
-                                'message': 'Download completed!'
-                            }
-                            with progress_lock:
-                                download_progress[download_id] = progress
-                                completed_downloads[download_id] = {
-                                    'filename': latest_file,
-                                    'filepath': os.path.join(OUTPUTS_DIR, latest_file),
-                                    'completed_at': time.time()
-                                }
-                            print(f"✅ Found recent file after stale detection: {latest_file}")
+                            progress = mark_download_finished(download_id, latest_file, os.path.join(OUTPUTS_DIR, latest_file))
+                            logger.info("✅ Found recent file after stale detection: %s", latest_file)
                         else:
                             # Mark as error if no recent files
                             progress = {
@@ -956,10 +3625,9 @@ async def get_progress(download_id: str):
                                 'last_update': time.time(),
                                 'message': 'Download timed out'
                             }
-                            with progress_lock:
-                                download_progress[download_id] = progress
+                            set_progress(download_id, progress)
                 except Exception as check_error:
-                    print(f"⚠️ Error checking for completed files: {check_error}")
+                    logger.warning("⚠️ Error checking for completed files: %s", check_error)
                     progress = {
                         'status': 'error',
                         'error': 'Download timeout - please try again',
@@ -967,91 +3635,989 @@ async def get_progress(download_id: str):
                         'last_update': time.time(),
                         'message': 'Download timed out'
                     }
-                    with progress_lock:
-                        download_progress[download_id] = progress
+                    set_progress(download_id, progress)
         
     return progress
 
 
-# check this 
+# Seconds between SSE snapshots when no update arrives (also re-runs stale detection)
+PROGRESS_STREAM_KEEPALIVE = float(os.environ.get("PROGRESS_STREAM_KEEPALIVE", 15))
+
+def format_sse(progress):
+    return f"data: {json.dumps(progress)}\n\n"
+
+@app.get("/progress/{download_id}/stream")
+async def stream_progress(download_id: str, request: Request):
+    """Server-Sent Events stream of progress updates, pushed by the download hooks"""
+    async def event_stream():
+        # Subscribe before the first snapshot so no update can slip in between
+        subscriber = progress_channel.subscribe(download_id)
+        try:
+            progress = await get_progress(download_id)
+            yield format_sse(progress)
+            # In shared-state mode the download may run in another worker, so local
+            # pushes never arrive - poll the shared store and send only changes
+            timeout = SHARED_STATE_POLL_INTERVAL if SHARED_STATE else PROGRESS_STREAM_KEEPALIVE
+            last_sent = time.time()
+            while progress.get('status') not in TERMINAL_PROGRESS_STATES:
+                try:
+                    update = await asyncio.wait_for(subscriber[1].get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    update = await get_progress(download_id)
+                    if update == progress and time.time() - last_sent < PROGRESS_STREAM_KEEPALIVE:
+                        continue
+                if await request.is_disconnected():
+                    break
+                progress = update
+                last_sent = time.time()
+                yield format_sse(progress)
+        finally:
+            progress_channel.unsubscribe(download_id, subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Served files stay available this long after their last transfer ends (resumes, parallel ranges)
+DOWNLOAD_RETENTION = float(os.environ.get("DOWNLOAD_RETENTION", 600))
+DOWNLOAD_REAPER_INTERVAL = float(os.environ.get("DOWNLOAD_REAPER_INTERVAL", 60))
+
+DOWNLOAD_MEDIA_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m4a': 'audio/mp4',
+    '.webm': 'video/webm',
+    '.mkv': 'video/x-matroska',
+    '.mp3': 'audio/mpeg',
+}
+
+class FileLeases:
+    """Reference counts for files being served; a file is deleted only once it is
+    idle for the retention window, instead of right after the first response"""
+    def __init__(self, retention):
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.refs = {}  # filename -> open responses
+        self.last_served = {}  # filename -> time the last response started or ended
+        self.reaper = None
+        self.stats = {'served': 0, 'deleted': 0, 'bytes_deleted': 0}
+
+    def acquire(self, filename):
+        with self.lock:
+            self.refs[filename] = self.refs.get(filename, 0) + 1
+            self.last_served[filename] = time.time()
+            self.stats['served'] += 1
+
+    def release(self, filename):
+        with self.lock:
+            self.refs[filename] -= 1
+            if self.refs[filename] <= 0:
+                del self.refs[filename]
+            self.last_served[filename] = time.time()
+
+    def reap(self):
+        """Delete served files that nobody is downloading and that outlived the retention window"""
+        cutoff = time.time() - self.retention
+        with self.lock:
+            expired = [name for name, served in self.last_served.items() if served < cutoff and name not in self.refs]
+            for name in expired:
+                del self.last_served[name]
+        for name in expired:
+            file_path = os.path.join(OUTPUTS_DIR, name)
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                self.stats['deleted'] += 1
+                self.stats['bytes_deleted'] += size
+                logger.info("🗑️ Deleted file: %s", file_path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning("⚠️ Failed to delete %s: %s", file_path, e)
+            output_index.remove(name)
+
+    def last_used(self, filename):
+        """When the file was last served, or None if it never was"""
+        with self.lock:
+            return self.last_served.get(filename)
+
+    def is_leased(self, filename):
+        with self.lock:
+            return filename in self.refs
+
+    def start_reaper(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reap()
+        self.reaper = threading.Thread(target=loop, name='download-reaper', daemon=True)
+        self.reaper.start()
+
+    def snapshot(self):
+        """Return retention metrics for the /stats endpoint"""
+        with self.lock:
+            return {
+                **self.stats,
+                'retention': self.retention,
+                'active_transfers': sum(self.refs.values()),
+                'pending_deletion': len(self.last_served),
+            }
+
+file_leases = FileLeases(DOWNLOAD_RETENTION)
+file_leases.start_reaper(DOWNLOAD_REAPER_INTERVAL)
+
+# Janitor limits for outputs/ (0 disables the quota / age limit)
+OUTPUTS_QUOTA_BYTES = int(os.environ.get("OUTPUTS_QUOTA_BYTES", 10 * 1024 ** 3))
+OUTPUTS_MAX_AGE = float(os.environ.get("OUTPUTS_MAX_AGE", 24 * 3600))
+OUTPUTS_MIN_FREE_BYTES = int(os.environ.get("OUTPUTS_MIN_FREE_BYTES", 1024 ** 3))
+OUTPUTS_JANITOR_INTERVAL = float(os.environ.get("OUTPUTS_JANITOR_INTERVAL", 300))
+# Intermediate files untouched this long belong to a dead download
+ORPHAN_FRAGMENT_AGE = float(os.environ.get("ORPHAN_FRAGMENT_AGE", 3600))
+# Freshly finished files are never evicted, so the requester gets a chance to fetch them
+OUTPUTS_EVICT_GRACE = 300
+
+# yt-dlp intermediates: .part/.ytdl/.temp files, .f123 format streams and fragment files
+FRAGMENT_PATTERN = re.compile(r'\.(part|ytdl|temp)(\.|-|$)|\.f\d+[\w-]*\.|-Frag\d+')
+# Output names end in _<download key> (see download_video_background)
+DOWNLOAD_KEY_PATTERN = re.compile(r'_([0-9a-f]{12})\.')
+
+class OutputJanitor:
+    """Keeps outputs/ within a byte quota and age limit
+
+    Completed files are evicted least-recently-used first (last serve or write),
+    skipping files that are being served or just finished. Intermediate files
+    whose download died are removed once they go stale.
+    """
+    def __init__(self, quota_bytes, max_age, min_free_bytes):
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.min_free_bytes = min_free_bytes
+        self.lock = threading.Lock()
+        self.janitor = None
+        self.last_sweep = None
+        self.stats = {
+            'sweeps': 0, 'evicted_files': 0, 'orphans_removed': 0,
+            'reclaimed_bytes': 0, 'refused_jobs': 0,
+        }
+
+    def _delete(self, filename, size, counter):
+        try:
+            os.remove(os.path.join(OUTPUTS_DIR, filename))
+        except FileNotFoundError:
+            size = 0
+        except OSError as e:
+            logger.warning("⚠️ Janitor could not remove %s: %s", filename, e)
+            return 0
+        output_index.remove(filename)
+        self.stats[counter] += 1
+        self.stats['reclaimed_bytes'] += size
+        return size
+
+    def free_bytes(self):
+        return shutil.disk_usage(OUTPUTS_DIR).free
+
+    def sweep(self, free_target=0):
+        """One janitor pass; evicts extra LRU files until free_target bytes are free"""
+        with self.lock:
+            now = time.time()
+            output_index.reconcile()
+            reclaimed = 0
+            completed = []
+            resumable = pending_download_keys()
+            for filename, entry in output_index.entries():
+                if FRAGMENT_PATTERN.search(filename):
+                    key = DOWNLOAD_KEY_PATTERN.search(filename)
+                    if key and key.group(1) in resumable:
+                        continue  # a journaled job will resume from it
+                    if now - entry['mtime'] > ORPHAN_FRAGMENT_AGE:
+                        reclaimed += self._delete(filename, entry['size'], 'orphans_removed')
+                elif not file_leases.is_leased(filename) and now - entry['mtime'] > OUTPUTS_EVICT_GRACE:
+                    last_used = max(entry['mtime'], file_leases.last_used(filename) or 0)
+                    completed.append((last_used, filename, entry['size']))
+
+            completed.sort()
+            total = sum(entry['size'] for _, entry in output_index.entries())
+            free = self.free_bytes() if free_target else 0
+            for last_used, filename, size in completed:
+                expired = self.max_age and now - last_used > self.max_age
+                over_quota = self.quota_bytes and total > self.quota_bytes
+                if not (expired or over_quota or free < free_target):
+                    break
+                deleted = self._delete(filename, size, 'evicted_files')
+                total -= size
+                free += deleted
+                reclaimed += deleted
+
+            self.stats['sweeps'] += 1
+            self.last_sweep = now
+        # The persistent video info cache would otherwise keep a file per URL ever extracted
+        video_info_cache.sweep_disk()
+        if reclaimed:
+            logger.info("🧹 Janitor reclaimed %.1f MB from outputs/", reclaimed / (1024 * 1024))
+        return reclaimed
+
+    def has_space(self):
+        """True if there is room for a new download, sweeping harder first if needed"""
+        if self.free_bytes() >= self.min_free_bytes:
+            return True
+        self.sweep(free_target=self.min_free_bytes)
+        if self.free_bytes() >= self.min_free_bytes:
+            return True
+        self.stats['refused_jobs'] += 1
+        return False
+
+    def start(self, interval):
+        if self.janitor or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.warning("⚠️ Janitor sweep failed: %s", e)
+                time.sleep(interval)
+
+        self.janitor = threading.Thread(target=loop, name='outputs-janitor', daemon=True)
+        self.janitor.start()
+
+    def snapshot(self):
+        """Return janitor metrics for the /stats endpoint"""
+        return {
+            **self.stats,
+            'quota_bytes': self.quota_bytes,
+            'max_age': self.max_age,
+            'min_free_bytes': self.min_free_bytes,
+            'free_bytes': self.free_bytes(),
+            'last_sweep': self.last_sweep,
+        }
+
+output_janitor = OutputJanitor(OUTPUTS_QUOTA_BYTES, OUTPUTS_MAX_AGE, OUTPUTS_MIN_FREE_BYTES)
+output_janitor.start(OUTPUTS_JANITOR_INTERVAL)
 
-from fastapi import BackgroundTasks
+async def ensure_disk_space():
+    """Refuse new work with 507 when outputs/ is out of room even after a sweep"""
+    if not await asyncio.to_thread(output_janitor.has_space):
+        raise HTTPException(status_code=507, detail='Server is low on disk space - please try again later')
 
-@app.get("/download_file/{filename}")
-async def download_file(filename: str, background_tasks: BackgroundTasks):
+class LeasedFileResponse(FileResponse):
+    """FileResponse that holds a lease on its file until the transfer ends or the client goes away
+
+    Starlette handles Range/If-Range, ETag and Last-Modified, and hands the file to
+    the server via the pathsend extension (zero-copy) when the server offers it.
+    """
+    chunk_size = 1024 * 1024  # fewer read/send round trips when streaming ourselves
+
+    async def __call__(self, scope, receive, send):
+        lease = os.path.basename(str(self.path))
+        response = {'status': None, 'length': 0, 'sent': 0}
+
+        async def counting_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['length'] = int(dict(message['headers']).get(b'content-length', 0))
+            elif message['type'] == 'http.response.body':
+                response['sent'] += len(message.get('body', b''))
+            elif message['type'] == 'http.response.pathsend':
+                response['sent'] += response['length']  # the server sends the whole file
+            await send(message)
+
+        file_leases.acquire(lease)
+        try:
+            await super().__call__(scope, receive, counting_send)
+        finally:
+            file_leases.release(lease)
+            if response['status']:
+                FILE_SERVE_BYTES.inc(response['sent'], status=response['status'])
+
+@app.api_route("/download_file/{filename}", methods=["GET", "HEAD"])
+async def download_file(filename: str, request: Request):
     try:
         # Sanitize filename to prevent directory traversal
         safe_filename = os.path.basename(filename)
         file_path = os.path.join(OUTPUTS_DIR, safe_filename)
 
-        print(f"📥 Download request for: {safe_filename}")
-        print(f"📁 Looking for file at: {file_path}")
+        logger.debug("📥 Download request for: %s", safe_filename)
+        logger.debug("📁 Looking for file at: %s", file_path)
 
         # Check if the requested file exists
         if not os.path.exists(file_path):
-            print(f"❌ File not found: {safe_filename}")
+            logger.error("❌ File not found: %s", safe_filename)
             raise HTTPException(status_code=404, detail='File not found')
 
         if not os.path.isfile(file_path):
             raise HTTPException(status_code=400, detail='Invalid file')
 
-        print(f"📤 Serving file: {safe_filename}")
-
-        # Add delete task with 0.1 second delay
-        background_tasks.add_task(delete_file_after_delay, file_path, delay=0)
-
-        return FileResponse(
+        response = LeasedFileResponse(
             path=file_path,
             filename=safe_filename,
-            media_type='application/octet-stream'
+            media_type=DOWNLOAD_MEDIA_TYPES.get(os.path.splitext(safe_filename)[1].lower(), 'application/octet-stream'),
+            stat_result=os.stat(file_path)
         )
 
+        # Revalidation of an unchanged file: headers only, no body
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and response.headers['etag'] in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers={
+                key: response.headers[key] for key in ('etag', 'last-modified', 'accept-ranges')
+            })
+
+        logger.info("📤 Serving file: %s (%s)", safe_filename, request.headers.get('range', 'full'))
+        return response
+
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error serving file {filename}: {e}")
+        logger.error("❌ Error serving file %s: %s", filename, e)
         raise HTTPException(status_code=500, detail=str(e))
 
-# Helper function
-import asyncio
+# Streaming mode - bytes go straight from Facebook's CDN to the client, nothing staged in outputs/
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_CONCURRENT_STREAMS = int(os.environ.get("MAX_CONCURRENT_STREAMS", 16))
+stream_slots = asyncio.Semaphore(MAX_CONCURRENT_STREAMS)
+
+STREAM_MEDIA_TYPES = {
+    'mp4': 'video/mp4',
+    'm4a': 'audio/mp4',
+    'webm': 'video/webm',
+    'mp3': 'audio/mpeg',
+}
+
+def content_disposition(filename):
+    """Attachment header that survives non-ASCII (e.g. Urdu) titles"""
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii') or 'facebook_video'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def format_has_video(fmt):
+    return bool(fmt.get('vcodec')) and fmt.get('vcodec') not in ['none', 'null']
+
+def format_has_audio(fmt):
+    return bool(fmt.get('acodec')) and fmt.get('acodec') not in ['none', 'null']
+
+def select_stream_formats(info, format_id):
+    """Resolve an /extract_info format_id to the yt-dlp format dicts to stream"""
+    formats_by_id = {fmt.get('format_id'): fmt for fmt in info.get('formats') or []}
+    selected = [formats_by_id.get(part) for part in format_id.split('+')]
+    if not selected or not all(selected):
+        return None
+
+    # Video-only formats get merged with the best audio, like the staged download path
+    if len(selected) == 1 and format_has_video(selected[0]) and not format_has_audio(selected[0]):
+        audio_formats = [fmt for fmt in formats_by_id.values() if format_has_audio(fmt) and not format_has_video(fmt)]
+        if audio_formats:
+            selected.append(max(audio_formats, key=lambda fmt: fmt.get('abr') or 0))
+    return selected
+
+def ffmpeg_header_args(fmt):
+    headers = fmt.get('http_headers') or {}
+    if not headers:
+        return []
+    return ['-headers', ''.join(f"{name}: {value}\r\n" for name, value in headers.items())]
+
+async def stream_progressive(fmt):
+    """Proxy a single progressive format through yt-dlp's networking stack"""
+    ydl = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'socket_timeout': 20})
+    request = yt_dlp.networking.Request(fmt['url'], headers=fmt.get('http_headers') or {})
+    try:
+        response = await asyncio.to_thread(ydl.urlopen, request)
+    except Exception:
+        ydl.close()
+        raise
 
-async def delete_file_after_delay(file_path: str, delay: float):
+    async def body():
+        try:
+            while True:
+                chunk = await asyncio.to_thread(response.read, STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+            ydl.close()
+            stream_slots.release()
+
+    return body(), response.headers.get('Content-Length')
+
+async def stream_ffmpeg_mux(formats):
+    """Mux separate video/audio streams into fragmented MP4 on an ffmpeg pipe"""
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for fmt in formats:
+        cmd += ffmpeg_header_args(fmt) + ['-i', fmt['url']]
+    for index in range(len(formats)):
+        cmd += ['-map', f'{index}']
+    cmd += [
+        '-c', 'copy',
+        # Fragmented MP4 can be written to a non-seekable pipe and played while downloading
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-f', 'mp4', 'pipe:1',
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+
+    async def body():
+        try:
+            while True:
+                chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            await process.wait()
+            if process.returncode:
+                logger.warning("⚠️ ffmpeg stream exited with code %s", process.returncode)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stream_slots.release()
+
+    return body()
+
+@app.get("/stream_download")
+async def stream_download(url: str, format_id: str, info_token: Optional[str] = None):
+    """Stream a video to the client as it downloads instead of staging it in outputs/"""
+    normalized_url = normalize_facebook_url(url.strip())
+    if not normalized_url or not format_id:
+        raise HTTPException(status_code=400, detail='A valid Facebook URL and format are required')
+
+    video_id = video_info_cache.resolve_token(info_token) or get_facebook_video_id(normalized_url)
+    cached = video_info_cache.get(video_id)
+    if not cached:
+        try:
+            cached, last_error = await asyncio.wait_for(
+                run_extraction_strategies(normalized_url), timeout=EXTRACT_DEADLINE
+            )
+        except ExtractionPoolSaturated:
+            raise HTTPException(status_code=503, detail='Server is busy. Please try again in a few seconds.', headers={'Retry-After': '5'})
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail='Timed out while extracting video information. Please try again.')
+        if not cached:
+            raise HTTPException(status_code=400, detail=get_helpful_error_message(last_error, url))
+
+    info = cached['info']
+    formats = select_stream_formats(info, format_id)
+    if not formats:
+        raise HTTPException(status_code=404, detail='Requested format is not available for this video')
+
+    progressive = len(formats) == 1 and formats[0].get('protocol', 'https') in ('http', 'https')
+    if not progressive and not shutil.which('ffmpeg'):
+        raise HTTPException(status_code=501, detail='Streaming this format requires ffmpeg; use /download instead')
+
+    if stream_slots.locked():
+        raise HTTPException(status_code=503, detail='Too many active streams. Please try again shortly.', headers={'Retry-After': '5'})
+    await stream_slots.acquire()
+
+    title = generate_safe_filename(info.get('title') or info.get('id'))
     try:
-        await asyncio.sleep(delay)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"🗑️ Deleted file: {file_path}")
+        if progressive:
+            ext = formats[0].get('ext') or 'mp4'
+            body, content_length = await stream_progressive(formats[0])
+        else:
+            ext = 'mp4'
+            body, content_length = await stream_ffmpeg_mux(formats), None
     except Exception as e:
-        print(f"⚠️ Failed to delete {file_path}: {e}")
+        stream_slots.release()
+        logger.error("❌ Could not open stream for %s: %s", video_id, e)
+        raise HTTPException(status_code=502, detail=f'Could not start streaming: {str(e)}')
+
+    logger.info("📡 Streaming %s format %s (%s)", video_id, format_id, 'direct' if progressive else 'ffmpeg mux')
+    headers = {'Content-Disposition': content_disposition(f"{title}.{ext}")}
+    if content_length:
+        headers['Content-Length'] = content_length
+    return StreamingResponse(body, media_type=STREAM_MEDIA_TYPES.get(ext, 'application/octet-stream'), headers=headers)
+
+
+
+
+
+
+# Batch API - one request for many URLs, results streamed back as NDJSON in completion order
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", 1000))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+BATCH_BUSY_RETRIES = 3
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+async def run_batch(items, worker, concurrency):
+    """Run worker over an (async or sync) iterable with at most `concurrency` in flight
+
+    Yields results as they complete. Items are pulled lazily, so memory stays
+    constant however long the input is; pending work is cancelled if the
+    consumer goes away.
+    """
+    if hasattr(items, '__aiter__'):
+        next_item = items.__aiter__().__anext__
+    else:
+        iterator = iter(items)
+
+        async def next_item():
+            try:
+                return next(iterator)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    pending = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    item = await next_item()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(worker(item)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
 
+def batch_items(urls):
+    """(index, url, video_id, duplicate_of) for each URL, deduplicated by video ID"""
+    seen = {}
+    for index, url in enumerate(urls):
+        url = url.strip()
+        normalized_url = normalize_facebook_url(url) if url else None
+        video_id = get_facebook_video_id(normalized_url) if normalized_url else None
+        duplicate_of = seen.get(video_id) if video_id else None
+        if video_id and duplicate_of is None:
+            seen[video_id] = index
+        yield index, url, video_id, duplicate_of
 
+def check_batch_size(urls, concurrency):
+    if not urls:
+        raise HTTPException(status_code=400, detail='Please provide at least one URL')
+    if len(urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f'At most {BATCH_MAX_URLS} URLs per batch')
+    return max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
 
+async def extract_batch_item(url):
+    """extract_video_data that backs off instead of failing while the extraction pool is full"""
+    for attempt in range(BATCH_BUSY_RETRIES + 1):
+        try:
+            return await extract_video_data(url)
+        except HTTPException as e:
+            if e.status_code != 503 or attempt == BATCH_BUSY_RETRIES:
+                raise
+            await asyncio.sleep(1 + attempt * 2)
+
+def batch_error(index, url, video_id, error):
+    if isinstance(error, HTTPException):
+        return {'index': index, 'url': url, 'video_id': video_id, 'status': 'error', 'error': error.detail, 'code': error.status_code}
+    logger.error("❌ Batch item %s failed: %s", index, error)
+    return {'index': index, 'url': url, 'video_id': video_id, 'status': 'error', 'error': str(error), 'code': 500}
+
+def format_ndjson(result):
+    return json.dumps(result) + '\n'
+
+@app.post("/extract_info/batch")
+async def extract_info_batch(request_data: BatchExtractRequest):
+    concurrency = check_batch_size(request_data.urls, request_data.concurrency)
+    logger.info("📚 Batch extraction of %s URLs (concurrency %s)", len(request_data.urls), concurrency)
+
+    async def extract_item(item):
+        index, url, video_id, duplicate_of = item
+        if duplicate_of is not None:
+            return {'index': index, 'url': url, 'video_id': video_id, 'status': 'duplicate', 'duplicate_of': duplicate_of}
+        try:
+            data = await extract_batch_item(url)
+            return {'index': index, 'url': url, 'video_id': video_id, 'status': 'ok', 'data': data}
+        except Exception as e:
+            return batch_error(index, url, video_id, e)
+
+    async def results():
+        async for result in run_batch(batch_items(request_data.urls), extract_item, concurrency):
+            yield format_ndjson(result)
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+async def wait_for_download(download_id):
+    """Wait until a download reaches a terminal state and return its progress"""
+    subscriber = progress_channel.subscribe(download_id)
+    try:
+        progress = await get_progress(download_id)
+        timeout = SHARED_STATE_POLL_INTERVAL if SHARED_STATE else PROGRESS_STREAM_KEEPALIVE
+        while progress.get('status') not in TERMINAL_PROGRESS_STATES:
+            try:
+                await asyncio.wait_for(subscriber[1].get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            progress = await get_progress(download_id)
+        return progress
+    finally:
+        progress_channel.unsubscribe(download_id, subscriber)
+
+class ZipStream:
+    """Write-only file object that collects zipfile output for a streaming response"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+async def stream_zip(results):
+    """Zip finished files as they arrive (stored, not deflated - videos don't compress)"""
+    import zipfile
+    output = ZipStream()
+    archive = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED)
+    manifest = []
+    async for result in results:
+        manifest.append(result)
+        if result.get('status') != 'finished':
+            continue
+        filename = result['filename']
+        file_path = os.path.join(OUTPUTS_DIR, filename)
+        file_leases.acquire(filename)
+        try:
+            with open(file_path, 'rb') as source, archive.open(filename, 'w', force_zip64=True) as target:
+                while True:
+                    chunk = await asyncio.to_thread(source.read, ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield output.drain()
+        except OSError as e:
+            logger.warning("⚠️ Could not add %s to zip: %s", filename, e)
+            result.update(status='error', error='File disappeared before it could be zipped')
+        finally:
+            file_leases.release(filename)
+        yield output.drain()
+    archive.writestr('manifest.ndjson', ''.join(format_ndjson(result) for result in manifest))
+    archive.close()
+    yield output.drain()
+
+@app.post("/download/batch")
+async def download_batch(request_data: BatchDownloadRequest):
+    concurrency = check_batch_size(request_data.urls, request_data.concurrency)
+    wait = request_data.wait or request_data.zip
+    logger.info("📚 Batch download of %s URLs (concurrency %s)", len(request_data.urls), concurrency)
+
+    async def download_item(item):
+        index, url, video_id, duplicate_of = item
+        if duplicate_of is not None:
+            return {'index': index, 'url': url, 'video_id': video_id, 'status': 'duplicate', 'duplicate_of': duplicate_of}
+        try:
+            # Warm the info cache so the download skips its own extraction
+            data = await extract_batch_item(url)
+            started = await start_download(DownloadRequest(
+                url=url,
+                format_id=request_data.format_id,
+                info_token=data.get('info_token'),
+                priority=request_data.priority
+            ))
+            result = {'index': index, 'url': url, 'video_id': video_id, 'status': 'queued', 'download_id': started['download_id']}
+            if wait:
+                progress = await wait_for_download(started['download_id'])
+                result['status'] = progress.get('status')
+                if progress.get('filename'):
+                    result['filename'] = progress['filename']
+                if progress.get('error'):
+                    result['error'] = progress['error']
+            return result
+        except Exception as e:
+            return batch_error(index, url, video_id, e)
+
+    results = run_batch(batch_items(request_data.urls), download_item, concurrency)
+    if request_data.zip:
+        return StreamingResponse(
+            stream_zip(results),
+            media_type='application/zip',
+            headers={'Content-Disposition': content_disposition(f"facebook_videos_{int(time.time())}.zip")}
+        )
+
+    async def ndjson():
+        async for result in results:
+            yield format_ndjson(result)
+
+    return StreamingResponse(ndjson(), media_type='application/x-ndjson')
+
+# Crawl mode - enumerate a page/profile's videos with flat extraction and download as we go
+MAX_CONCURRENT_CRAWLS = int(os.environ.get("MAX_CONCURRENT_CRAWLS", 4))
+# Crawl downloads allowed in the pipeline at once; enumeration pauses while this many are pending
+CRAWL_MAX_IN_FLIGHT = int(os.environ.get("CRAWL_MAX_IN_FLIGHT", 16))
+crawl_slots = asyncio.Semaphore(MAX_CONCURRENT_CRAWLS)
+
+def iter_flat_entries(ydl, info, depth=0):
+    """Yield video entries of a flat (unprocessed) extraction result, paging lazily"""
+    # A page URL may first resolve to another extractor's URL
+    while info.get('_type') in ('url', 'url_transparent') and depth < 3:
+        info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        depth += 1
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        yield info
+        return
+    for entry in info.get('entries') or ():
+        if not entry:
+            continue
+        if entry.get('_type') == 'playlist' and depth < 3:
+            yield from iter_flat_entries(ydl, entry, depth + 1)
+        else:
+            yield entry
+
+async def crawl_entries(url, limit, stop):
+    """Async generator over a page's video entries, produced by a flat extraction thread
 
+    The bounded queue is the backpressure: yt-dlp only fetches the next page of
+    the listing when the crawl has room for more downloads.
+    """
+    loop = asyncio.get_running_loop()
+    entries_queue = asyncio.Queue(maxsize=CRAWL_MAX_IN_FLIGHT)
+    done = object()
 
+    def put(item):
+        asyncio.run_coroutine_threadsafe(entries_queue.put(item), loop).result()
+
+    def produce():
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'logger': ytdlp_logger,
+            'extract_flat': 'in_playlist',
+            'lazy_playlist': True,
+            'socket_timeout': 20,
+        }
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False, process=False)
+                for count, entry in enumerate(iter_flat_entries(ydl, info)):
+                    if stop.is_set() or (limit and count >= limit):
+                        break
+                    put(entry)
+        except Exception as e:
+            logger.error("❌ Crawl enumeration failed for %s: %s", url, e)
+            put(e)
+        finally:
+            put(done)
+
+    threading.Thread(target=produce, name='crawl', daemon=True).start()
+    try:
+        while True:
+            item = await entries_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer so it notices the stop flag
+        while not entries_queue.empty():
+            entries_queue.get_nowait()
+
+@app.post("/crawl")
+async def crawl(request_data: CrawlRequest):
+    url = request_data.url.strip()
+    normalized_url = normalize_facebook_url(url) if url else None
+    if not normalized_url:
+        raise HTTPException(status_code=400, detail='Please provide a valid Facebook page or profile videos URL')
+    if crawl_slots.locked():
+        raise HTTPException(status_code=503, detail='Too many crawls running. Please try again later.', headers={'Retry-After': '30'})
+    # A free slot is taken without suspending, so no other request can slip in after the check
+    await crawl_slots.acquire()
+    released = False
+
+    def release_slot():
+        nonlocal released
+        if not released:
+            released = True
+            crawl_slots.release()
+
+    async def download_entry(item):
+        index, entry = item
+        # Flat entries point at the video page in 'url'; resolved ones carry 'webpage_url'
+        if entry.get('_type') in ('url', 'url_transparent'):
+            entry_url = entry.get('url')
+        else:
+            entry_url = entry.get('webpage_url') or entry.get('url')
+        result = {'index': index, 'url': entry_url, 'video_id': entry.get('id'), 'title': entry.get('title')}
+        try:
+            if not entry_url or not entry_url.startswith(('http://', 'https://')):
+                raise HTTPException(status_code=400, detail='Entry has no downloadable URL')
+            # No per-video extraction here - the download resolves formats when it starts
+            started = await start_download(DownloadRequest(
+                url=entry_url,
+                format_id=request_data.format_id,
+                priority=request_data.priority
+            ))
+            result['download_id'] = started['download_id']
+            progress = await wait_for_download(started['download_id'])
+            result['status'] = progress.get('status')
+            for key in ('filename', 'error'):
+                if progress.get(key):
+                    result[key] = progress[key]
+            return result
+        except Exception as e:
+            return {**batch_error(index, entry_url, entry.get('id'), e), 'title': entry.get('title')}
+
+    async def results():
+        stop = threading.Event()
+        counts = {'entries': 0, 'finished': 0, 'failed': 0}
+        logger.info("🕸️ Crawling: %s", normalized_url)
+        entries = crawl_entries(normalized_url, request_data.limit, stop)
+        try:
+            async for result in run_batch(enumerate_async(entries), download_entry, CRAWL_MAX_IN_FLIGHT):
+                counts['entries'] += 1
+                counts['finished' if result.get('status') == 'finished' else 'failed'] += 1
+                yield format_ndjson(result)
+        except Exception as e:
+            yield format_ndjson({'status': 'error', 'error': get_helpful_error_message(str(e), url), **counts})
+            return
+        finally:
+            stop.set()
+            release_slot()
+        logger.info("🕸️ Crawl finished: %s", counts)
+        yield format_ndjson({'status': 'done', **counts})
+
+    # The background task covers a response whose body never started streaming
+    return StreamingResponse(results(), media_type='application/x-ndjson', background=BackgroundTask(release_slot))
+
+async def enumerate_async(items):
+    index = 0
+    async for item in items:
+        yield index, item
+        index += 1
 
 @app.get("/list_filess")
 async def list_files():
     try:
-        files = []
-        if os.path.exists(OUTPUTS_DIR):
-            for filename in os.listdir(OUTPUTS_DIR):
-                file_path = os.path.join(OUTPUTS_DIR, filename)
-                if os.path.isfile(file_path) and filename.endswith(('.mp4', '.webm', '.mkv')):
-                    file_size = os.path.getsize(file_path)
-                    files.append({
-                        'name': filename,
-                        'size': file_size,
-                        'modified': os.path.getmtime(file_path)
-                    })
-        
-        # Sort by modification time (newest first)
-        files.sort(key=lambda x: x['modified'], reverse=True)
-        return files[:10]  # Return only the 10 most recent files
+        # Return only the 10 most recent files (newest first) from the output index
+        output_index.ensure_fresh()
+        return [
+            {'name': filename, 'size': entry['size'], 'modified': entry['mtime']}
+            for filename, entry in output_index.recent_media(10)
+        ]
         
     except Exception as e:
-        print(f"❌ Error listing files: {e}")
+        logger.error("❌ Error listing files: %s", e)
         return []
 
+@app.post("/cancel/{download_id}")
+async def cancel_download(download_id: str):
+    if download_queue is not None:
+        # The owning worker sees the flag and stops the download
+        state = download_queue.cancel(download_id)
+        if not state:
+            raise HTTPException(status_code=404, detail='Download not found or already finished')
+        logger.info("🛑 Cancel requested for ID: %s", download_id)
+        return {'download_id': download_id, 'status': 'cancelling'}
+
+    # A coalesced download keeps running while other requesters still wait on it
+    if not download_registry.detach(download_id):
+        logger.info("🔗 Detached one requester from shared download: %s", download_id)
+        return {'download_id': download_id, 'status': 'detached'}
+
+    state = download_scheduler.cancel(download_id)
+    if not state:
+        raise HTTPException(status_code=404, detail='Download not found or already finished')
+    if state == 'queued':
+        download_registry.finish(download_id)
+        if download_journal is not None:
+            download_journal.remove(download_id)
+    logger.info("🛑 Cancel requested for ID: %s", download_id)
+    return {'download_id': download_id, 'status': 'cancelling'}
+
+def check_profile_access(x_profile):
+    if PROFILE_TOKEN is None:
+        raise HTTPException(status_code=404, detail='Profiling is disabled')
+    if not profile_requested(x_profile):
+        raise HTTPException(status_code=403, detail='Missing or wrong X-Profile token')
+
+@app.get("/profiles")
+async def get_profiles(x_profile: Optional[str] = Header(None)):
+    check_profile_access(x_profile)
+    return list_profiles()
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_profile: Optional[str] = Header(None)):
+    """A profile as collapsed stacks, e.g. for `flamegraph.pl profile.folded > profile.svg`"""
+    check_profile_access(x_profile)
+    path = os.path.join(PROFILES_DIR, f'{profile_id}.folded')
+    if not PROFILE_ID_PATTERN.match(profile_id) or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail='Profile not found (the run may still be in progress)')
+    return FileResponse(path, media_type='text/plain', filename=f'{profile_id}.folded')
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        'extraction_pool': extraction_pool.snapshot(),
+        'video_info_cache': video_info_cache.snapshot(),
+        'strategies': strategy_stats.snapshot(),
+        'downloads': (download_queue or download_scheduler).snapshot(),
+        'download_journal': download_journal.snapshot() if download_journal is not None else None,
+        'stage_timings': stage_timings.snapshot(),
+        'transfer_budget': transfer_budget.snapshot(),
+        'file_retention': file_leases.snapshot(),
+        'janitor': output_janitor.snapshot(),
+        'dedup': download_registry.snapshot(),
+        'progress_stream_subscribers': progress_channel.subscriber_count(),
+        'output_index': output_index.snapshot(),
+        'job_store': job_store.snapshot(),
+        'filename_cache': _clean_title.cache_info()._asdict(),
+    }
+
+def snapshot_values(snapshot, keys):
+    """{(key,): snapshot[key]} for a labelled scrape-time metric"""
+    return {(key,): snapshot.get(key) or 0 for key in keys}
+
+# Gauges and totals read from the /stats snapshots when /metrics is scraped - no hot-path cost
+metrics.register(Gauge(
+    'fbdl_extraction_jobs', 'Extraction jobs in the pool by state', labels=('state',),
+    callback=lambda: snapshot_values(extraction_pool.snapshot(), ('running', 'queued'))))
+metrics.register(Counter(
+    'fbdl_extraction_rejected_total', 'Extractions refused with 503 because the pool was full',
+    callback=lambda: {(): extraction_pool.snapshot()['rejected']}))
+metrics.register(Gauge(
+    'fbdl_download_jobs', 'Download jobs by state', labels=('state',),
+    callback=lambda: snapshot_values((download_queue or download_scheduler).snapshot(), ('running', 'queued'))))
+metrics.register(Gauge(
+    'fbdl_transfer_active_jobs', 'Downloads sharing the transfer budget',
+    callback=lambda: {(): transfer_budget.snapshot()['active_jobs']}))
+metrics.register(Counter(
+    'fbdl_video_info_cache_lookups_total', 'Video info cache lookups by result', labels=('result',),
+    callback=lambda: snapshot_values(video_info_cache.snapshot(), ('hits', 'disk_hits', 'misses'))))
+metrics.register(Gauge(
+    'fbdl_video_info_cache_bytes', 'Approximate size of the video info cache',
+    callback=lambda: {(): video_info_cache.snapshot()['bytes']}))
+metrics.register(Counter(
+    'fbdl_download_requests_total', 'Download requests by how they were served', labels=('result',),
+    callback=lambda: snapshot_values(download_registry.snapshot(), ('started', 'coalesced', 'completed_hits'))))
+metrics.register(Gauge(
+    'fbdl_progress_stream_subscribers', 'Open /progress/{id}/stream connections',
+    callback=lambda: {(): progress_channel.subscriber_count()}))
+metrics.register(Gauge(
+    'fbdl_file_transfers_active', 'Responses currently streaming a file from outputs/',
+    callback=lambda: {(): file_leases.snapshot()['active_transfers']}))
+metrics.register(Counter(
+    'fbdl_janitor_reclaimed_bytes_total', 'Bytes freed in outputs/ by the janitor',
+    callback=lambda: {(): output_janitor.snapshot()['reclaimed_bytes']}))
+
+metrics.register(Counter(
+    'fbdl_log_records_dropped_total', 'Log records dropped because the log queue was full',
+    callback=lambda: {(): log_queue_handler.dropped}))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of this process's metrics"""
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.exception_handler(404)
 async def not_found_handler(request: Request, exc):
     return JSONResponse(
@@ -1067,6 +4633,8 @@ async def internal_error_handler(request: Request, exc):
     )
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']:
+        run_worker()
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run("app:app", host="0.0.0.0", port=port)
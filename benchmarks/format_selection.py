@@ -0,0 +1,208 @@
+"""Micro-benchmark for process_formats_enhanced against the previous implementation
+
+Usage: python benchmarks/format_selection.py [--repeat N] [fixtures...]
+
+Fixtures are yt-dlp info dicts (only 'formats' is used) in benchmarks/fixtures/.
+The bundled ones mirror the shape of Facebook reel/watch responses (DASH
+video-only streams per codec and bitrate, DASH audio, sd/hd progressive);
+drop `yt-dlp --dump-json <url>` output in there to benchmark real captures.
+Before timing, both implementations must return identical listings.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import timeit
+
+# Importing app must not start background janitors on the real outputs/ directory
+os.environ.setdefault("OUTPUTS_JANITOR_INTERVAL", "0")
+os.environ.setdefault("OUTPUT_INDEX_RECONCILE_INTERVAL", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_process_formats(formats):
+    """process_formats_enhanced as it was before the rewrite (log lines removed)"""
+    combined_formats = []
+    video_only_formats = []
+    audio_only_formats = []
+
+    for fmt in formats:
+        try:
+            format_id = fmt.get('format_id', 'unknown')
+            ext = fmt.get('ext', 'mp4')
+
+            if ext in ['jpg', 'png', 'gif', 'webp']:
+                continue
+
+            has_video = fmt.get('vcodec') and fmt.get('vcodec') not in ['none', 'null']
+            has_audio = fmt.get('acodec') and fmt.get('acodec') not in ['none', 'null']
+
+            height = fmt.get('height') or 0
+            width = fmt.get('width') or 0
+
+            if height == 0:
+                format_note = fmt.get('format_note', '').lower()
+                if '1080' in format_note:
+                    height = 1080
+                elif '720' in format_note:
+                    height = 720
+                elif '480' in format_note:
+                    height = 480
+                elif '360' in format_note:
+                    height = 360
+                elif '240' in format_note:
+                    height = 240
+
+            filesize = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+
+            if has_video and has_audio and height >= 144:
+                combined_formats.append({
+                    'format_id': format_id,
+                    'quality': f"{height}p (Video + Audio)" if height > 0 else "Video + Audio",
+                    'ext': ext,
+                    'filesize': filesize,
+                    'type': 'combined',
+                    'height': height,
+                    'width': width,
+                    'fps': fmt.get('fps') or 0,
+                    'vcodec': fmt.get('vcodec', 'unknown'),
+                    'acodec': fmt.get('acodec', 'unknown'),
+                    'abr': fmt.get('abr') or 0,
+                    'priority': 1
+                })
+            elif has_video and not has_audio and height >= 144:
+                video_only_formats.append({
+                    'format_id': format_id,
+                    'quality': f"{height}p (Video Only)" if height > 0 else "Video Only",
+                    'ext': ext,
+                    'filesize': filesize,
+                    'type': 'video_only',
+                    'height': height,
+                    'width': width,
+                    'fps': fmt.get('fps') or 0,
+                    'vcodec': fmt.get('vcodec', 'unknown'),
+                    'priority': 3
+                })
+            elif has_audio and not has_video:
+                audio_only_formats.append({
+                    'format_id': format_id,
+                    'quality': 'Audio Only',
+                    'ext': 'mp3' if ext in ['m4a', 'mp3'] else ext,
+                    'filesize': filesize,
+                    'type': 'audio_only',
+                    'acodec': fmt.get('acodec', 'unknown'),
+                    'abr': fmt.get('abr') or 0,
+                    'priority': 2
+                })
+            elif not has_video and not has_audio:
+                if height > 0 or width > 0:
+                    combined_formats.append({
+                        'format_id': format_id,
+                        'quality': f"{height}p" if height > 0 else "Video",
+                        'ext': ext,
+                        'filesize': filesize,
+                        'type': 'combined',
+                        'height': height,
+                        'width': width,
+                        'fps': fmt.get('fps') or 0,
+                        'vcodec': 'unknown',
+                        'acodec': 'unknown',
+                        'abr': fmt.get('abr') or 0,
+                        'priority': 2
+                    })
+        except Exception:
+            continue
+
+    if not combined_formats and video_only_formats and audio_only_formats:
+        best_video = max(video_only_formats, key=lambda x: x.get('height', 0))
+        best_audio = max(audio_only_formats, key=lambda x: x.get('abr', 0))
+
+        video_size = best_video.get('filesize') or 0
+        audio_size = best_audio.get('filesize') or 0
+        combined_size = video_size + audio_size if video_size > 0 and audio_size > 0 else 0
+
+        combined_formats.append({
+            'format_id': f"{best_video['format_id']}+{best_audio['format_id']}",
+            'quality': f"{best_video['height']}p (Best Quality + Audio)" if best_video['height'] > 0 else "Best Quality + Audio",
+            'ext': 'mp4',
+            'filesize': combined_size,
+            'type': 'best_combined',
+            'height': best_video.get('height', 0),
+            'width': best_video.get('width', 0),
+            'fps': best_video.get('fps', 0),
+            'vcodec': best_video.get('vcodec', 'unknown'),
+            'acodec': best_audio.get('acodec', 'unknown'),
+            'abr': best_audio.get('abr', 0),
+            'priority': 1
+        })
+
+    all_formats = combined_formats + video_only_formats + audio_only_formats
+
+    if not all_formats:
+        return None
+
+    seen_qualities = set()
+    unique_formats = []
+
+    all_formats.sort(key=lambda x: (
+        x.get('priority', 999),
+        -x.get('height', 0),
+        -x.get('abr', 0)
+    ))
+
+    for fmt in all_formats:
+        quality_key = fmt['quality']
+        if quality_key not in seen_qualities:
+            unique_formats.append(fmt)
+            seen_qualities.add(quality_key)
+            if len(unique_formats) >= 8:
+                break
+
+    return unique_formats
+
+
+def best_of(func, formats, repeat, number):
+    """Fastest per-call time in microseconds"""
+    return min(timeit.repeat(lambda: func(formats), repeat=repeat, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('fixtures', nargs='*', help='fixture files (default: benchmarks/fixtures/*.json)')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    paths = args.fixtures or sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json')))
+    print(f"{'fixture':<32} {'formats':>7} {'legacy us':>10} {'new us':>8} {'speedup':>8}")
+    for path in paths:
+        with open(path) as f:
+            formats = json.load(f)['formats']
+
+        expected = legacy_process_formats(formats)
+        actual = app.process_formats_enhanced(formats)
+        if expected != actual:
+            print(f"❌ {os.path.basename(path)}: listings differ")
+            print(json.dumps({'legacy': expected, 'new': actual}, indent=1))
+            sys.exit(1)
+
+        legacy_time = best_of(legacy_process_formats, formats, args.repeat, args.number)
+        new_time = best_of(app.process_formats_enhanced, formats, args.repeat, args.number)
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f"{name:<32} {len(formats):>7} {legacy_time:>10.1f} {new_time:>8.1f} {legacy_time / new_time:>7.2f}x")
+
+    policy = app.FormatPolicy(max_height=720, preferred_codec='h264', max_filesize=50 * 1024 * 1024)
+    for path in paths:
+        with open(path) as f:
+            formats = json.load(f)['formats']
+        listing = app.process_formats_enhanced(formats, policy) or []
+        print(f"policy {os.path.basename(path)}: {[entry['quality'] for entry in listing]}")
+
+
+if __name__ == '__main__':
+    main()
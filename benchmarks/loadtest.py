@@ -0,0 +1,603 @@
+"""Load test for the whole download path against a local stand-in for Facebook
+
+Usage: python benchmarks/loadtest.py [--requests N] [--concurrency N] [--media-size MB] [--mode progressive|merge]
+(needs httpx on top of requirements.txt)
+
+A fake origin on 127.0.0.1 serves Facebook-like reel pages
+(`/facebook.com/reel/<15 digit id>`) that yt-dlp's generic extractor parses:
+og:title, an sd/hd progressive mp4 pair and a DASH manifest with separate
+video and audio representations. Progressive media is synthesized on the fly
+(a valid faststart box layout padded to --media-size, so no remux is
+triggered); the DASH streams are real media rendered once with ffmpeg, since
+the merge has to read them. All media honours Range requests.
+
+Each session drives /extract_info, /download, polls /progress until the job
+is done and then reads the file back from /download_file. By default the app
+is started with uvicorn in a subprocess (outputs/ of this checkout, files the
+run created are removed afterwards); --target points the driver at an already
+running instance instead (--pid to sample its RSS). Latencies are reported as
+p50/p99 per endpoint, plus session throughput, bytes served and peak RSS.
+--json saves the report and --baseline compares against a saved one, exiting
+non-zero when a percentile regresses past --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.server
+import importlib.util
+from urllib.parse import urlparse
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTPUTS_DIR = os.path.join(REPO_DIR, 'outputs')
+TERMINAL_STATES = ('finished', 'error', 'cancelled', 'not_found')
+MEDIA_CHUNK_SIZE = 64 * 1024
+ZERO_CHUNK = bytes(MEDIA_CHUNK_SIZE)
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html><head>
+<title>{title} | Facebook</title>
+<meta property="og:title" content="{title}">
+<meta property="og:description" content="Load test video {video_id}">
+<meta property="og:image" content="{origin}/media/{video_id}/thumb.jpg">
+</head><body>
+<video controls>
+<source src="/media/{video_id}/hd.mp4" type="video/mp4" label="720p" res="720">
+<source src="/media/{video_id}/sd.mp4" type="video/mp4" label="360p" res="360">
+{dash_source}
+</video>
+</body></html>
+"""
+
+DASH_SOURCE = '<source src="/media/{video_id}/manifest.mpd" type="application/dash+xml">'
+
+MPD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{duration}S" minBufferTime="PT1S" profiles="urn:mpeg:dash:profile:isoff-on-demand:2011">
+<Period>
+<AdaptationSet mimeType="video/mp4" segmentAlignment="true">
+<Representation id="{video_id}v" codecs="mp4v.20.1" width="1280" height="720" frameRate="25" bandwidth="{video_bandwidth}">
+<BaseURL>dash_video.mp4</BaseURL>
+</Representation>
+</AdaptationSet>
+<AdaptationSet mimeType="audio/mp4" segmentAlignment="true">
+<Representation id="{video_id}a" codecs="mp4a.40.2" audioSamplingRate="44100" bandwidth="{audio_bandwidth}">
+<BaseURL>dash_audio.m4a</BaseURL>
+</Representation>
+</AdaptationSet>
+</Period>
+</MPD>
+"""
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_rss(pid):
+    """(VmRSS, VmHWM) of a process in bytes, or (None, None) where /proc is unavailable"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    values[key] = int(rest.split()[0]) * 1024
+    except OSError:
+        pass
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def faststart_mp4_header(total_size):
+    """ftyp + moov + mdat header of a `total_size` byte mp4 whose mdat is zero padding"""
+    ftyp = struct.pack('>I4s4sI4s4s', 24, b'ftyp', b'isom', 0x200, b'isom', b'mp41')
+    moov = struct.pack('>I4s', 16, b'moov') + struct.pack('>I4s', 8, b'free')
+    mdat_size = max(total_size - len(ftyp) - len(moov), 8)
+    return ftyp + moov + struct.pack('>I4s', mdat_size, b'mdat')
+
+
+def render_dash_media(directory, size, duration):
+    """Real video-only and audio-only mp4 files for the merge path; None without ffmpeg"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return None
+    video_path = os.path.join(directory, 'dash_video.mp4')
+    audio_path = os.path.join(directory, 'dash_audio.m4a')
+    video_bitrate = max(size * 8 // duration, 64000)
+    common = [ffmpeg, '-loglevel', 'error', '-y']
+    subprocess.run(common + [
+        '-f', 'lavfi', '-i', f'testsrc=size=1280x720:rate=25:duration={duration}',
+        # Noise keeps the test pattern from compressing far below the requested size
+        '-vf', 'noise=alls=60:allf=t+u', '-c:v', 'mpeg4', '-b:v', str(video_bitrate),
+        '-minrate', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate),
+        '-movflags', '+faststart', video_path
+    ], check=True)
+    subprocess.run(common + [
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:a', 'aac', '-b:a', '128k', audio_path
+    ], check=True)
+    return {
+        'dash_video.mp4': video_path,
+        'dash_audio.m4a': audio_path,
+        'duration': duration,
+        'video_bandwidth': video_bitrate,
+        'audio_bandwidth': 128000,
+    }
+
+
+class FakeOriginHandler(http.server.BaseHTTPRequestHandler):
+    """Serves reel pages, DASH manifests and Range-aware media for FakeOrigin"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        origin = self.server.origin
+        path = urlparse(self.path).path
+        parts = path.strip('/').split('/')
+        origin.count('requests')
+        if origin.page_delay:
+            time.sleep(origin.page_delay)
+
+        if len(parts) == 3 and parts[:2] == ['facebook.com', 'reel'] and parts[2].isdigit():
+            video_id = parts[2]
+            dash_source = DASH_SOURCE.format(video_id=video_id) if origin.dash else ''
+            body = PAGE_TEMPLATE.format(
+                title=f'Load test reel {video_id}', video_id=video_id, origin=origin.url, dash_source=dash_source
+            ).encode()
+            return self.send_body(body, 'text/html; charset=utf-8', head)
+
+        if len(parts) != 3 or parts[0] != 'media':
+            return self.send_error(404)
+        name = parts[2]
+        if name == 'manifest.mpd' and origin.dash:
+            body = MPD_TEMPLATE.format(video_id=parts[1], **{
+                key: origin.dash[key] for key in ('duration', 'video_bandwidth', 'audio_bandwidth')
+            }).encode()
+            return self.send_body(body, 'application/dash+xml', head)
+        if name in ('dash_video.mp4', 'dash_audio.m4a') and origin.dash:
+            with open(origin.dash[name], 'rb') as f:
+                return self.send_media(f.read(), 'video/mp4', head)
+        if name in origin.progressive_sizes:
+            return self.send_media(origin.progressive_sizes[name], 'video/mp4', head)
+        if name == 'thumb.jpg':
+            return self.send_body(b'\xff\xd8\xff\xd9', 'image/jpeg', head)
+        self.send_error(404)
+
+    def send_body(self, body, content_type, head):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_media(self, media, content_type, head):
+        """Serve `media` (bytes, or a size to synthesize) honouring a single Range"""
+        total = len(media) if isinstance(media, bytes) else media
+        start, end = 0, total - 1
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[6:].split(',')[0].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), total - 1) if last else total - 1
+            elif last:
+                start = max(total - int(last), 0)
+            if start >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{total}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+
+        if isinstance(media, bytes):
+            self.wfile.write(media[start:end + 1])
+            self.server.origin.count('media_bytes', end - start + 1)
+            return
+        header = faststart_mp4_header(total)
+        position = start
+        try:
+            while position <= end:
+                if position < len(header):
+                    chunk = header[position:min(len(header), end + 1)]
+                else:
+                    chunk = ZERO_CHUNK[:min(MEDIA_CHUNK_SIZE, end + 1 - position)]
+                self.wfile.write(chunk)
+                position += len(chunk)
+        finally:
+            self.server.origin.count('media_bytes', position - start)
+
+
+class FakeOrigin:
+    """Threaded local HTTP server standing in for facebook.com and its CDN"""
+    def __init__(self, media_size, dash=None, page_delay=0):
+        self.progressive_sizes = {'hd.mp4': media_size, 'sd.mp4': max(media_size // 3, 1024)}
+        self.dash = dash
+        self.page_delay = page_delay
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'media_bytes': 0}
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeOriginHandler)
+        self.server.daemon_threads = True
+        self.server.origin = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counters[key] += amount
+
+    def video_url(self, video_id):
+        return f'{self.url}/facebook.com/reel/{video_id}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-origin', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AppServer:
+    """The app under uvicorn in a subprocess, with outputs/ of this checkout"""
+    def __init__(self, env, workers=1):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.env = {**os.environ, **env}
+        self.workers = workers
+        self.process = None
+
+    def start(self, timeout=60):
+        if importlib.util.find_spec('uvicorn') is None:
+            sys.exit('uvicorn is not installed; install requirements.txt or pass --target URL')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'app:app', '--host', '127.0.0.1', '--port', str(self.port),
+             '--workers', str(self.workers), '--log-level', 'warning'],
+            cwd=REPO_DIR, env=self.env
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                sys.exit(f'app exited during startup with code {self.process.returncode}')
+            try:
+                if httpx.get(f'{self.url}/stats', timeout=1).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        sys.exit(f'app did not answer on {self.url} within {timeout}s')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class RSSSampler:
+    """Samples VmRSS of a process (and its uvicorn workers) in the background"""
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='rss-sampler', daemon=True)
+
+    def pids(self):
+        children = []
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as f:
+                children = [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        return [self.pid] + children
+
+    def run(self):
+        while not self.stop_event.is_set():
+            rss = sum(read_rss(pid)[0] or 0 for pid in self.pids())
+            if rss:
+                self.samples.append(rss)
+                self.peak = max(self.peak, rss)
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        return {
+            'rss_start': self.samples[0] if self.samples else None,
+            'rss_end': self.samples[-1] if self.samples else None,
+            'rss_peak': self.peak or None,
+        }
+
+
+class LoadTest:
+    """Runs sessions at fixed concurrency and collects per-endpoint latencies"""
+    def __init__(self, client, origin, args):
+        self.client = client
+        self.origin = origin
+        self.args = args
+        self.latencies = {}
+        self.errors = {}
+        self.file_bytes = 0
+        self.filenames = set()
+        # Fresh ids per run so a long-running target doesn't answer from its caches
+        self.id_prefix = random.randrange(10 ** 5, 10 ** 6)
+
+    def record(self, name, started, ok=True):
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def timed(self, name, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.record(name, started, ok=False)
+            raise RuntimeError(f'{name}: {e!r}')
+        self.record(name, started, ok=response.status_code < 400)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name}: HTTP {response.status_code} {response.text[:200]}')
+        return response
+
+    def pick_format(self, video_data):
+        formats = video_data.get('formats') or []
+        if self.args.mode == 'merge':
+            video = next((f for f in formats if f['type'] == 'video_only'), None)
+            audio = next((f for f in formats if f['type'] == 'audio_only'), None)
+            if not video or not audio:
+                raise RuntimeError('extract_info: no separate video and audio streams to merge')
+            return f"{video['format_id']}+{audio['format_id']}"
+        combined = next((f for f in formats if f['type'] == 'combined'), None)
+        if not combined:
+            raise RuntimeError('extract_info: no progressive format listed')
+        return combined['format_id']
+
+    async def session(self, index):
+        started = time.perf_counter()
+        video_id = f'{self.id_prefix}{index % self.args.videos:09d}'
+        url = self.origin.video_url(video_id)
+
+        video_data = (await self.timed('extract_info', 'POST', '/extract_info', json={'url': url})).json()
+        format_id = self.pick_format(video_data)
+        download_id = (await self.timed('download', 'POST', '/download', json={
+            'url': url, 'format_id': format_id, 'info_token': video_data.get('info_token')
+        })).json()['download_id']
+
+        job_started = time.perf_counter()
+        while True:
+            progress = (await self.timed('progress', 'GET', f'/progress/{download_id}')).json()
+            if progress.get('status') in TERMINAL_STATES:
+                break
+            if time.perf_counter() - job_started > self.args.job_timeout:
+                raise RuntimeError(f'progress: job {download_id} not done after {self.args.job_timeout}s')
+            await asyncio.sleep(self.args.poll_interval)
+        self.record('job', job_started, ok=progress['status'] == 'finished')
+        if progress['status'] != 'finished':
+            raise RuntimeError(f"job: {progress['status']} {progress.get('error', '')}")
+
+        filename = progress['filename']
+        self.filenames.add(filename)
+        file_started = time.perf_counter()
+        try:
+            async with self.client.stream('GET', f'/download_file/{filename}') as response:
+                async for chunk in response.aiter_bytes():
+                    self.file_bytes += len(chunk)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        self.record('download_file', file_started, ok=ok)
+        if not ok:
+            raise RuntimeError(f'download_file: failed for {filename}')
+        self.record('session', started)
+
+    async def run(self):
+        queue = asyncio.Queue()
+        for index in range(self.args.requests):
+            queue.put_nowait(index)
+        failures = []
+
+        async def user():
+            while not queue.empty():
+                index = queue.get_nowait()
+                try:
+                    await self.session(index)
+                except Exception as e:
+                    failures.append(str(e))
+                    self.errors['session'] = self.errors.get('session', 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - started
+        return elapsed, failures
+
+    def report(self, elapsed, failures, rss):
+        endpoints = {}
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            endpoints[name] = {
+                'count': len(values),
+                'errors': self.errors.get(name, 0),
+                'p50': percentile(values, 0.50),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+            }
+        completed = len(self.latencies.get('session', []))
+        return {
+            'config': {key: getattr(self.args, key) for key in (
+                'requests', 'concurrency', 'videos', 'media_size', 'mode', 'poll_interval'
+            )},
+            'elapsed': elapsed,
+            'sessions_completed': completed,
+            'sessions_failed': len(failures),
+            'sessions_per_second': completed / elapsed if elapsed else 0,
+            'download_file_bytes_per_second': self.file_bytes / elapsed if elapsed else 0,
+            'origin_media_bytes': self.origin.counters['media_bytes'],
+            'origin_requests': self.origin.counters['requests'],
+            'endpoints': endpoints,
+            **rss,
+            'failures': failures[:20],
+        }
+
+
+def print_report(report):
+    print(f"{'endpoint':<16} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    order = ('extract_info', 'download', 'progress', 'job', 'download_file', 'session')
+    for name in sorted(report['endpoints'], key=lambda n: order.index(n) if n in order else len(order)):
+        stats = report['endpoints'][name]
+        print(f"{name:<16} {stats['count']:>6} {stats['errors']:>6} {stats['p50'] * 1000:>9.1f} "
+              f"{stats['p99'] * 1000:>9.1f} {stats['max'] * 1000:>9.1f}")
+    mb = 1024 * 1024
+    print(f"sessions: {report['sessions_completed']} ok, {report['sessions_failed']} failed "
+          f"in {report['elapsed']:.1f}s ({report['sessions_per_second']:.2f}/s)")
+    print(f"download_file throughput: {report['download_file_bytes_per_second'] / mb:.1f} MB/s, "
+          f"origin served {report['origin_media_bytes'] / mb:.1f} MB in {report['origin_requests']} requests")
+    if report.get('rss_peak'):
+        print(f"app RSS: start {report['rss_start'] / mb:.0f} MB, end {report['rss_end'] / mb:.0f} MB, "
+              f"peak {report['rss_peak'] / mb:.0f} MB")
+    for failure in report['failures']:
+        print(f"❌ {failure}")
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Percentiles that got slower than the baseline by more than `tolerance` (a fraction)"""
+    regressions = []
+    for name, stats in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if not before:
+            continue
+        for key in ('p50', 'p99'):
+            if before[key] and stats[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {before[key] * 1000:.1f} ms -> {stats[key] * 1000:.1f} ms")
+    if baseline.get('rss_peak') and report.get('rss_peak') and report['rss_peak'] > baseline['rss_peak'] * (1 + tolerance):
+        regressions.append(f"rss_peak: {baseline['rss_peak'] // 1024 ** 2} MB -> {report['rss_peak'] // 1024 ** 2} MB")
+    return regressions
+
+
+async def drive(base_url, origin, args):
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        test = LoadTest(client, origin, args)
+        elapsed, failures = await test.run()
+    return test, elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50, help='sessions to run')
+    parser.add_argument('--concurrency', type=int, default=8, help='sessions in flight at once')
+    parser.add_argument('--videos', type=int, help='distinct videos (default: one per session, fewer exercises the caches)')
+    parser.add_argument('--media-size', type=float, default=8, help='hd progressive/DASH video size in MB')
+    parser.add_argument('--mode', choices=('progressive', 'merge'), default='progressive',
+                        help='download the progressive mp4 or merge the DASH video+audio (needs ffmpeg)')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--page-delay', type=float, default=0, help='seconds the origin waits before each response')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--target', help='base URL of a running app instead of starting one')
+    parser.add_argument('--pid', type=int, help='with --target: process to sample RSS from')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers when starting the app')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra app environment')
+    parser.add_argument('--keep-files', action='store_true', help='leave downloaded files in outputs/')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='report from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown vs --baseline')
+    args = parser.parse_args()
+    args.videos = args.videos or args.requests
+    media_size = int(args.media_size * 1024 * 1024)
+
+    with tempfile.TemporaryDirectory(prefix='fbdl-loadtest-') as media_dir:
+        dash = None
+        if args.mode == 'merge':
+            dash = render_dash_media(media_dir, media_size, duration=10)
+            if not dash:
+                sys.exit('--mode merge needs ffmpeg on PATH to render the DASH streams')
+        origin = FakeOrigin(media_size, dash, args.page_delay).start()
+
+        app_server = None
+        if args.target:
+            base_url, pid = args.target.rstrip('/'), args.pid
+        else:
+            env = dict(item.split('=', 1) for item in args.env)
+            env.setdefault('OUTPUTS_JANITOR_INTERVAL', '0')
+            app_server = AppServer(env, args.workers).start()
+            base_url, pid = app_server.url, app_server.process.pid
+
+        sampler = RSSSampler(pid).start() if pid else None
+        try:
+            test, elapsed, failures = asyncio.run(drive(base_url, origin, args))
+        finally:
+            rss = sampler.stop() if sampler else {}
+            if app_server:
+                app_server.stop()
+            origin.stop()
+
+    if app_server and not args.keep_files:
+        for filename in test.filenames:
+            try:
+                os.remove(os.path.join(OUTPUTS_DIR, filename))
+            except OSError:
+                pass
+
+    report = test.report(elapsed, failures, rss)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"📉 {regression}")
+        if regressions:
+            sys.exit(1)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
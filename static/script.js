@@ -3,6 +3,7 @@ class FacebookDownloader {
     this.currentVideoData = null;
     this.currentDownloadId = null;
     this.progressInterval = null;
+    this.progressStream = null;
     this.currentFilename = null;
     this.isProcessing = false;
     this.progressCheckCount = 0;
@@ -66,6 +67,7 @@ class FacebookDownloader {
     this.hideElement("error");
     this.hideElement("success");
     if (this.progressInterval) clearInterval(this.progressInterval);
+    this.stopProgressStream();
   }
 
   async extractVideoInfo() {
@@ -203,7 +205,13 @@ class FacebookDownloader {
       const response = await fetch("/download", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ url, format_id: formatId }),
+        body: JSON.stringify({
+          url,
+          format_id: formatId,
+          info_token: this.currentVideoData
+            ? this.currentVideoData.info_token
+            : null,
+        }),
       });
 
       const data = await response.json();
@@ -219,6 +227,34 @@ class FacebookDownloader {
   }
 
   startProgressTracking() {
+    if (!window.EventSource) {
+      this.startProgressPolling();
+      return;
+    }
+
+    // Server pushes updates as they happen; fall back to polling on failure
+    this.progressStream = new EventSource(
+      `/progress/${this.currentDownloadId}/stream`
+    );
+    this.progressStream.onmessage = (event) => {
+      if (this.handleProgress(JSON.parse(event.data))) {
+        this.stopProgressStream();
+      }
+    };
+    this.progressStream.onerror = () => {
+      this.stopProgressStream();
+      this.startProgressPolling();
+    };
+  }
+
+  stopProgressStream() {
+    if (this.progressStream) {
+      this.progressStream.close();
+      this.progressStream = null;
+    }
+  }
+
+  startProgressPolling() {
     let attempts = 0;
     const maxAttempts = 180;
 
@@ -233,14 +269,7 @@ class FacebookDownloader {
       try {
         const response = await fetch(`/progress/${this.currentDownloadId}`);
         const progress = await response.json();
-
-        if (progress.status === "downloading") {
-          this.updateProgress(progress);
-        } else if (progress.status === "finished") {
-          this.downloadComplete(progress.filename);
-          clearInterval(this.progressInterval);
-        } else if (progress.status === "error") {
-          this.showError(progress.error || "Download failed");
+        if (this.handleProgress(progress)) {
           clearInterval(this.progressInterval);
         }
       } catch (error) {
@@ -249,6 +278,31 @@ class FacebookDownloader {
     }, 2000);
   }
 
+  // Returns true once the download reached a terminal state
+  handleProgress(progress) {
+    if (progress.status === "downloading") {
+      this.updateProgress(progress);
+    } else if (progress.status === "queued") {
+      document.getElementById("progressSpeed").textContent =
+        progress.queue_position
+          ? `Queued (#${progress.queue_position})`
+          : progress.message || "Queued";
+    } else if (progress.status === "retrying") {
+      document.getElementById("progressSpeed").textContent =
+        progress.message || "Retrying...";
+    } else if (progress.status === "cancelled") {
+      this.showError("Download cancelled");
+      return true;
+    } else if (progress.status === "finished") {
+      this.downloadComplete(progress.filename);
+      return true;
+    } else if (progress.status === "error") {
+      this.showError(progress.error || "Download failed");
+      return true;
+    }
+    return false;
+  }
+
   updateProgress(progress) {
     const percent = Math.min(progress.percent || 0, 100);
     document.getElementById("progressFill").style.width = `${percent}%`;
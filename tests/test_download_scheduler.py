@@ -0,0 +1,106 @@
+"""DownloadScheduler and /download coalescing, driven by a fake runner instead of yt-dlp"""
+import os
+import sys
+import threading
+import time
+
+# Importing app must not start background janitors on the real outputs/ directory
+os.environ.setdefault("OUTPUTS_JANITOR_INTERVAL", "0")
+os.environ.setdefault("OUTPUT_INDEX_RECONCILE_INTERVAL", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+VIDEO_URL = 'https://www.facebook.com/reel/{}'
+
+
+class FakeRunner:
+    """Records the jobs it runs; each one blocks until release() so tests control the pace"""
+    def __init__(self, on_done=None):
+        self.started = []
+        self.release_event = threading.Event()
+        self.on_done = on_done
+        self.lock = threading.Lock()
+
+    def __call__(self, job):
+        with self.lock:
+            self.started.append(job.download_id)
+        self.release_event.wait(5)
+        if self.on_done:
+            self.on_done(job)
+
+    def release(self):
+        self.release_event.set()
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self.started) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+
+def wait_idle(scheduler, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        snapshot = scheduler.snapshot()
+        if not snapshot['queued'] and not snapshot['running']:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_runs_higher_priority_first_then_fifo():
+    runner = FakeRunner()
+    scheduler = app.DownloadScheduler(1, 1, runner=runner)
+    scheduler.submit(app.DownloadJob('blocker', 'url', 'hd'))
+    assert runner.wait_for(1)
+
+    for download_id, priority in (('low-1', 0), ('batch', -1), ('high', 5), ('low-2', 0)):
+        scheduler.submit(app.DownloadJob(download_id, 'url', 'hd', priority=priority))
+    assert scheduler.queue_position('high') == 1
+    assert scheduler.queue_position('batch') == 4
+
+    runner.release()
+    assert wait_idle(scheduler)
+    assert runner.started == ['blocker', 'high', 'low-1', 'low-2', 'batch']
+
+
+def test_cancelled_queued_job_never_runs():
+    runner = FakeRunner()
+    scheduler = app.DownloadScheduler(1, 1, runner=runner)
+    scheduler.submit(app.DownloadJob('running', 'url', 'hd'))
+    assert runner.wait_for(1)
+    scheduler.submit(app.DownloadJob('queued', 'url', 'hd'))
+
+    assert scheduler.cancel('queued') == 'queued'
+    assert app.job_store.get('queued')['status'] == 'cancelled'
+    assert scheduler.cancel('running') == 'running'
+    assert scheduler.cancel('unknown') is None
+
+    runner.release()
+    assert wait_idle(scheduler)
+    assert runner.started == ['running']
+    assert scheduler.snapshot()['cancelled'] == 2
+
+
+def test_identical_downloads_share_one_job(monkeypatch):
+    runner = FakeRunner(on_done=lambda job: app.download_registry.finish(job.download_id))
+    monkeypatch.setattr(app, 'download_scheduler', app.DownloadScheduler(2, 1, runner=runner))
+    monkeypatch.setattr(app, 'download_journal', None)
+    client = TestClient(app.app)
+
+    url = VIDEO_URL.format('100000000000001')
+    first = client.post('/download', json={'url': url, 'format_id': 'hd'}).json()['download_id']
+    second = client.post('/download', json={'url': url, 'format_id': 'hd'}).json()['download_id']
+    other_format = client.post('/download', json={'url': url, 'format_id': 'sd'}).json()['download_id']
+
+    assert second == first
+    assert other_format != first
+    assert runner.wait_for(2)
+    runner.release()
+    assert wait_idle(app.download_scheduler)
+    assert sorted(runner.started) == sorted([first, other_format])